@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Measure what pytest-elk-reporter costs per test
+
+runs synthetic suites of trivial tests without the plugin, with the plugin inactive (no address),
+and with the plugin posting to a local stand-in Elasticsearch, and reports the overhead of each:
+
+    python -m benchmarks.bench_overhead --tests 1000 10000 --latency 0.005 --throttle-rate 0.05
+
+with `--max-overhead-us`, exits with 1 when the per-test overhead is higher,
+to guard against regressions
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+from importlib import metadata
+
+from benchmarks.es_server import StandInElasticsearch
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# runs in the child process, so its timing and peak RSS cover pytest only
+RUNNER = """
+import sys, json, time, resource, pytest
+start = time.perf_counter()
+ret = pytest.main(sys.argv[2:])
+elapsed = time.perf_counter() - start
+max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform != "darwin":
+    max_rss *= 1024
+with open(sys.argv[1], "w") as result_file:
+    json.dump(dict(ret=int(ret), elapsed=elapsed, max_rss=max_rss), result_file)
+"""
+
+SUITE = """
+import pytest
+
+@pytest.mark.parametrize("index", range({count}))
+def test_trivial(index):
+    pass
+"""
+
+MODES = dict(
+    disabled=["-p", "no:elk-reporter", "-p", "no:pytest_elk_reporter"],
+    inactive=[],
+    enabled=["--es-address={address}", "-o", "es_index_name=benchmark"],
+)
+
+
+def plugin_env():
+    env = dict(os.environ)
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, "select"):
+        entry_points = entry_points.select(group="pytest11")
+    else:
+        entry_points = entry_points.get("pytest11", [])
+    if not any(entry_point.name == "elk-reporter" for entry_point in entry_points):
+        # running from a checkout, load the plugin from the source tree
+        env["PYTHONPATH"] = os.pathsep.join(
+            filter(None, [ROOT_DIR, env.get("PYTHONPATH")])
+        )
+        env["PYTEST_PLUGINS"] = "pytest_elk_reporter"
+    return env
+
+
+def run_suite(suite_dir, args, env):
+    result_path = os.path.join(suite_dir, "result.json")
+    subprocess.run(
+        [sys.executable, "-c", RUNNER, result_path, "-q", "-p", "no:randomly"] + args,
+        cwd=suite_dir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        check=False,
+    )
+    with open(result_path) as result_file:
+        return json.load(result_file)
+
+
+def run_mode(mode, suite_dir, server, extra_args=(), repeat=1):
+    """
+    :param mode: one of `MODES`
+    :param suite_dir: directory of the synthetic suite
+
+    :returns: the fastest of `repeat` runs, with the requests Elasticsearch got
+    """
+    env = plugin_env()
+    args = [arg.format(address=server.address) for arg in MODES[mode]]
+    args += list(extra_args)
+    runs = []
+    for _ in range(repeat):
+        before = dict(server.counters)
+        run = run_suite(suite_dir, args, env)
+        if run["ret"] != 0:
+            raise RuntimeError(
+                "pytest failed with {} in '{}' mode".format(run["ret"], mode)
+            )
+        run["requests"] = server.counters["requests"] - before.get("requests", 0)
+        runs.append(run)
+    return min(runs, key=lambda run: run["elapsed"])
+
+
+def benchmark(count, server, extra_args=(), repeat=1):
+    """
+    :param count: number of tests in the synthetic suite
+    :param server: a started `StandInElasticsearch`
+    :param extra_args: more pytest arguments, used in all the modes
+    :param repeat: number of runs of each mode, the fastest is kept
+
+    :returns: dict of results for each mode
+    """
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="elk-bench-") as suite_dir:
+        with open(os.path.join(suite_dir, "pytest.ini"), "w") as ini_file:
+            ini_file.write("[pytest]\n")
+        with open(os.path.join(suite_dir, "test_synthetic.py"), "w") as test_file:
+            test_file.write(SUITE.format(count=count))
+
+        for mode in MODES:
+            results[mode] = run_mode(mode, suite_dir, server, extra_args, repeat)
+
+    baseline = results["disabled"]
+    for result in results.values():
+        result["overhead_us"] = (result["elapsed"] - baseline["elapsed"]) / count * 1e6
+        result["rss_delta"] = result["max_rss"] - baseline["max_rss"]
+    return results
+
+
+def print_results(count, results):
+    print("{} tests".format(count))
+    print(
+        "  {:<10}{:>12}{:>16}{:>14}{:>16}{:>12}".format(
+            "mode",
+            "wall [s]",
+            "per test [us]",
+            "peak RSS [MB]",
+            "RSS delta [MB]",
+            "requests",
+        )
+    )
+    for mode, result in results.items():
+        print(
+            "  {:<10}{:>12.3f}{:>16.1f}{:>14.1f}{:>16.1f}{:>12}".format(
+                mode,
+                result["elapsed"],
+                result["overhead_us"],
+                result["max_rss"] / 1024.0 / 1024.0,
+                result["rss_delta"] / 1024.0 / 1024.0,
+                result["requests"],
+            )
+        )
+
+
+def check_limits(results, args):
+    """
+    :param results: results of `benchmark()` for one suite
+    :param args: the parsed command line, with the `--max-*` limits
+
+    :returns: True if a limit was exceeded
+    """
+    failed = False
+    limits = (
+        ("enabled", args.max_overhead_us),
+        ("inactive", args.max_inactive_overhead_us),
+    )
+    for mode, limit in limits:
+        if limit is not None and results[mode]["overhead_us"] > limit:
+            print(
+                "  {} overhead {:.1f}us is over the limit of {:.1f}us".format(
+                    mode, results[mode]["overhead_us"], limit
+                )
+            )
+            failed = True
+    rss_delta_mb = results["enabled"]["rss_delta"] / 1024.0 / 1024.0
+    if args.max_rss_delta_mb is not None and rss_delta_mb > args.max_rss_delta_mb:
+        print(
+            "  enabled RSS delta {:.1f}MB is over the limit of {:.1f}MB".format(
+                rss_delta_mb, args.max_rss_delta_mb
+            )
+        )
+        failed = True
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__.strip().split("\n", 1)[1],
+    )
+    parser.add_argument(
+        "--tests",
+        type=int,
+        nargs="+",
+        default=[1000, 10000],
+        help="sizes of the synthetic suites",
+    )
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--max-overhead-us",
+        type=float,
+        default=None,
+        help="fail if the enabled plugin costs more than this per test, in microseconds",
+    )
+    parser.add_argument(
+        "--max-inactive-overhead-us",
+        type=float,
+        default=None,
+        help="fail if the inactive plugin costs more than this per test, in microseconds",
+    )
+    parser.add_argument(
+        "--max-rss-delta-mb",
+        type=float,
+        default=None,
+        help="fail if the enabled plugin adds more than this to the peak RSS, in MB",
+    )
+    parser.add_argument("--json", dest="json_path", help="write the results here")
+    parser.add_argument(
+        "pytest_args", nargs="*", help="more pytest arguments, after `--`"
+    )
+    args = parser.parse_args(argv)
+
+    server = StandInElasticsearch(
+        latency=args.latency,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        seed=0,
+    ).start()
+    all_results = {}
+    failed = False
+    try:
+        for count in args.tests:
+            results = benchmark(count, server, args.pytest_args, repeat=args.repeat)
+            print_results(count, results)
+            all_results[count] = results
+            failed = check_limits(results, args) or failed
+    finally:
+        server.stop()
+
+    if args.json_path:
+        with open(args.json_path, "w") as json_file:
+            json.dump(all_results, json_file, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for Elasticsearch, answering the requests sent by pytest-elk-reporter
+
+can be run on its own:
+
+    python -m benchmarks.es_server --port 9200 --latency 0.01 --throttle-rate 0.1
+"""
+
+import gzip
+import json
+import time
+import random
+import argparse
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self.handle_request()
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        self.handle_request()
+
+    def do_PUT(self):  # pylint: disable=invalid-name
+        self.handle_request()
+
+    def read_body(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        return body
+
+    def handle_request(self):
+        server = self.server
+        body = self.read_body()
+        path = self.path.split("?")[0]
+        outcome = server.pick_outcome()
+        server.count("requests", bytes_received=len(body))
+
+        if outcome == "throttled":
+            server.count("throttled")
+            self.reply(429, {"error": "throttled"}, headers={"Retry-After": "0"})
+        elif outcome == "error":
+            server.count("errors")
+            self.reply(500, {"error": "stand-in error"})
+        elif path.endswith("/_bulk"):
+            lines = body.decode("utf-8").splitlines()
+            documents = len(lines) // 2
+            server.count("bulk_requests", documents=documents)
+            items = [{"index": {"status": 201}}] * documents
+            self.reply(200, {"took": 1, "errors": False, "items": items})
+        elif path.endswith("/_search"):
+            server.count("searches")
+            self.reply(
+                200,
+                {
+                    "hits": {"hits": []},
+                    "aggregations": {
+                        "tests": {"buckets": []},
+                        "percentiles_duration": {"values": {"95.0": None}},
+                    },
+                },
+            )
+        elif "/_doc" in path:
+            server.count("documents")
+            self.reply(201, {"result": "created"})
+        else:
+            self.reply(200, {"acknowledged": True})
+
+    def reply(self, status, data, headers=None):
+        content = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class StandInElasticsearch(ThreadingHTTPServer):
+    """
+    HTTP server emulating the `_doc`, `_bulk` and `_search` APIs of Elasticsearch
+
+    :param latency: seconds added to every response
+    :param error_rate: fraction of requests answered with 500
+    :param throttle_rate: fraction of requests answered with 429
+    """
+
+    daemon_threads = True
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        address=("127.0.0.1", 0),
+        latency=0.0,
+        error_rate=0.0,
+        throttle_rate=0.0,
+        seed=None,
+    ):
+        super().__init__(address, StandInHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.counters = Counter()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def address(self):
+        return "{}:{}".format(*self.server_address[:2])
+
+    def pick_outcome(self):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            roll = self.random.random()
+        if roll < self.throttle_rate:
+            return "throttled"
+        if roll < self.throttle_rate + self.error_rate:
+            return "error"
+        return "ok"
+
+    def count(self, name, **amounts):
+        with self.lock:
+            self.counters[name] += 1
+            self.counters.update(amounts)
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.serve_forever, kwargs=dict(poll_interval=0.05), daemon=True
+        )
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=9200)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = StandInElasticsearch(
+        ("127.0.0.1", args.port),
+        latency=args.latency,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+    )
+    print("stand-in Elasticsearch listening on {}".format(server.address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(dict(server.counters))
+
+
+if __name__ == "__main__":
+    main()
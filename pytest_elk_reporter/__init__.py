@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import pytest
+
+from .options import pytest_addoption
+from .reporter import ElkReporter, ElkRuntestHooks, ReportRecord, get_username
+from .context import ContextCollector
+from .metrics import ReporterMetrics
+from .shipping import BulkShipper, NdjsonFileSink, ReportSpool
+from .transport import AsyncResponse, AsyncTransport, RequestsTransport
+from .work_queue import WorkQueue
+from .scheduling import DurationCache, LongestFirstScheduling
+from .upload import BulkUploader, UploadConfig, upload_main
+
+
+def pytest_configure(config):
+    config.elk = ElkReporter(config)
+    # prevent posting from xdist workers, when the controller ships their results
+    config.elk.is_slave = (
+        config.elk.is_worker and config.elk.es_xdist_mode == "controller"
+    )
+    config.elk.es_index_name = config.getini("es_index_name")
+    config.pluginmanager.register(config.elk, "elk-reporter-runtime")
+    config.elk.configured = True
+    # without Elasticsearch configured, the reporter stays inactive and costs nothing
+    config.elk.activate()
+
+
+def pytest_unconfigure(config):
+    elk = getattr(config, "elk", None)
+    if elk:
+        elk.close_shipper()
+        elk.close_session()
+        if elk.output:
+            elk.output.close()
+        del config.elk
+        config.pluginmanager.unregister(elk)
+        hooks = config.pluginmanager.get_plugin("elk-reporter-runtest")
+        if hooks:
+            config.pluginmanager.unregister(hooks)
+
+
+@pytest.fixture(scope="session")
+def elk_reporter(request):
+    return request.config.pluginmanager.get_plugin("elk-reporter-runtime")
+
+
+@pytest.fixture(scope="session", autouse=True)
+def jenkins_data(request):
+    """
+    Append jenkins job and user data into results session
+    """
+    # TODO: maybe filter some, like password/token and such ?
+    elk = request.config.pluginmanager.get_plugin("elk-reporter-runtime")
+    if elk.active:
+        elk.add_context("jenkins")
+
+
+@pytest.fixture(scope="session", autouse=True)
+def circle_data(request):
+    """
+    Append circle ci job and user data into results session
+    """
+    # TODO: maybe filter some, like password/token and such ?
+    elk = request.config.pluginmanager.get_plugin("elk-reporter-runtime")
+    if elk.active:
+        elk.add_context("circle")
+
+
+@pytest.fixture(scope="session", autouse=True)
+def travis_data(request):
+    """
+    Append travis ci job and user data into results session
+    """
+    elk = request.config.pluginmanager.get_plugin("elk-reporter-runtime")
+    if elk.active:
+        elk.add_context("travis")
+
+
+@pytest.fixture(scope="session", autouse=True)
+def github_data(request):
+    """
+    Append github ci job and user data into results session
+    """
+    elk = request.config.pluginmanager.get_plugin("elk-reporter-runtime")
+    if elk.active:
+        elk.add_context("github")
+
+
+@pytest.fixture(scope="session", autouse=True)
+def git_data(request):
+    """
+    Append git information into results session
+    """
+    elk = request.config.pluginmanager.get_plugin("elk-reporter-runtime")
+    if elk.active:
+        elk.add_context("git")
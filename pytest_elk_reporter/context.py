@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+The CI and git context of a test session
+"""
+
+import os
+import logging
+import threading
+import hashlib
+import subprocess
+import configparser
+
+
+LOGGER = logging.getLogger("elk-reporter")
+
+
+class ContextCollector(object):
+    """
+    Collect the git and CI context of the session in a background thread,
+    so it overlaps with the tests collection
+
+    git information is read out of the `.git` directory where possible,
+    the commit details are kept in the pytest cache, keyed by HEAD and the index mtime
+    """
+
+    CI_PREFIXES = dict(
+        jenkins="JENKINS_", circle="CIRCLE_", travis="TRAVIS_", github="GITHUB_"
+    )
+    GIT_LOG_FORMAT = "%x00".join(
+        [
+            "%H",
+            "%h",
+            "%h %s",
+            "commit %H%nAuthor: %an <%ae>%nDate:   %ad%n",
+            "%B",
+        ]
+    )
+
+    def __init__(self, cache=None, cwd=None):
+        self.cache = cache
+        self.cwd = cwd or os.getcwd()
+        self.context = dict()
+        self.thread = threading.Thread(
+            target=self.collect, name="elk-reporter-context", daemon=True
+        )
+
+    def start(self):
+        if self.thread.ident is None:
+            self.thread.start()
+        return self
+
+    def get(self, name):
+        """
+        wait for the collection to end
+
+        :param name: one of `git` or the keys of `CI_PREFIXES`
+        :returns: copy of the collected context
+        """
+        self.start().thread.join()
+        return dict(self.context.get(name, {}))
+
+    def collect(self):
+        context = {name: dict() for name in self.CI_PREFIXES}
+        # single pass over the environment for all the CI systems
+        for key, value in list(os.environ.items()):
+            for name, prefix in self.CI_PREFIXES.items():
+                if key.startswith(prefix):
+                    context[name][key.lower()] = value
+        try:
+            context["git"] = self.collect_git()
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.warning("Failed to collect git information", exc_info=True)
+        self.context = context
+
+    @staticmethod
+    def find_git_dir(path):
+        git_dir = os.environ.get("GIT_DIR")
+        if git_dir:
+            return os.path.abspath(git_dir)
+        path = os.path.abspath(path)
+        while True:
+            candidate = os.path.join(path, ".git")
+            if os.path.isdir(candidate):
+                return candidate
+            if os.path.isfile(candidate):
+                # worktrees and submodules point to their git directory
+                with open(candidate) as git_file:
+                    content = git_file.read().strip()
+                if content.startswith("gitdir:"):
+                    return os.path.normpath(
+                        os.path.join(path, content[len("gitdir:") :].strip())
+                    )
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+    @staticmethod
+    def get_common_dir(git_dir):
+        try:
+            with open(os.path.join(git_dir, "commondir")) as commondir_file:
+                return os.path.normpath(
+                    os.path.join(git_dir, commondir_file.read().strip())
+                )
+        except OSError:
+            return git_dir
+
+    @staticmethod
+    def read_head(git_dir, common_dir):
+        """
+        :returns: tuple of the branch name (`HEAD` when detached), and the commit sha
+        """
+        with open(os.path.join(git_dir, "HEAD")) as head_file:
+            head = head_file.read().strip()
+        if not head.startswith("ref:"):
+            return "HEAD", head
+        ref = head[len("ref:") :].strip()
+        branch = ref[len("refs/heads/") :] if ref.startswith("refs/heads/") else ref
+        for base_dir in (git_dir, common_dir):
+            try:
+                with open(os.path.join(base_dir, ref)) as ref_file:
+                    return branch, ref_file.read().strip()
+            except OSError:
+                pass
+        try:
+            with open(os.path.join(common_dir, "packed-refs")) as packed_refs:
+                for line in packed_refs:
+                    if line.rstrip().endswith(" " + ref):
+                        return branch, line.split()[0]
+        except OSError:
+            pass
+        return branch, None
+
+    @staticmethod
+    def read_remote_url(common_dir):
+        parser = configparser.RawConfigParser(strict=False)
+        try:
+            parser.read(os.path.join(common_dir, "config"))
+            return parser.get('remote "origin"', "url")
+        except configparser.Error:
+            return None
+
+    def git_log(self):
+        output = subprocess.check_output(
+            ["git", "log", "-1", "--no-decorate", "--format=" + self.GIT_LOG_FORMAT],
+            cwd=self.cwd,
+            stderr=subprocess.DEVNULL,
+        ).decode("utf-8")
+        sha, sha_short, oneline, header, message = output.split("\x00")
+        # same as the default `git log` format, which indents the message
+        message = "\n".join("    " + line for line in message.strip().splitlines())
+        return dict(
+            git_commit_oneline=oneline.strip(),
+            git_commit_full="{}\n{}".format(header, message),
+            git_commit_sha=sha.strip(),
+            git_commit_sha_short=sha_short.strip(),
+        )
+
+    def collect_git(self):
+        git_dir = self.find_git_dir(self.cwd)
+        if not git_dir:
+            return {}
+        common_dir = self.get_common_dir(git_dir)
+        branch, sha = self.read_head(git_dir, common_dir)
+        git_info = dict(git_branch=branch)
+        remote_url = self.read_remote_url(common_dir)
+        if remote_url:
+            git_info["git_repo"] = remote_url
+        if not sha:
+            return git_info
+
+        try:
+            index_mtime = os.stat(os.path.join(git_dir, "index")).st_mtime
+        except OSError:
+            index_mtime = None
+        cache_key = "elk-reporter/git/{}".format(
+            hashlib.sha1(git_dir.encode("utf-8")).hexdigest()[:16]
+        )
+        head = [branch, sha, index_mtime]
+        cached = self.cache.get(cache_key, {}) if self.cache is not None else {}
+        if cached.get("head") == head:
+            git_info.update(cached["info"])
+            return git_info
+
+        try:
+            commit_info = self.git_log()
+        except (OSError, subprocess.CalledProcessError, ValueError):
+            return git_info
+        if self.cache is not None:
+            self.cache.set(cache_key, dict(head=head, info=commit_info))
+        git_info.update(commit_info)
+        return git_info
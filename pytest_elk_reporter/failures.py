@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+The failure messages of test documents
+"""
+
+import hashlib
+import re
+
+
+class FailuresMixin(object):
+    """
+    The failure messages and fingerprints of test documents, part of `ElkReporter`
+    """
+
+    @staticmethod
+    def get_failure_messge(item_report):
+        if hasattr(item_report, "longreprtext"):
+            message = item_report.longreprtext
+        elif hasattr(item_report.longrepr, "reprcrash"):
+            message = item_report.longrepr.reprcrash.message
+        elif isinstance(item_report.longrepr, str):
+            message = item_report.longrepr
+        else:
+            message = str(item_report.longrepr)
+        return message
+
+    @staticmethod
+    def get_failure_fingerprint(*records):
+        """
+        fingerprint failures by their crash location and exception type,
+        or by their normalized message, if the location isn't known
+
+        :param records: `ReportRecord` of the failed reports
+        :returns: hex digest identifying the failure
+        """
+        parts = []
+        for record in records:
+            if record.crash is not None:
+                parts.append(record.crash)
+            else:
+                parts.append(re.sub(r"0x[0-9a-fA-F]+|\d+", "?", record.failure_message))
+        return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()[:16]
+
+    @staticmethod
+    def truncate_message(message, max_bytes):
+        """
+        :returns: the head and the tail of `message`, with a marker in between,
+                  within `max_bytes`, or only its head if the marker doesn't fit
+        """
+        data = message.encode("utf-8")
+        if len(data) <= max_bytes:
+            return message
+        marker = "\n...[{} bytes truncated]...\n"
+        # the marker can only get shorter once the kept bytes are known
+        budget = max_bytes - len(marker.format(len(data)).encode("utf-8"))
+        if budget < 0:
+            return data[:max_bytes].decode("utf-8", "ignore")
+        half = budget // 2
+        head = data[:half].decode("utf-8", "ignore")
+        tail = data[len(data) - half :].decode("utf-8", "ignore")
+        kept = len(head.encode("utf-8")) + len(tail.encode("utf-8"))
+        return head + marker.format(len(data) - kept) + tail
+
+    def get_failure_data(self, message, *item_reports):
+        """
+        :returns: failure fields of a test document, with the message
+                  truncated if the same failure was already reported in this session
+        """
+        fingerprint = self.get_failure_fingerprint(*item_reports)
+        failure_data = dict(failure_message=message, failure_fingerprint=fingerprint)
+        if self.es_failure_max_bytes and fingerprint in self.seen_failures:
+            truncated = self.truncate_message(message, self.es_failure_max_bytes)
+            if truncated is not message:
+                failure_data.update(
+                    failure_message=truncated, failure_message_truncated=True
+                )
+        self.seen_failures.add(fingerprint)
+        return failure_data
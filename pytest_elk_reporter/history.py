@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+"""
+Looking up the durations of tests from the reports of past sessions
+"""
+
+import datetime
+import logging
+import hashlib
+
+from .scheduling import DurationCache
+from .transport import RequestsTransport
+
+
+LOGGER = logging.getLogger("elk-reporter")
+
+
+class HistoryMixin(object):
+    """
+    Querying the test history, part of `ElkReporter`
+    """
+
+    LOOKUP_CHUNK_SIZE = 1000
+    # `ignore_above` of the keyword sub-field made by dynamic mapping
+    KEYWORD_IGNORE_ABOVE = 256
+
+    def fetch_test_duration(
+        self, collected_test_list, default_time_sec=120.0, max_workers=None
+    ):
+        """
+        fetch test 95 percentile duration of a list of tests
+
+        :param collected_test_list: the names of the test to lookup
+        :param default_time_sec: the time to return when no history data found
+        :param max_workers: number of threads to use for concurrency,
+                            default to the number of connections
+
+        :returns: map from test_id to 95 percentile duration
+        """
+
+        cache = self.get_duration_cache()
+        test_durations = []
+        if cache:
+            test_durations, collected_test_list = cache.lookup(
+                collected_test_list, offline=self.es_offline
+            )
+        if self.es_offline:
+            test_durations += [
+                dict(test_name=test_id, duration=None)
+                for test_id in collected_test_list
+            ]
+            collected_test_list = []
+        fetched_durations = self.fetch_test_history(collected_test_list, max_workers)
+        if cache and fetched_durations:
+            cache.update(fetched_durations)
+        test_durations += fetched_durations
+
+        for test in test_durations:
+            if not test["duration"]:
+                test["duration"] = default_time_sec
+        test_durations.sort(key=lambda x: x["duration"])
+        import pprint  # pylint: disable=import-outside-toplevel
+
+        LOGGER.debug(pprint.pformat(test_durations))
+
+        return test_durations
+
+    def get_duration_cache(self):
+        cache = getattr(self.config, "cache", None)
+        if cache is None or self.es_history_cache_ttl <= 0:
+            return None
+        source = "{}/{}".format(self.es_address, self.es_read_index)
+        history_options = (
+            self.es_history_window,
+            self.es_history_samples,
+            self.es_history_half_life,
+            self.get_history_branch(),
+            self.es_slices_group != "none",
+        )
+        if any(history_options):
+            source += "/{}/{}/{}/{}/{}".format(*history_options)
+        key = "elk-reporter/durations/{}".format(
+            hashlib.sha1(source.encode("utf-8")).hexdigest()[:16]
+        )
+        return DurationCache(cache, key, ttl=self.es_history_cache_ttl * 3600)
+
+    def fetch_test_history(self, collected_test_list, max_workers=None):
+        """
+        fetch test 95 percentile duration of a list of tests from Elasticsearch
+
+        all the lookups are sent concurrently, thru the asyncio transport or a pool of threads
+
+        :returns: list of dicts with `test_name` and `duration` (None if not found),
+                  and `setup_duration` when slicing groups tests
+        """
+        if not collected_test_list:
+            return []
+        self.exact_lookup = self.es_index_template and self.has_keyword_names()
+        if self.es_transport == "asyncio":
+            transport = self.async_transport
+        else:
+            transport = RequestsTransport(self, max_workers or self.es_connections)
+
+        durations = dict.fromkeys(collected_test_list)
+        setup_durations = {} if self.es_slices_group != "none" else None
+        try:
+            branch = self.get_history_branch()
+            if branch:
+                self.lookup_history(
+                    transport, collected_test_list, durations, branch, setup_durations
+                )
+                # e.g. a new branch, use the history of all the branches instead
+                missing = [
+                    test_id
+                    for test_id, duration in durations.items()
+                    if duration is None
+                ]
+            else:
+                missing = collected_test_list
+            self.lookup_history(
+                transport, missing, durations, setup_durations=setup_durations
+            )
+        finally:
+            if transport is not self._async_transport:
+                transport.close()
+
+        history = [
+            dict(test_name=test_id, duration=duration)
+            for test_id, duration in durations.items()
+        ]
+        if setup_durations is not None:
+            for test in history:
+                test["setup_duration"] = setup_durations.get(test["test_name"])
+        return history
+
+    def lookup_history(  # pylint: disable=too-many-arguments
+        self,
+        transport,
+        test_list,
+        durations,
+        branch=None,
+        setup_durations=None,
+        per_test=False,
+    ):
+        """
+        look up the history of `test_list`, updating `durations` with what was found
+
+        :param transport: `RequestsTransport` or `AsyncTransport` to send the queries with
+        :param branch: only use the history of this git branch
+        :param setup_durations: if given, updated with the setup durations found
+        :param per_test: send a query for each test, even with `--es-slices-lookup=aggregation`
+        """
+        import concurrent.futures  # pylint: disable=import-outside-toplevel
+
+        if not test_list:
+            return
+        per_test = per_test or self.es_slices_lookup == "per-test"
+        if per_test:
+            lookups = [(test_id,) for test_id in test_list]
+        else:
+            lookups = [
+                tuple(test_list[i : i + self.LOOKUP_CHUNK_SIZE])
+                for i in range(0, len(test_list), self.LOOKUP_CHUNK_SIZE)
+            ]
+
+        path = "{}/_search".format(self.es_read_index)
+        pending = {
+            transport.submit(
+                "POST",
+                path,
+                json=self.history_query(lookup, branch=branch, per_test=per_test),
+            ): lookup
+            for lookup in lookups
+        }
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                lookup = pending.pop(future)
+                after_key = self.read_history(
+                    future, lookup, durations, setup_durations
+                )
+                if after_key:
+                    future = transport.submit(
+                        "POST",
+                        path,
+                        json=self.history_query(
+                            lookup, after_key=after_key, branch=branch
+                        ),
+                    )
+                    pending[future] = lookup
+
+        if not per_test and not self.exact_lookup:
+            # names longer than that aren't in the keyword sub-field, look them up one by one
+            self.lookup_history(
+                transport,
+                [
+                    test_id
+                    for test_id in test_list
+                    if durations[test_id] is None
+                    and len(test_id) > self.KEYWORD_IGNORE_ABOVE
+                ],
+                durations,
+                branch,
+                setup_durations,
+                per_test=True,
+            )
+
+    def read_history(self, future, lookup, durations, setup_durations):
+        """
+        update `durations` (and `setup_durations` if given) from the response of a lookup
+
+        :param future: `concurrent.futures.Future` of the response
+        :returns: the key of the next page to fetch, if there is one
+        """
+        import requests  # pylint: disable=import-outside-toplevel
+
+        try:
+            res = future.result()
+            res.raise_for_status()
+            return self.parse_history(lookup, res.json(), durations, setup_durations)
+        except (requests.exceptions.RequestException, ValueError, KeyError) as ex:
+            LOGGER.warning("Failed to fetch history data: [%s]", str(ex))
+            return None
+
+    def get_history_branch(self):
+        """
+        :returns: the git branch to filter the history by, if any
+        """
+        if self.es_history_branch == "auto":
+            return self.context.get("git").get("git_branch")
+        return self.es_history_branch
+
+    def history_filters(self, branch=None):
+        """
+        :returns: filters bounding the history lookup by time and branch
+        """
+        filters = []
+        if self.es_history_window:
+            minutes = int(self.es_history_window * 24 * 60)
+            filters.append({"range": {"timestamp": {"gte": "now-{}m".format(minutes)}}})
+        if branch:
+            field = "git_branch" if self.exact_lookup else "git_branch.keyword"
+            filters.append({"term": {field: branch}})
+        return filters
+
+    def history_page_size(self):
+        """
+        :returns: number of tests in each page of the composite aggregation
+        """
+        if self.es_history_samples:
+            # keep the number of hits in a page bounded
+            return max(
+                10, min(self.LOOKUP_CHUNK_SIZE, 10000 // self.es_history_samples)
+            )
+        return self.LOOKUP_CHUNK_SIZE
+
+    def history_query(self, lookup, after_key=None, branch=None, per_test=False):
+        """
+        :param lookup: tuple of test names, looked up by one query
+        :param after_key: composite aggregation key of the previous page
+        :param branch: only use the history of this git branch
+        :param per_test: query the history of the single test of `lookup`
+
+        :returns: body of the search for the duration percentiles of the `lookup` tests,
+                  or for their latest runs, with `--es-history-samples`
+        """
+        if self.es_history_samples:
+            samples = {
+                "size": self.es_history_samples,
+                "sort": [{"timestamp": {"order": "desc"}}],
+                "_source": ["duration", "setup_duration", "timestamp"],
+            }
+            aggs = {"recent": {"top_hits": samples}}
+        else:
+            samples = {"size": 0}
+            aggs = {
+                "percentiles_duration": {
+                    "percentiles": {"field": "duration", "percents": [90, 95, 99]}
+                },
+            }
+            if self.es_slices_group != "none":
+                aggs["percentiles_setup_duration"] = {
+                    "percentiles": {"field": "setup_duration", "percents": [95]}
+                }
+        if self.exact_lookup:
+            name_field, passed = "name", {"term": {"outcome": "passed"}}
+        else:
+            name_field, passed = self.es_name_field, {"match": {"outcome": "passed"}}
+        filters = self.history_filters(branch)
+
+        if per_test:
+            if self.exact_lookup:
+                query = {"bool": {"filter": [{"term": {"name": lookup[0]}}, passed]}}
+            else:
+                query = {
+                    "query_string": {"query": self.slices_query_fmt.format(lookup[0])}
+                }
+            if filters:
+                query = {"bool": {"must": [query], "filter": filters}}
+            if self.es_history_samples:
+                return dict(samples, query=query)
+            return {"size": 0, "query": query, "aggs": aggs}
+
+        composite = {
+            "size": self.history_page_size(),
+            "sources": [{"name": {"terms": {"field": name_field}}}],
+        }
+        if after_key:
+            composite["after"] = after_key
+        return {
+            "size": 0,
+            "query": {
+                "bool": {
+                    "filter": [{"terms": {name_field: list(lookup)}}, passed] + filters
+                }
+            },
+            "aggs": {"tests": {"composite": composite, "aggs": aggs}},
+        }
+
+    def parse_history(self, lookup, result, durations, setup_durations=None):
+        """
+        update `durations` (and `setup_durations` if given) from the search result of a lookup
+
+        :returns: the key of the next page to fetch, if there is one
+        """
+        aggregation = result.get("aggregations", {}).get("tests")
+        if aggregation is None:
+            # the result of a single test lookup
+            tests = [(lookup[0], result)]
+        else:
+            tests = [
+                (bucket["key"]["name"], bucket)
+                for bucket in aggregation["buckets"]
+                if bucket["key"]["name"] in durations
+            ]
+        for test_id, test_result in tests:
+            duration = self.history_duration(test_result)
+            if duration is not None:
+                durations[test_id] = duration
+            if setup_durations is not None:
+                setup_durations[test_id] = self.history_duration(
+                    test_result, "setup_duration"
+                )
+        if (
+            aggregation is None
+            or len(aggregation["buckets"]) < self.history_page_size()
+        ):
+            return None
+        return aggregation.get("after_key")
+
+    def history_duration(self, result, field="duration"):
+        """
+        :param result: search result of one test, or its bucket in the composite aggregation
+        :param field: `duration` or `setup_duration`
+
+        :returns: the 95 percentile duration of the test, weighted by the age of its runs
+                  with `--es-history-half-life`, or None if it has no history
+        """
+        if not self.es_history_samples:
+            if "aggregations" in result:
+                result = result["aggregations"]
+            return result["percentiles_" + field]["values"]["95.0"]
+        hits = (
+            result["recent"]["hits"]["hits"]
+            if "recent" in result
+            else result["hits"]["hits"]
+        )
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        samples = []
+        for hit in hits:
+            source = hit["_source"]
+            if source.get(field) is None:
+                continue
+            weight = 1.0
+            if self.es_history_half_life and source.get("timestamp"):
+                timestamp = datetime.datetime.fromisoformat(source["timestamp"])
+                if timestamp.tzinfo is None:
+                    timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+                age = (now - timestamp).total_seconds() / (24 * 3600)
+                weight = 0.5 ** (max(age, 0.0) / self.es_history_half_life)
+            samples.append((source[field], weight))
+        return self.weighted_percentile(samples, 0.95)
+
+    @staticmethod
+    def weighted_percentile(samples, fraction):
+        """
+        :param samples: list of (value, weight)
+        :param fraction: percentile to compute, between 0 and 1
+
+        :returns: the smallest value whose samples carry `fraction` of the total weight,
+                  or None if there are no samples
+        """
+        total = sum(weight for _, weight in samples)
+        if not total:
+            return None
+        cumulative = 0.0
+        for value, weight in sorted(samples):
+            cumulative += weight
+            if cumulative >= fraction * total:
+                return value
+        return max(value for value, _ in samples)
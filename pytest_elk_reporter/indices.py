@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+The indices of the reports, their template and lifecycle policy
+"""
+
+import json
+import datetime
+import logging
+import hashlib
+
+from .context import ContextCollector
+
+
+LOGGER = logging.getLogger("elk-reporter")
+
+
+class IndicesMixin(object):
+    """
+    The indices written and read, their template and lifecycle policy, part of `ElkReporter`
+    """
+
+    TEMPLATE_VERSION = 1
+
+    def get_index_template(self):
+        """
+        composable index template for `es_index_name`, mapping the fields used by the history
+        queries as keywords, and keeping the bulky and per-run fields out of the index
+
+        :returns: body of the template
+        """
+        ci_variables = [
+            {
+                "{}_variables".format(name): {
+                    "match": prefix.lower() + "*",
+                    "runtime": {"type": "keyword"},
+                }
+            }
+            for name, prefix in sorted(ContextCollector.CI_PREFIXES.items())
+        ]
+        strings = {
+            "strings": {
+                "match_mapping_type": "string",
+                "mapping": {"type": "keyword", "ignore_above": 1024},
+            }
+        }
+        settings = {"number_of_shards": 1, "refresh_interval": "5s"}
+        if self.es_ilm_retention:
+            settings["index.lifecycle.name"] = self.lifecycle_policy_name
+        template = {
+            "index_patterns": [self.es_index_name, self.es_index_name + "-*"],
+            "priority": 200,
+            "version": self.TEMPLATE_VERSION,
+            "_meta": self.template_meta,
+            "template": {
+                "settings": settings,
+                "mappings": {
+                    "dynamic_templates": ci_variables + [strings],
+                    "properties": {
+                        "@timestamp": {"type": "date"},
+                        "name": {"type": "keyword"},
+                        "outcome": {"type": "keyword"},
+                        "markers": {"type": "keyword"},
+                        "duration": {"type": "float"},
+                        "setup_duration": {"type": "float"},
+                        "timestamp": {"type": "date"},
+                        "session_start_time": {"type": "date"},
+                        "session_id": {"type": "keyword"},
+                        "failure_fingerprint": {"type": "keyword"},
+                        "failure_message": {"type": "text", "index": False},
+                        "git_commit_full": {"type": "text", "index": False},
+                        "reporter_metrics": {"type": "object", "enabled": False},
+                    },
+                },
+            },
+        }
+        if self.es_index_mode == "daily":
+            # reads go thru the alias, so they cover all the days
+            template["template"]["aliases"] = {
+                "{}-history".format(self.es_index_name): {}
+            }
+        elif self.es_index_mode == "data-stream":
+            template["index_patterns"] = [self.es_index_name]
+            template["data_stream"] = {}
+        return template
+
+    @property
+    def lifecycle_policy_name(self):
+        return "pytest-elk-reporter-{}".format(self.es_index_name)
+
+    @property
+    def template_meta(self):
+        """what the installed template is compared against, to know if it's up to date"""
+        return {
+            "managed_by": "pytest-elk-reporter",
+            "index_mode": self.es_index_mode,
+            "retention_days": self.es_ilm_retention,
+        }
+
+    def get_lifecycle_policy(self):
+        """
+        lifecycle policy deleting indices older than `--es-ilm-retention` days,
+        data streams are also rolled over daily, or when a shard gets big
+
+        :returns: body of the policy
+        """
+        phases = {
+            "delete": {
+                "min_age": "{}h".format(int(self.es_ilm_retention * 24)),
+                "actions": {"delete": {}},
+            }
+        }
+        if self.es_index_mode == "data-stream":
+            phases["hot"] = {
+                "actions": {
+                    "rollover": {"max_age": "1d", "max_primary_shard_size": "10gb"}
+                }
+            }
+        return {"policy": {"_meta": self.template_meta, "phases": phases}}
+
+    def ensure_index_template(self):
+        """
+        install the index template (and lifecycle policy),
+        unless the cluster already has this version of it, for the same index mode and retention
+
+        once done, it's remembered in the pytest cache, so it's checked once per cluster and index
+
+        :returns: True if the template is installed
+        """
+        name = "pytest-elk-reporter-{}".format(self.es_index_name)
+        cache = getattr(self.config, "cache", None)
+        key = "elk-reporter/template/{}".format(
+            hashlib.sha1(
+                "{}/{}".format(self.es_address, name).encode("utf-8")
+            ).hexdigest()[:16]
+        )
+        installed = dict(self.template_meta, version=self.TEMPLATE_VERSION)
+        if cache is not None and cache.get(key, None) == installed:
+            return True
+        path = "_index_template/{}".format(name)
+        try:
+            res = self.es_request("GET", path)
+            templates = res.json()["index_templates"] if res.status_code == 200 else []
+            if not any(
+                (template["index_template"].get("version") or 0)
+                >= self.TEMPLATE_VERSION
+                and template["index_template"].get("_meta") == self.template_meta
+                for template in templates
+            ):
+                if self.es_ilm_retention:
+                    # the template refers to it, so it goes first
+                    self.es_request(
+                        "PUT",
+                        "_ilm/policy/{}".format(self.lifecycle_policy_name),
+                        json=self.get_lifecycle_policy(),
+                    ).raise_for_status()
+                self.es_request(
+                    "PUT", path, json=self.get_index_template()
+                ).raise_for_status()
+        except Exception as ex:  # pylint: disable=broad-except
+            LOGGER.warning("Failed to install the index template: [%s]", str(ex))
+            return False
+        if cache is not None:
+            cache.set(key, installed)
+        return True
+
+    def has_keyword_names(self):
+        """
+        :returns: True if `name` is mapped as a keyword in all the indices
+                  (as done by the index template), so tests can be looked up
+                  with exact `term` queries
+        """
+        try:
+            res = self.es_request(
+                "GET", "{}/_mapping/field/name".format(self.es_read_index)
+            )
+            res.raise_for_status()
+            mappings = [
+                index["mappings"].get("name", {}).get("mapping", {}).get("name", {})
+                for index in res.json().values()
+            ]
+        except Exception as ex:  # pylint: disable=broad-except
+            LOGGER.warning("Failed to fetch the mapping of 'name': [%s]", str(ex))
+            return False
+        return bool(mappings) and all(
+            mapping.get("type") == "keyword" for mapping in mappings
+        )
+
+    @property
+    def es_read_index(self):
+        """the index, alias or pattern the history is read from"""
+        if self._es_read_index:
+            return self._es_read_index
+        if self.es_index_mode == "daily":
+            return "{}-history".format(self.es_index_name)
+        return self.es_index_name
+
+    def write_index(self):
+        """
+        :returns: the index or data stream documents are written into now
+        """
+        if self.es_index_mode == "daily":
+            return "{}-{:%Y.%m.%d}".format(
+                self.es_index_name, datetime.datetime.now(tz=datetime.timezone.utc)
+            )
+        return self.es_index_name
+
+    def bulk_action(self):
+        """
+        :returns: the `_bulk` action line of documents written now
+        """
+        # data streams only accept `create`
+        op_type = "create" if self.es_index_mode == "data-stream" else "index"
+        return json.dumps({op_type: {"_index": self.write_index()}})
+
+    def get_session_enrich_definitions(self):
+        """
+        definitions of an enrich policy, and of an ingest pipeline using it,
+        to copy the session context back into test documents posted with `--es-normalize-session`
+
+        :returns: dict with the `policy` and `pipeline` bodies
+        """
+        return dict(
+            policy={
+                "match": {
+                    "indices": self.es_read_index,
+                    "match_field": "session_id",
+                    "enrich_fields": sorted(self.session_data),
+                    "query": {"term": {"session_context": True}},
+                }
+            },
+            pipeline={
+                "description": "copy pytest session context into test documents",
+                "processors": [
+                    {
+                        "enrich": {
+                            "policy_name": "pytest-elk-reporter-sessions",
+                            "field": "session_id",
+                            "target_field": "session",
+                            "ignore_missing": True,
+                        }
+                    }
+                ],
+            },
+        )
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Measuring the overhead of the reporter
+"""
+
+import time
+import threading
+import contextlib
+import bisect
+
+
+class ReporterMetrics(object):
+    """
+    Metrics of the reporter itself: latency histograms of timed operations, and max gauges
+
+    histograms use fixed buckets (upper bounds in milliseconds), percentiles are estimated from them
+    """
+
+    BUCKETS_MS = (
+        0.01,
+        0.1,
+        0.5,
+        1,
+        2.5,
+        5,
+        10,
+        25,
+        50,
+        100,
+        250,
+        500,
+        1000,
+        2500,
+        5000,
+        10000,
+        30000,
+    )
+
+    def __init__(self):
+        self.timers = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds, failed=False):
+        value = seconds * 1000.0
+        with self._lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = dict(
+                    count=0,
+                    failures=0,
+                    total_ms=0.0,
+                    max_ms=0.0,
+                    buckets=[0] * (len(self.BUCKETS_MS) + 1),
+                )
+            timer["count"] += 1
+            timer["failures"] += int(failed)
+            timer["total_ms"] += value
+            timer["max_ms"] = max(timer["max_ms"], value)
+            timer["buckets"][bisect.bisect_left(self.BUCKETS_MS, value)] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            self.observe(name, time.perf_counter() - start, failed=failed)
+
+    def gauge(self, name, value):
+        """keep the max value seen"""
+        if value > self.gauges.get(name, 0):
+            self.gauges[name] = value
+
+    def percentile(self, timer, fraction):
+        rank = fraction * timer["count"]
+        seen = 0
+        for bound, count in zip(self.BUCKETS_MS, timer["buckets"]):
+            seen += count
+            if seen >= rank:
+                return round(min(bound, timer["max_ms"]), 3)
+        return round(timer["max_ms"], 3)
+
+    def as_dict(self):
+        metrics = dict(self.gauges)
+        with self._lock:
+            for name, timer in self.timers.items():
+                metrics[name] = dict(
+                    count=timer["count"],
+                    failures=timer["failures"],
+                    total_ms=round(timer["total_ms"], 3),
+                    max_ms=round(timer["max_ms"], 3),
+                    p50_ms=self.percentile(timer, 0.5),
+                    p95_ms=self.percentile(timer, 0.95),
+                    p99_ms=self.percentile(timer, 0.99),
+                    histogram={
+                        str(bound): count
+                        for bound, count in zip(
+                            self.BUCKETS_MS + ("inf",), timer["buckets"]
+                        )
+                        if count
+                    },
+                )
+        return metrics
+
+    @staticmethod
+    def http_metric(path):
+        """:returns: metric name of an Elasticsearch api, i.e. `http_bulk` for `index/_bulk`"""
+        endpoint = path.split("?")[0].rstrip("/").rsplit("/", 1)[-1]
+        if not endpoint.startswith("_"):
+            endpoint = "index"
+        return "http" + endpoint
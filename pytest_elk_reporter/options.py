@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+"""
+The command line options and ini keys of the plugin
+"""
+
+
+def pytest_addoption(parser):
+    # pylint: disable=too-many-statements
+    group = parser.getgroup("elk-reporter")
+
+    group.addoption(
+        "--es-post-reports",
+        action="store_true",
+        dest="es_post_reports",
+        default=None,
+        help="Post reports to Elasticsearch",
+    )
+
+    group.addoption(
+        "--es-no-post-reports",
+        action="store_false",
+        dest="es_post_reports",
+        default=None,
+        help="Don't post reports to Elasticsearch",
+    )
+
+    group.addoption(
+        "--es-address",
+        action="store",
+        dest="es_address",
+        default=None,
+        help="Elasticsearch address",
+    )
+
+    group.addoption(
+        "--es-username",
+        action="store",
+        dest="es_username",
+        default=None,
+        help="Elasticsearch username",
+    )
+
+    group.addoption(
+        "--es-password",
+        action="store",
+        dest="es_password",
+        default=None,
+        help="Elasticsearch password",
+    )
+
+    group.addoption(
+        "--es-api-key",
+        action="store",
+        dest="es_api_key",
+        default=None,
+        help="Elasticsearch api key in base64 format",
+    )
+
+    group.addoption(
+        "--es-timeout",
+        action="store",
+        dest="es_timeout",
+        default=10,
+        help="Elasticsearch connection timeout",
+    )
+
+    group.addoption(
+        "--es-transport",
+        action="store",
+        dest="es_transport",
+        choices=["requests", "asyncio"],
+        default="requests",
+        help="How requests are sent to Elasticsearch, 'asyncio' requires aiohttp",
+    )
+    group.addoption(
+        "--es-max-in-flight",
+        action="store",
+        type=int,
+        dest="es_max_in_flight",
+        default=200,
+        help="Max number of concurrent requests, when using the 'asyncio' transport",
+    )
+    group.addoption(
+        "--es-connections",
+        action="store",
+        type=int,
+        dest="es_connections",
+        default=20,
+        help="Max number of connections kept open to Elasticsearch",
+    )
+    group.addoption(
+        "--es-max-retries",
+        action="store",
+        type=int,
+        dest="es_max_retries",
+        default=3,
+        help="Max number of retries of requests throttled by Elasticsearch (429/502/503)",
+    )
+    group.addoption(
+        "--es-retry-backoff",
+        action="store",
+        type=float,
+        dest="es_retry_backoff",
+        default=0.5,
+        help="Base of the exponential backoff between retries, in seconds",
+    )
+
+    group.addoption(
+        "--es-xdist-mode",
+        action="store",
+        dest="es_xdist_mode",
+        choices=["controller", "workers"],
+        default="controller",
+        help="With pytest-xdist, 'controller' ships all the results from the controller process, "
+        "'workers' ships the results from each worker process",
+    )
+
+    group.addoption(
+        "--es-xdist-schedule",
+        action="store",
+        dest="es_xdist_schedule",
+        choices=["xdist", "longest-first"],
+        default="xdist",
+        help="With pytest-xdist '--dist=load', 'longest-first' sends the longest tests first "
+        "according to their history, and then the shorter ones in shrinking chunks",
+    )
+
+    group.addoption(
+        "--es-slices",
+        action="store_true",
+        dest="es_slices",
+        default=False,
+        help="Splice collected tests base on history data",
+    )
+
+    group.addoption(
+        "--es-slices-group",
+        action="store",
+        dest="es_slices_group",
+        choices=["none", "class", "module", "package"],
+        default="none",
+        help="Keep the tests using fixtures of this scope (or a narrower one) "
+        "together when slicing, so their setup is paid once",
+    )
+
+    group.addoption(
+        "--es-work-queue",
+        action="store",
+        dest="es_work_queue",
+        default=None,
+        help="Shared directory of a queue of test chunks: with '--es-slices', "
+        "publish the chunks into it instead of include files, "
+        "otherwise pull chunks from it and run them until it's empty",
+    )
+    group.addoption(
+        "--es-work-queue-lease",
+        action="store",
+        type=float,
+        dest="es_work_queue_lease",
+        default=30.0,
+        help="Time after which a chunk of the work queue is pulled again, "
+        "if the agent running it didn't run a test in the meantime, in minutes",
+    )
+
+    group.addoption(
+        "--es-slices-lookup",
+        action="store",
+        dest="es_slices_lookup",
+        choices=["aggregation", "per-test"],
+        default="aggregation",
+        help="How to lookup history data: 'aggregation' fetches many tests in each query, "
+        "'per-test' sends one query for each test",
+    )
+
+    group.addoption(
+        "--es-history-window",
+        action="store",
+        type=float,
+        dest="es_history_window",
+        default=None,
+        help="Only use history data from the last days",
+    )
+    group.addoption(
+        "--es-history-samples",
+        action="store",
+        type=int,
+        dest="es_history_samples",
+        default=None,
+        help="Only use the latest runs of each test (up to 100)",
+    )
+    group.addoption(
+        "--es-history-half-life",
+        action="store",
+        type=float,
+        dest="es_history_half_life",
+        default=None,
+        help="Weight the latest runs of each test by their age, halving the weight of a run "
+        "every this many days",
+    )
+    group.addoption(
+        "--es-history-branch",
+        action="store",
+        nargs="?",
+        const="auto",
+        dest="es_history_branch",
+        default=None,
+        help="Only use history data of this git branch, or of the current one if not given, "
+        "falling back to all the branches for tests without history on it",
+    )
+
+    group.addoption(
+        "--es-history-cache-ttl",
+        action="store",
+        type=float,
+        dest="es_history_cache_ttl",
+        default=12,
+        help="How long history data is kept in the local cache, in hours (0 disables the cache)",
+    )
+
+    group.addoption(
+        "--es-offline",
+        action="store_true",
+        dest="es_offline",
+        default=False,
+        help="Splice only based on the locally cached history data",
+    )
+
+    group.addoption(
+        "--es-max-splice-time",
+        action="store",
+        type=float,
+        dest="es_max_splice_time",
+        default=60,
+        help="Max duration of each splice, in minutes",
+    )
+    group.addoption(
+        "--es-slices-count",
+        action="store",
+        type=int,
+        dest="es_slices_count",
+        default=None,
+        help="Splice collected tests into exactly this number of slices, "
+        "minimizing the duration of the longest one",
+    )
+    group.addoption(
+        "--es-default-test-time",
+        action="store",
+        type=float,
+        dest="es_default_test_time",
+        default=120,
+        help="Default time for a test, if history isn't found for it, in seconds",
+    )
+
+    group.addoption(
+        "--es-bulk-max-docs",
+        action="store",
+        type=int,
+        dest="es_bulk_max_docs",
+        default=500,
+        help="Max number of documents sent in one bulk request",
+    )
+    group.addoption(
+        "--es-bulk-max-bytes",
+        action="store",
+        type=int,
+        dest="es_bulk_max_bytes",
+        default=5 * 1024 * 1024,
+        help="Max size of one bulk request body, in bytes",
+    )
+    group.addoption(
+        "--es-bulk-flush-interval",
+        action="store",
+        type=float,
+        dest="es_bulk_flush_interval",
+        default=1.0,
+        help="Max time a document waits before its bulk request is sent, in seconds",
+    )
+    group.addoption(
+        "--es-flush-timeout",
+        action="store",
+        type=float,
+        dest="es_flush_timeout",
+        default=60.0,
+        help="Max time to wait for pending documents at the end of the session, in seconds",
+    )
+    group.addoption(
+        "--es-gzip",
+        action="store_true",
+        dest="es_gzip",
+        default=False,
+        help="Compress the documents sent to Elasticsearch with gzip",
+    )
+    group.addoption(
+        "--es-gzip-level",
+        action="store",
+        type=int,
+        dest="es_gzip_level",
+        default=6,
+        help="gzip compression level, from 1 (fastest) to 9 (smallest)",
+    )
+    group.addoption(
+        "--es-gzip-min-bytes",
+        action="store",
+        type=int,
+        dest="es_gzip_min_bytes",
+        default=1024,
+        help="Requests smaller than this aren't compressed, in bytes",
+    )
+    group.addoption(
+        "--es-normalize-session",
+        action="store_true",
+        dest="es_normalize_session",
+        default=False,
+        help="Post the session context once, in a session document, and only reference it "
+        "by 'session_id' from each test document",
+    )
+    group.addoption(
+        "--es-failure-max-bytes",
+        action="store",
+        type=int,
+        dest="es_failure_max_bytes",
+        default=4096,
+        help="A failure message is sent in full only the first time it's seen in a session, "
+        "and then truncated to this size, in bytes (0 always sends it in full)",
+    )
+    group.addoption(
+        "--es-spool-dir",
+        action="store",
+        dest="es_spool_dir",
+        default=None,
+        help="Directory to keep documents that failed to post, "
+        "default is inside the pytest cache directory",
+    )
+    group.addoption(
+        "--es-spool-max-bytes",
+        action="store",
+        type=int,
+        dest="es_spool_max_bytes",
+        default=100 * 1024 * 1024,
+        help="Max size of the spool directory, in bytes (0 disables spooling)",
+    )
+    group.addoption(
+        "--es-spool-max-age",
+        action="store",
+        type=float,
+        dest="es_spool_max_age",
+        default=7 * 24,
+        help="Max age of spooled documents before they are dropped, in hours",
+    )
+    group.addoption(
+        "--es-output-file",
+        action="store",
+        dest="es_output_file",
+        default=None,
+        help="Write the documents in `_bulk` format into this file, or into files in this "
+        "directory (if it exists or ends with '/'), instead of posting them",
+    )
+    group.addoption(
+        "--es-output-max-bytes",
+        action="store",
+        type=int,
+        dest="es_output_max_bytes",
+        default=100 * 1024 * 1024,
+        help="Size of an output file before the next one is started, in bytes "
+        "(0 disables rotation)",
+    )
+    group.addoption(
+        "--es-index-mode",
+        action="store",
+        dest="es_index_mode",
+        choices=["index", "daily", "data-stream"],
+        default="index",
+        help="Write into the index named by `es_index_name` ('index'), into an index per day "
+        "named `<es_index_name>-YYYY.MM.DD` ('daily'), or into a data stream ('data-stream')",
+    )
+    group.addoption(
+        "--es-ilm-retention",
+        action="store",
+        type=float,
+        dest="es_ilm_retention",
+        default=None,
+        help="With 'daily' or 'data-stream' index mode, install a lifecycle policy "
+        "deleting the history older than this, in days",
+    )
+    group.addoption(
+        "--es-index-template",
+        action="store_true",
+        dest="es_index_template",
+        default=False,
+        help="Install an index template mapping the documents for reporting and history queries "
+        "(once per cluster), and look up history with exact term queries",
+    )
+
+    parser.addini("es_address", help="Elasticsearch address", default=None)
+    parser.addini("es_username", help="Elasticsearch username", default=None)
+    parser.addini("es_password", help="Elasticsearch password", default=None)
+    parser.addini(
+        "es_api_key", help="Elasticsearch api key in base64 format", default=None
+    )
+    parser.addini(
+        "es_index_name",
+        help="name of the elasticsearch index to save results to",
+        default="test_data",
+    )
+    parser.addini(
+        "es_read_index",
+        help="index, alias or pattern to read the history from, "
+        "default is `es_index_name`, "
+        "or its `<es_index_name>-history` alias with the 'daily' index mode",
+        default=None,
+    )
+    parser.addini(
+        "es_session_fields",
+        type="linelist",
+        help="session context fields still copied into each test document, "
+        "with --es-normalize-session",
+        default=["username", "hostname", "git_branch", "git_commit_sha"],
+    )
+    parser.addini(
+        "es_name_field",
+        help="keyword field holding the test name, used to aggregate history data",
+        default="name.keyword",
+    )
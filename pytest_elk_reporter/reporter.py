@@ -0,0 +1,552 @@
+# -*- coding: utf-8 -*-
+"""
+The reporter posting the results of a test session to Elasticsearch
+"""
+
+import os
+import json
+import time
+import getpass
+import socket
+import datetime
+import logging
+import uuid
+from collections import defaultdict
+
+import pytest
+from _pytest.runner import pytest_runtest_makereport as _makereport
+
+from .context import ContextCollector
+from .failures import FailuresMixin
+from .history import HistoryMixin
+from .indices import IndicesMixin
+from .metrics import ReporterMetrics
+from .shipping import NdjsonFileSink, ShippingMixin
+from .slicing import SlicingMixin
+from .transport import TransportMixin
+
+
+LOGGER = logging.getLogger("elk-reporter")
+
+
+def get_username():
+    try:
+        return getpass.getuser()
+    except ImportError:
+        try:
+            return os.getlogin()
+        except Exception:  # pylint: disable=broad-except
+            # seems like there are case we can't get the name of the user that is currently running
+            LOGGER.warning(
+                "couldn't figure out which user is currently running setting to 'unknown'"
+            )
+            LOGGER.warning(
+                "see https://docs.python.org/3/library/getpass.html#getpass.getuser, "
+                "if you want to configure it correctly"
+            )
+            return "unknown"
+
+
+class ReportRecord(object):  # pylint: disable=too-few-public-methods
+    """
+    The parts of a test report needed to post it
+
+    kept until the test teardown instead of the whole report,
+    with its traceback objects and captured output
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    __slots__ = (
+        "nodeid",
+        "duration",
+        "keywords",
+        "user_properties",
+        "is_subtest",
+        "subtest",
+        "failure_message",
+        "crash",
+    )
+
+    def __init__(self, report):
+        self.nodeid = report.nodeid
+        self.duration = report.duration
+        self.keywords = report.keywords
+        self.user_properties = list(report.user_properties)
+        context = getattr(report, "context", None)
+        self.is_subtest = bool(context)
+        self.subtest = context.msg if context else None
+        if report.longrepr is None:
+            self.failure_message = ""
+        else:
+            self.failure_message = ElkReporter.get_failure_messge(report)
+        crash = getattr(report.longrepr, "reprcrash", None)
+        if crash is not None:
+            # the message of rewritten asserts has the compared values, but no exception type
+            exception_type = getattr(report, "elk_exception_type", None)
+            if exception_type is None:
+                exception_type = crash.message.split(":", 1)[0].split("\n", 1)[0]
+            self.crash = "{}:{}:{}".format(crash.path, crash.lineno, exception_type)
+        else:
+            self.crash = None
+
+
+class ElkRuntestHooks(object):
+    """
+    Per-test hooks of the reporter, registered only once it's active
+    """
+
+    def __init__(self, reporter):
+        self.reporter = reporter
+        self.marker_names = {}
+
+    def pytest_runtest_makereport(self, item, call):
+        report = _makereport(item, call)
+        names = tuple(m.name for m in item.iter_markers())
+        # pytest keeps all the reports, so tests with the same markers share one tuple
+        report.keywords = self.marker_names.setdefault(names, names)
+        if call.excinfo is not None:
+            report.elk_exception_type = call.excinfo.typename
+        if self.reporter.is_slave:
+            self.reporter.attach_worker_data(report)
+        return report
+
+    def pytest_runtest_logreport(self, report):
+        start = time.perf_counter()
+        self.reporter.log_report(report)
+        self.reporter.metrics.observe("logreport", time.perf_counter() - start)
+
+
+class ElkReporter(  # pylint: disable=too-many-instance-attributes
+    TransportMixin,
+    ShippingMixin,
+    FailuresMixin,
+    IndicesMixin,
+    HistoryMixin,
+    SlicingMixin,
+):
+    DEFAULT_HISTORY_SAMPLES = 20
+    # CI context is added only when running on that CI system
+    CI_FLAGS = dict(
+        jenkins=None, circle="CIRCLECI", travis="TRAVIS", github="GITHUB_ACTIONS"
+    )
+
+    def __init__(self, config):
+        # pylint: disable=too-many-statements
+        self.configured = False
+        self.active = False
+        self.session_started = False
+        if config.getoption("es_post_reports") is not None:
+            self.es_post_reports = config.getoption("es_post_reports")
+        else:  # default to True
+            self.es_post_reports = True
+        self.es_address = config.getoption("es_address") or config.getini("es_address")
+        self.es_api_key = config.getoption("es_api_key") or config.getini("es_api_key")
+        self.es_username = config.getoption("es_username") or config.getini(
+            "es_username"
+        )
+        self.es_password = config.getoption("es_password") or config.getini(
+            "es_password"
+        )
+        self.es_index_name = config.getini("es_index_name")
+        self.es_timeout = config.getoption("es_timeout")
+        self.es_connections = config.getoption("es_connections")
+        self.es_max_retries = config.getoption("es_max_retries")
+        self.es_retry_backoff = config.getoption("es_retry_backoff")
+        self.es_transport = config.getoption("es_transport")
+        self.es_max_in_flight = config.getoption("es_max_in_flight")
+        self._session = None
+        self._async_transport = None
+
+        self.es_max_splice_time = config.getoption("es_max_splice_time")
+        self.es_default_test_time = config.getoption("es_default_test_time")
+        self.es_slices_count = config.getoption("es_slices_count")
+        self.es_slices_lookup = config.getoption("es_slices_lookup")
+        self.es_name_field = config.getini("es_name_field")
+        self.es_history_cache_ttl = config.getoption("es_history_cache_ttl")
+        self.es_history_window = config.getoption("es_history_window")
+        self.es_history_samples = config.getoption("es_history_samples")
+        if (
+            self.es_history_samples is not None
+            and not 1 <= self.es_history_samples <= 100
+        ):
+            raise pytest.UsageError("--es-history-samples should be between 1 and 100")
+        self.es_history_half_life = config.getoption("es_history_half_life")
+        if self.es_history_half_life and not self.es_history_samples:
+            # weighting needs the runs themselves, not their percentiles
+            self.es_history_samples = self.DEFAULT_HISTORY_SAMPLES
+        self.es_history_branch = config.getoption("es_history_branch")
+        self.es_offline = config.getoption("es_offline")
+
+        self.es_bulk_max_docs = config.getoption("es_bulk_max_docs")
+        self.es_bulk_max_bytes = config.getoption("es_bulk_max_bytes")
+        self.es_bulk_flush_interval = config.getoption("es_bulk_flush_interval")
+        self.es_flush_timeout = config.getoption("es_flush_timeout")
+        self.es_gzip = config.getoption("es_gzip")
+        self.es_gzip_level = config.getoption("es_gzip_level")
+        self.es_gzip_min_bytes = config.getoption("es_gzip_min_bytes")
+        self.body_bytes = dict(raw_bytes=0, sent_bytes=0)
+        self.metrics = ReporterMetrics()
+        self.es_failure_max_bytes = config.getoption("es_failure_max_bytes")
+        self.seen_failures = set()
+        self.es_normalize_session = config.getoption("es_normalize_session")
+        self.es_session_fields = config.getini("es_session_fields")
+        self.session_id = uuid.uuid4().hex
+        self.session_posted = False
+        self.shipper = None
+        self.spool = None
+        self.es_output_file = config.getoption("es_output_file")
+        self.es_output_max_bytes = config.getoption("es_output_max_bytes")
+        self.output = None
+        self.es_index_mode = config.getoption("es_index_mode")
+        self.es_ilm_retention = config.getoption("es_ilm_retention")
+        if self.es_ilm_retention and self.es_index_mode == "index":
+            raise pytest.UsageError(
+                "--es-ilm-retention needs the 'daily' or 'data-stream' index mode, "
+                "it would delete the whole index"
+            )
+        # time based indices get their mappings, alias and lifecycle from the template
+        self.es_index_template = (
+            config.getoption("es_index_template") or self.es_index_mode != "index"
+        )
+        self._es_read_index = config.getini("es_read_index")
+        self.exact_lookup = False
+
+        self.slices_query_fmt = '(name:"{}") AND (outcome: passed)'
+
+        self.stats = dict.fromkeys(
+            [
+                "error",
+                "passed",
+                "failure",
+                "skipped",
+                "xfailed",
+                "xpass",
+                "passed & error",
+                "failure & error",
+                "skipped & error",
+                "error & error",
+            ],
+            0,
+        )
+        self.session_data = dict()
+        self.context = ContextCollector(getattr(config, "cache", None))
+        self.test_data = defaultdict(dict)
+        self.setup_durations = {}
+        self.reports = defaultdict(list)
+        self.config = config
+        self.is_slave = False
+        self.es_xdist_mode = config.getoption("es_xdist_mode")
+        self.es_xdist_schedule = config.getoption("es_xdist_schedule")
+        self.es_work_queue = config.getoption("es_work_queue")
+        self.es_slices_group = config.getoption("es_slices_group")
+        self.work_queue = None
+        self._sent_session_data = None
+
+    @property
+    def es_address(self):
+        return self._es_address
+
+    @es_address.setter
+    def es_address(self, value):
+        self._es_address = value
+        # configured from code, e.g. in `pytest_plugin_registered` or in a session fixture
+        if self.configured:
+            self.activate()
+
+    @property
+    def es_url(self):
+        if self.es_address.startswith("http"):
+            return "{0.es_address}".format(self)
+        return "http://{0.es_address}".format(self)
+
+    def activate(self):
+        """
+        start reporting, once Elasticsearch is configured
+
+        until then no per-test hooks are registered, and no context is collected
+        """
+        if self.active or not self.es_post_reports:
+            return
+        if not (self.es_address or self.es_output_file):
+            return
+        self.active = True
+        self.config.pluginmanager.register(
+            ElkRuntestHooks(self), "elk-reporter-runtest"
+        )
+        if self.is_slave:
+            # the controller ships with its own context, the worker only passes
+            # on what the tests and fixtures added
+            return
+        self.session_data.setdefault("username", get_username())
+        self.session_data.setdefault("hostname", socket.gethostname())
+        # collect git and CI information while the tests are being collected
+        self.context.start()
+        if self.session_started:
+            # the context fixtures already ran while the reporter was inactive
+            self.add_context("git", *self.CI_FLAGS)
+        if self.es_output_file:
+            suffix = "-" + self.get_worker_id() if self.is_worker else ""
+            self.output = NdjsonFileSink(
+                self.es_output_file, max_bytes=self.es_output_max_bytes, suffix=suffix
+            )
+        else:
+            self.spool = self.make_spool(self.config)
+            self.replay_spool()
+
+    def add_context(self, *names):
+        """
+        append collected git and CI context into the session data
+
+        :param names: `git` or the names of the CI systems in `CI_FLAGS`
+        """
+        if self.is_slave:
+            return
+        for name in names:
+            flag = self.CI_FLAGS.get(name)
+            if flag and os.environ.get(flag, False) != "true":
+                continue
+            self.session_data.update(**self.context.get(name))
+
+    def append_test_data(self, request, test_data):
+        self.test_data[request.node.nodeid].update(**test_data)
+
+    def cache_report(self, report_item, outcome):
+        nodeid = getattr(report_item, "nodeid", report_item)
+        # local hack to handle xdist report order
+        slavenode = getattr(report_item, "node", None)
+        self.reports[nodeid, slavenode].append((ReportRecord(report_item), outcome))
+
+    def get_reports(self, report_item):
+        nodeid = getattr(report_item, "nodeid", report_item)
+        # local hack to handle xdist report order
+        slavenode = getattr(report_item, "node", None)
+        return self.reports.get((nodeid, slavenode), [])
+
+    def pop_reports(self, report_item):
+        """:returns: the cached records of a test, removing them"""
+        nodeid = getattr(report_item, "nodeid", report_item)
+        slavenode = getattr(report_item, "node", None)
+        return self.reports.pop((nodeid, slavenode), [])
+
+    def get_worker_id(self):
+        # based on https://github.com/pytest-dev/pytest-xdist/pull/505
+        # (to support older version of xdist)
+        worker_id = "default"
+        if hasattr(self.config, "workerinput"):
+            worker_id = self.config.workerinput["workerid"]
+        if (
+            not hasattr(self.config, "workerinput")
+            and getattr(self.config.option, "dist", "no") != "no"
+        ):
+            worker_id = "master"
+        return worker_id
+
+    @property
+    def is_worker(self):
+        return hasattr(self.config, "workerinput") or hasattr(self.config, "slaveinput")
+
+    def attach_worker_data(self, report):
+        """
+        attach the data collected on a xdist worker to its reports,
+        so the controller can ship it
+
+        the session data of a worker only holds what its fixtures added,
+        since the controller collects the context itself
+        """
+        if report.when == "teardown":
+            test_data = self.test_data.pop(report.nodeid, None)
+        else:
+            test_data = self.test_data.get(report.nodeid)
+        # serialized, since the report is sent over execnet
+        if test_data:
+            report.elk_test_data = json.dumps(test_data, default=str)
+        if self.session_data != self._sent_session_data:
+            self._sent_session_data = dict(self.session_data)
+            report.elk_session_data = json.dumps(self.session_data, default=str)
+
+    def log_report(self, report):
+        # pylint: disable=too-many-branches
+
+        if self.is_slave:
+            # the xdist controller ships the results
+            return
+        if hasattr(report, "elk_session_data"):
+            # the controller's own fields win, e.g. its session start time
+            for key, value in json.loads(report.elk_session_data).items():
+                self.session_data.setdefault(key, value)
+        if hasattr(report, "elk_test_data"):
+            self.test_data[report.nodeid].update(json.loads(report.elk_test_data))
+
+        if report.passed:
+            if report.when == "setup":
+                # it's where the setup of module or class fixtures shows, for grouping slices
+                self.setup_durations[report.nodeid] = report.duration
+            elif report.when == "call":
+                if hasattr(report, "wasxfail"):
+                    self.cache_report(report, "xpass")
+                else:
+                    self.cache_report(report, "passed")
+        elif report.failed:
+            if report.when == "call":
+                self.cache_report(report, "failure")
+            elif report.when == "setup":
+                self.cache_report(report, "error")
+        elif report.skipped:
+            if hasattr(report, "wasxfail"):
+                self.cache_report(report, "xfailed")
+            else:
+                self.cache_report(report, "skipped")
+
+        if report.when == "teardown":
+            # the test is done, so drop everything kept for it
+            old_reports = self.pop_reports(report)
+            # in xdist, report only on the controller or only on worker nodes
+            if self.es_xdist_mode == "controller" or self.get_worker_id() != "master":
+                record = ReportRecord(report)
+                for old_report in old_reports:
+                    if report.passed and old_report:
+                        self.report_test(old_report[0], old_report[1])
+                    if report.failed and old_report:
+                        self.report_test(
+                            record, old_report[1] + " & error", old_report=old_report[0]
+                        )
+                    if report.skipped:
+                        self.report_test(record, "skipped")
+            self.test_data.pop(report.nodeid, None)
+            self.setup_durations.pop(report.nodeid, None)
+
+    def get_test_session_data(self):
+        """
+        :returns: the session context to put into each test document
+        """
+        if not self.es_normalize_session:
+            return dict(self.session_data, session_id=self.session_id)
+        if not self.session_posted:
+            # session fixtures already ran, so the context is complete
+            self.session_posted = True
+            self.post_to_elasticsearch(
+                dict(
+                    session_context=True,
+                    timestamp=datetime.datetime.now(
+                        tz=datetime.timezone.utc
+                    ).isoformat(),
+                    session_id=self.session_id,
+                    **self.session_data,
+                )
+            )
+        return dict(
+            {
+                key: self.session_data[key]
+                for key in self.es_session_fields
+                if key in self.session_data
+            },
+            session_id=self.session_id,
+        )
+
+    def report_test(self, item_report, outcome, old_report=None):
+        """
+        :param item_report: `ReportRecord` of the test
+        :param outcome: the outcome to post
+        :param old_report: `ReportRecord` of an earlier phase, when the teardown failed
+        """
+        self.stats[outcome] += 1
+        test_data = dict(
+            item_report.user_properties,
+            timestamp=datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+            name=item_report.nodeid,
+            outcome=outcome,
+            duration=item_report.duration,
+            markers=item_report.keywords,
+            **self.get_test_session_data(),
+        )
+        if item_report.is_subtest:
+            test_data.update(subtest=item_report.subtest)
+        setup_duration = self.setup_durations.get(item_report.nodeid)
+        if setup_duration is not None:
+            test_data.update(setup_duration=setup_duration)
+        test_data.update(self.test_data.pop(item_report.nodeid, {}))
+
+        message = item_report.failure_message
+        if old_report:
+            message += old_report.failure_message
+        if message:
+            failed_reports = (item_report, old_report) if old_report else (item_report,)
+            test_data.update(self.get_failure_data(message, *failed_reports))
+        self.post_to_elasticsearch(test_data)
+
+    def pytest_sessionstart(self):
+        self.session_started = True
+        if self.is_slave:
+            return
+        self.session_data["session_start_time"] = datetime.datetime.utcnow().isoformat()
+
+    def pytest_sessionfinish(self):
+        # flushing and closing the shipper share the same `--es-flush-timeout`
+        deadline = time.monotonic() + self.es_flush_timeout
+        if self.active and not self.config.getoption("collectonly"):
+            test_data = dict(
+                summery=True,
+                stats=self.stats,
+                session_id=self.session_id,
+                **self.session_data,
+            )
+            if self.shipper:
+                self.shipper.flush(timeout=max(0.0, deadline - time.monotonic()))
+                test_data.update(shipping=dict(self.shipper.stats, **self.body_bytes))
+            if self.output:
+                test_data.update(output=dict(self.output.stats))
+            test_data.update(
+                reporter_metrics=dict(self.metrics.as_dict(), **self.body_bytes)
+            )
+            self.post_to_elasticsearch(test_data)
+        self.close_shipper(deadline)
+        if self.output:
+            self.output.flush()
+
+    def pytest_terminal_summary(self, terminalreporter):
+        verbose = terminalreporter.config.getvalue("verbose")
+
+        if verbose >= 1 and (self.active or self.metrics.timers):
+            self.write_metrics(terminalreporter)
+        if self.work_queue:
+            terminalreporter.write_sep(
+                "-",
+                "pulled {chunks} chunks, {tests} tests from [{path}]".format(
+                    path=self.work_queue.path, **self.work_queue.stats
+                ),
+            )
+        if self.config.getoption("collectonly") or verbose >= 2:
+            return
+        if self.output:
+            terminalreporter.write_sep(
+                "-",
+                "stats written to [%s]: %s"
+                % (", ".join(self.output.filenames), self.stats),
+            )
+        elif self.es_address:
+            terminalreporter.write_sep(
+                "-",
+                "stats posted to elasticsearch [%s]: %s"
+                % (self.es_address, self.stats),
+            )
+
+    def write_metrics(self, terminalreporter):
+        terminalreporter.write_sep("-", "elk-reporter metrics")
+        metrics = dict(self.metrics.as_dict(), **self.body_bytes)
+        for name, value in sorted(metrics.items()):
+            if isinstance(value, dict):
+                value = (
+                    "{count} calls, {failures} failed, total {total_ms:.1f}ms, "
+                    "p50 {p50_ms:.1f}ms, p95 {p95_ms:.1f}ms, p99 {p99_ms:.1f}ms, "
+                    "max {max_ms:.1f}ms"
+                ).format(**value)
+            terminalreporter.write_line("{}: {}".format(name, value))
+
+    def pytest_internalerror(self, excrepr):
+        test_data = dict(
+            timestamp=datetime.datetime.utcnow().isoformat(),
+            outcome="internal-error",
+            faiure_message=str(excrepr),
+            **self.session_data,
+        )
+        self.post_to_elasticsearch(test_data)
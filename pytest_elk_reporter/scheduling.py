@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Ordering the tests of an xdist session by their duration
+"""
+
+import time
+import logging
+import threading
+
+
+LOGGER = logging.getLogger("elk-reporter")
+
+
+class DurationCache(object):
+    """
+    Local cache of tests duration history, kept in the pytest cache
+
+    entries are stored as `{test_id: [duration, timestamp, setup_duration]}`,
+    and are considered stale after `ttl` seconds
+    """
+
+    MAX_AGE = 30 * 24 * 3600
+
+    def __init__(self, cache, key, ttl):
+        self.cache = cache
+        self.key = key
+        self.ttl = ttl
+        self.entries = cache.get(key, {})
+
+    def lookup(self, test_ids, offline=False):
+        """
+        :param test_ids: the names of the test to lookup
+        :param offline: if True, stale entries are used too
+
+        :returns: tuple of found durations list, and list of missing or stale test ids
+        """
+        now = time.time()
+        found, missing = [], []
+        for test_id in test_ids:
+            entry = self.entries.get(test_id)
+            if entry and (offline or now - entry[1] < self.ttl):
+                found.append(
+                    dict(
+                        test_name=test_id,
+                        duration=entry[0],
+                        setup_duration=entry[2] if len(entry) > 2 else None,
+                    )
+                )
+            else:
+                missing.append(test_id)
+        return found, missing
+
+    def update(self, test_durations):
+        now = time.time()
+        for test in test_durations:
+            # tests without history aren't cached, so they would be looked up next time
+            if test["duration"]:
+                self.entries[test["test_name"]] = [
+                    test["duration"],
+                    now,
+                    test.get("setup_duration"),
+                ]
+        self.entries = {
+            test_id: entry
+            for test_id, entry in self.entries.items()
+            if now - entry[1] < self.MAX_AGE
+        }
+        self.cache.set(self.key, self.entries)
+
+
+class LongestFirstScheduling(object):
+    """
+    pytest-xdist scheduling sending the longest tests first, according to their duration history
+
+    each node gets one test at a time while they are long, and then chunks of shorter tests,
+    sized to a fraction of the remaining work, so all the nodes finish at about the same time
+
+    mixed into xdist's `LoadScheduling` by `create()`, since xdist is an optional dependency
+    """
+
+    # nodes, pending, log... are members of `LoadScheduling`, which pylint can't see here
+    # pylint: disable=no-member
+
+    # a worker runs a test only once it got the next one
+    MIN_PENDING = 2
+    # chunks are sized so each node would still get at least this many of them
+    CHUNKS_PER_NODE = 4
+
+    @classmethod
+    def create(cls, reporter, config, log):
+        from xdist.scheduler import (  # pylint: disable=import-outside-toplevel
+            LoadScheduling,
+        )
+
+        scheduling_class = type("LongestFirstLoadScheduling", (cls, LoadScheduling), {})
+        return scheduling_class(reporter, config, log)
+
+    def __init__(self, reporter, config, log=None):
+        super().__init__(config, log)
+        self.reporter = reporter
+        # the collection of all the nodes, once it's scheduled
+        self.collection = None
+        self.durations = None
+        self.remaining_duration = 0.0
+        self.history = None
+
+    def fetch_durations(self, collection):
+        reporter = self.reporter
+        if not (reporter.es_address or reporter.es_offline):
+            return
+        try:
+            test_ids = [nodeid.replace("::()", "") for nodeid in collection]
+            history = reporter.fetch_test_duration(
+                test_ids, default_time_sec=reporter.es_default_test_time
+            )
+            durations = {test["test_name"]: test["duration"] for test in history}
+            self.durations = [
+                durations.get(test_id, reporter.es_default_test_time)
+                for test_id in test_ids
+            ]
+        except Exception as ex:  # pylint: disable=broad-except
+            LOGGER.warning("Failed to fetch history data: [%s]", str(ex))
+
+    def add_node_collection(self, node, collection):
+        super().add_node_collection(node, collection)
+        if self.history is None:
+            # look up the history while the other nodes are still collecting
+            self.history = threading.Thread(
+                target=self.fetch_durations,
+                args=(list(collection),),
+                name="elk-reporter-history",
+                daemon=True,
+            )
+            self.history.start()
+
+    def schedule(self):
+        assert self.collection_is_completed
+        if self.collection is not None:
+            for node in self.nodes:
+                self.check_schedule(node)
+            return
+        if not self._check_nodes_have_same_collection():
+            self.log("**Different tests collected, aborting run**")
+            return
+        self.collection = next(iter(self.node2collection.values()))
+        self.history.join()
+        if self.durations is None or len(self.durations) != len(self.collection):
+            # without history, it's plain load scheduling in collection order
+            self.durations = [1.0] * len(self.collection)
+        durations = self.durations
+        # sort is stable, so tests of the same duration keep their collection order
+        self.pending[:] = sorted(
+            range(len(self.collection)), key=lambda index: -durations[index]
+        )
+        self.remaining_duration = sum(durations)
+        if not self.collection:
+            return
+        # deal the longest tests one by one, so they start on different nodes
+        for _ in range(self.MIN_PENDING):
+            for node in self.nodes:
+                self._send_tests(node, 1)
+        if not self.pending:
+            for node in self.nodes:
+                node.shutdown()
+
+    def check_schedule(self, node, duration=0):
+        # pylint: disable=unused-argument
+        # `duration` is part of xdist's signature, chunks are sized from the history instead
+        if node.shutting_down:
+            return
+        if not self.pending:
+            node.shutdown()
+            return
+        missing = self.MIN_PENDING - len(self.node2pending[node])
+        if missing > 0:
+            self._send_tests(node, self.chunk_size(missing))
+
+    def chunk_size(self, minimum):
+        """
+        :param minimum: number of tests the node needs to keep running
+
+        :returns: number of pending tests to send to a node, at least `minimum`
+        """
+        budget = self.remaining_duration / (len(self.nodes) * self.CHUNKS_PER_NODE)
+        count, total = 0, 0.0
+        for index in self.pending:
+            if count >= minimum and total + self.durations[index] > budget:
+                break
+            count += 1
+            total += self.durations[index]
+        return count
+
+    def _send_tests(self, node, num):
+        sent = sum(self.durations[index] for index in self.pending[:num])
+        self.remaining_duration = max(self.remaining_duration - sent, 0.0)
+        super()._send_tests(node, num)
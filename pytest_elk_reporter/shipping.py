@@ -0,0 +1,526 @@
+# -*- coding: utf-8 -*-
+"""
+Writing the reports out: the background `_bulk` shipper, its spool and the ndjson files
+"""
+
+import os
+import json
+import time
+import queue
+import datetime
+import logging
+import threading
+import uuid
+import shutil
+import fnmatch
+
+
+LOGGER = logging.getLogger("elk-reporter")
+
+
+def split_bulk_items(entries, result):
+    """
+    :param entries: what was sent, one entry per document
+    :param result: the json response of the `_bulk` request
+    :returns: tuple of the entries rejected with 429, the number of indexed documents
+              and the number of failed ones
+    """
+    throttled = []
+    indexed = errors = 0
+    for entry, item in zip(entries, result.get("items", [])):
+        status = next(iter(item.values()), {})
+        if status.get("status") == 429:
+            throttled.append(entry)
+        elif status.get("error"):
+            LOGGER.warning("Failed to index document: [%s]", status["error"])
+            errors += 1
+        else:
+            indexed += 1
+    return throttled, indexed, errors
+
+
+class ReportSpool(object):
+    """
+    Append-only local spool of documents that couldn't be sent to Elasticsearch
+
+    each session writes its own file, in `_bulk` format, so leftover files
+    can be replayed as is at the next session
+    """
+
+    def __init__(self, spool_dir, max_bytes=100 * 1024 * 1024, max_age=7 * 24 * 3600):
+        self.spool_dir = spool_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.filename = os.path.join(
+            spool_dir,
+            "spool-{}-{}-{}.ndjson".format(
+                time.strftime("%Y%m%d%H%M%S"), os.getpid(), uuid.uuid4().hex[:8]
+            ),
+        )
+        self._file = None
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _spool_size(self):
+        total = 0
+        for filename in os.listdir(self.spool_dir):
+            try:
+                total += os.path.getsize(os.path.join(self.spool_dir, filename))
+            except OSError:
+                pass
+        return total
+
+    def write(self, action, lines):
+        """
+        append documents to this session spool file, and fsync them
+
+        :param action: the `_bulk` action line of the documents
+        :param lines: list of json serialized documents
+
+        :returns: True if the documents were spooled
+        """
+        data = "".join(action + "\n" + line + "\n" for line in lines).encode("utf-8")
+        with self._lock:
+            try:
+                if self._size is None:
+                    os.makedirs(self.spool_dir, exist_ok=True)
+                    self._size = self._spool_size()
+                if self._size + len(data) > self.max_bytes:
+                    LOGGER.warning(
+                        "spool [%s] is full, dropping %d documents",
+                        self.spool_dir,
+                        len(lines),
+                    )
+                    return False
+                if self._file is None:
+                    self._file = open(self.filename, "ab")
+                self._file.write(data)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._size += len(data)
+                return True
+            except OSError as ex:
+                LOGGER.warning("Failed to write to spool: [%s]", str(ex))
+                return False
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def claim_leftovers(self):
+        """
+        claim spool files left by previous sessions, removing expired ones
+
+        :returns: list of claimed files, renamed so no other session replays them
+        """
+        claimed = []
+        if not os.path.isdir(self.spool_dir):
+            return claimed
+        now = time.time()
+        for filename in sorted(os.listdir(self.spool_dir)):
+            path = os.path.join(self.spool_dir, filename)
+            if not fnmatch.fnmatch(filename, "spool-*"):
+                continue
+            try:
+                created = time.mktime(
+                    time.strptime(filename.split("-")[1], "%Y%m%d%H%M%S")
+                )
+                if now - created > self.max_age:
+                    LOGGER.warning("removing expired spool file [%s]", path)
+                    os.remove(path)
+                    continue
+                # `.replay` files are claimed by a running session, unless stale
+                if filename.endswith(".ndjson") or (
+                    filename.endswith(".replay") and now - os.path.getmtime(path) > 3600
+                ):
+                    claimed_path = os.path.splitext(path)[0] + ".replay"
+                    os.rename(path, claimed_path)
+                    os.utime(claimed_path)
+                    claimed.append(claimed_path)
+            except (OSError, ValueError, IndexError):
+                # some other session got it first, or it isn't ours
+                continue
+        return claimed
+
+    @staticmethod
+    def release(path, lines, rest):
+        """
+        return the unsent part of a claimed file to the spool, so the next session can retry it
+
+        :param path: the claimed file
+        :param lines: lines read from the claimed file and not sent yet
+        :param rest: the claimed file object, positioned after `lines`
+        """
+        base = os.path.splitext(path)[0]
+        try:
+            with open(base + ".tmp", "wb") as spool_file:
+                spool_file.writelines(lines)
+                shutil.copyfileobj(rest, spool_file)
+            os.replace(base + ".tmp", base + ".ndjson")
+            os.remove(path)
+        except OSError as ex:
+            LOGGER.warning("Failed to release spool file: [%s]", str(ex))
+
+
+class NdjsonFileSink(object):  # pylint: disable=too-many-instance-attributes
+    """
+    Buffered writer of documents into local files in `_bulk` format,
+    so they can be ingested into Elasticsearch out of band
+
+    :param path: file to write, or directory to create the files in
+    :param max_bytes: size of a file before the next one is started, 0 disables rotation
+    :param suffix: added to the file names, to separate processes writing to the same path
+    """
+
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, path, max_bytes=100 * 1024 * 1024, suffix=""):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.is_dir = os.path.isdir(path) or path.endswith(("/", os.sep))
+        self.filenames = []
+        self.stats = dict(documents=0, bytes=0, files=0)
+        self._file = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def next_filename(self):
+        index = len(self.filenames)
+        if self.is_dir:
+            return os.path.join(
+                self.path,
+                "pytest-elk-{}-{}{}-{:03d}.ndjson".format(
+                    time.strftime("%Y%m%d%H%M%S"), os.getpid(), self.suffix, index
+                ),
+            )
+        root, ext = os.path.splitext(self.path)
+        root += self.suffix
+        if index:
+            root = "{}.{}".format(root, index)
+        return root + ext
+
+    def _open_next(self):
+        if self._file:
+            self._file.close()
+        filename = self.next_filename()
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self._file = open(filename, "wb", buffering=self.BUFFER_SIZE)
+        self._size = 0
+        self.filenames.append(filename)
+        self.stats["files"] += 1
+
+    def write(self, action, document):
+        """
+        :param action: the `_bulk` action line of the document
+        :param document: dict to serialize
+
+        :returns: True if the document was written
+        """
+        data = "{}\n{}\n".format(action, json.dumps(document, default=str)).encode(
+            "utf-8"
+        )
+        with self._lock:
+            try:
+                rotate = self.max_bytes and self._size + len(data) > self.max_bytes
+                if self._file is None or (rotate and self._size):
+                    self._open_next()
+                self._file.write(data)
+            except OSError as ex:
+                LOGGER.warning("Failed to write to [%s]: [%s]", self.path, str(ex))
+                return False
+            self._size += len(data)
+            self.stats["documents"] += 1
+            self.stats["bytes"] += len(data)
+            return True
+
+    def flush(self):
+        with self._lock:
+            if self._file:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+
+class BulkShipper(object):  # pylint: disable=too-many-instance-attributes
+    """
+    Ship documents to Elasticsearch `_bulk` api from a background thread
+
+    documents are queued by `put()`, and sent as NDJSON bulk requests
+    when `max_docs`, `max_bytes` or `flush_interval` is reached,
+    documents that couldn't be sent are written into `spool` if given
+    """
+
+    _STOP = object()
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        reporter,
+        max_docs=500,
+        max_bytes=5 * 1024 * 1024,
+        flush_interval=1.0,
+        spool=None,
+    ):
+        self.reporter = reporter
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.spool = spool
+        self.stats = dict(
+            documents=0, errors=0, failed_requests=0, spooled=0, replayed=0
+        )
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name="elk-reporter-shipper", daemon=True
+        )
+        self._thread.start()
+
+    def put(self, document):
+        self._queue.put(document)
+        self.reporter.metrics.gauge("queue_depth_max", self._queue.qsize())
+
+    def replay(self, path):
+        """queue a spool file from a previous session to be sent"""
+        self._queue.put(path)
+
+    def flush(self, timeout=None):
+        """
+        wait until all documents queued so far were sent
+
+        :returns: True if all documents were sent before the timeout
+        """
+        flushed = threading.Event()
+        self._queue.put(flushed)
+        return flushed.wait(timeout)
+
+    def close(self, timeout=None):
+        self._queue.put(self._STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            LOGGER.warning(
+                "elasticsearch shipper didn't finish in %s seconds, "
+                "some documents might be lost",
+                timeout,
+            )
+            self._spool_pending()
+        if self.spool:
+            self.spool.close()
+
+    def _spool_pending(self):
+        lines = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, dict):
+                lines.append(json.dumps(item, default=str))
+        if lines:
+            self._spool(lines, self.reporter.bulk_action())
+
+    def _spool(self, lines, action):
+        if self.spool and self.spool.write(action, lines):
+            self.stats["spooled"] += len(lines)
+        else:
+            self.stats["errors"] += len(lines)
+
+    def _run(self):
+        if self.reporter.es_index_template:
+            # before the first document creates the index
+            self.reporter.ensure_index_template()
+        lines, size, deadline, action = [], 0, None, None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, dict):
+                try:
+                    line = json.dumps(item, default=str)
+                except (TypeError, ValueError) as ex:
+                    LOGGER.warning("Failed to serialize document: [%s]", str(ex))
+                    self.stats["errors"] += 1
+                    continue
+                if deadline is None:
+                    # e.g. the index of the day, the same for the whole request
+                    action = self.reporter.bulk_action()
+                    deadline = time.monotonic() + self.flush_interval
+                lines.append(line)
+                size += len(action) + len(line) + 2
+                if (
+                    len(lines) < self.max_docs
+                    and size < self.max_bytes
+                    and time.monotonic() < deadline
+                ):
+                    continue
+
+            if lines:
+                self._send(lines, action)
+            lines, size, deadline = [], 0, None
+
+            if isinstance(item, threading.Event):
+                item.set()
+            elif isinstance(item, str):
+                try:
+                    self._replay(item)
+                except OSError as ex:
+                    # e.g. removed by a concurrent session, keep shipping this one
+                    LOGGER.warning("Failed to replay [%s]: [%s]", item, str(ex))
+            elif item is self._STOP:
+                return
+
+    def _post(self, pairs):
+        """
+        send the `_bulk` action and document `pairs`, retrying the documents
+        rejected with 429 by Elasticsearch, like `BulkUploader.send_chunk`
+
+        :returns: tuple of the number of indexed documents, of failed ones,
+                  and the indexes in `pairs` of the documents that weren't sent
+        """
+        reporter = self.reporter
+        pending = list(range(len(pairs)))
+        indexed = errors = attempt = 0
+        while pending:
+            try:
+                res = reporter.bulk_to_elasticsearch(
+                    "".join(pairs[index] for index in pending)
+                )
+                res.raise_for_status()
+            except Exception as ex:  # pylint: disable=broad-except
+                LOGGER.warning("Failed to POST to elasticsearch: [%s]", str(ex))
+                self.stats["failed_requests"] += 1
+                break
+            try:
+                result = res.json()
+            except ValueError:
+                result = None
+            if not isinstance(result, dict) or not result.get("errors"):
+                indexed += len(pending)
+                pending = []
+                break
+            pending, done, failed = split_bulk_items(pending, result)
+            indexed += done
+            errors += failed
+            if pending and attempt >= reporter.es_max_retries:
+                LOGGER.warning("%d documents still rejected with 429", len(pending))
+                break
+            if pending:
+                time.sleep(reporter.retry_delay(res, attempt))
+            attempt += 1
+        return indexed, errors, pending
+
+    def _send(self, lines, action):
+        indexed, errors, unsent = self._post(
+            [action + "\n" + line + "\n" for line in lines]
+        )
+        self.stats["documents"] += indexed
+        self.stats["errors"] += errors
+        if unsent:
+            self._spool([lines[index] for index in unsent], action)
+
+    def _replay(self, path):
+        with open(path, "rb") as spool_file:
+            chunk = []
+            for line in spool_file:
+                chunk.append(line)
+                if len(chunk) >= 2 * self.max_docs:
+                    unsent = self._replay_chunk(chunk)
+                    if unsent:
+                        ReportSpool.release(path, unsent, spool_file)
+                        return
+                    chunk = []
+            unsent = self._replay_chunk(chunk) if chunk else None
+            if unsent:
+                ReportSpool.release(path, unsent, spool_file)
+                return
+        os.remove(path)
+
+    def _replay_chunk(self, chunk):
+        """
+        :returns: the lines of the documents that weren't sent, to be kept in the spool
+        """
+        pairs = [
+            b"".join(chunk[index : index + 2]).decode("utf-8")
+            for index in range(0, len(chunk), 2)
+        ]
+        indexed, errors, unsent = self._post(pairs)
+        self.stats["replayed"] += indexed
+        self.stats["errors"] += errors
+        return [line for index in unsent for line in chunk[2 * index : 2 * index + 2]]
+
+
+class ShippingMixin(object):
+    """
+    Posting the documents of a session, part of `ElkReporter`
+    """
+
+    @staticmethod
+    def make_spool(config):
+        max_bytes = config.getoption("es_spool_max_bytes")
+        spool_dir = config.getoption("es_spool_dir")
+        if not spool_dir and getattr(config, "cache", None) is not None:
+            spool_dir = str(config.cache.mkdir("elk-reporter-spool"))
+        if not spool_dir or max_bytes <= 0:
+            return None
+        return ReportSpool(
+            spool_dir,
+            max_bytes=max_bytes,
+            max_age=config.getoption("es_spool_max_age") * 3600,
+        )
+
+    def get_shipper(self):
+        if self.shipper is None:
+            self.shipper = BulkShipper(
+                self,
+                max_docs=self.es_bulk_max_docs,
+                max_bytes=self.es_bulk_max_bytes,
+                flush_interval=self.es_bulk_flush_interval,
+                spool=self.spool,
+            )
+        return self.shipper
+
+    def replay_spool(self):
+        if (
+            self.spool
+            and self.es_address
+            and self.es_post_reports
+            and not self.is_slave
+        ):
+            for path in self.spool.claim_leftovers():
+                self.get_shipper().replay(path)
+
+    def post_to_elasticsearch(self, test_data):
+        if not self.es_post_reports or self.is_slave:
+            return
+        if self.es_index_mode == "data-stream":
+            test_data.setdefault(
+                "@timestamp",
+                test_data.get("timestamp")
+                or datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+            )
+        if self.output:
+            self.output.write(self.bulk_action(), test_data)
+        elif self.es_address:
+            self.get_shipper().put(test_data)
+
+    def close_shipper(self, deadline=None):
+        """
+        :param deadline: `time.monotonic()` by which the shipper should be done,
+                         default to `--es-flush-timeout` from now
+        """
+        if self.shipper:
+            if deadline is None:
+                timeout = self.es_flush_timeout
+            else:
+                timeout = max(0.0, deadline - time.monotonic())
+            self.shipper.close(timeout=timeout)
+            self.shipper = None
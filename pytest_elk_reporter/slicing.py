@@ -0,0 +1,523 @@
+# -*- coding: utf-8 -*-
+"""
+Splitting the tests of a session between agents, by their past durations
+"""
+
+import os
+import datetime
+import logging
+import heapq
+import bisect
+import math
+from collections import defaultdict, deque
+import fnmatch
+
+import pytest
+
+from .scheduling import LongestFirstScheduling
+from .work_queue import WorkQueue
+
+
+LOGGER = logging.getLogger("elk-reporter")
+
+
+class SlicingMixin(object):
+    """
+    Slicing the tests and feeding the work queue, part of `ElkReporter`
+    """
+
+    @staticmethod
+    def clear_old_exclude_files(outputdir):
+        print("clear old exclude files")
+        # Get a list of all files in directory
+        for root_dir, _, filenames in os.walk(outputdir):
+            # Find the files that matches the given pattern
+            for filename in fnmatch.filter(filenames, "include_*.txt"):
+                try:
+                    os.remove(os.path.join(root_dir, filename))
+                except OSError:
+                    print("Error while deleting file {}".format(filename))
+
+    @staticmethod
+    def split_files_test_list(outputdir, slices):
+        for i, current_slice in enumerate(slices):
+            print(
+                "{}: {} ".format(i, datetime.timedelta(0, current_slice["total"]))
+                + "- {} - {}".format(
+                    len(current_slice["tests"]), current_slice["tests"]
+                )
+            )
+            include_filename = os.path.join(outputdir, "include_%03d.txt" % i)
+
+            with open(include_filename, "w") as slice_file:
+                for case in current_slice["tests"]:
+                    slice_file.write(case + "\n")
+
+    AFFINITY_SCOPES = ("class", "module", "package")
+
+    @classmethod
+    def get_affinity_key(cls, item, level):
+        """
+        the group of a test, for keeping the tests sharing fixtures in the same slice
+
+        :param item: the collected test
+        :param level: widest fixture scope to group by, `class`, `module` or `package`
+
+        :returns: the nodeid of the class, the path of the module or of the package,
+                  of the widest fixture scope up to `level` that the test uses, or the test name
+        """
+        test_name = item.nodeid.replace("::()", "")
+        fixtureinfo = getattr(item, "_fixtureinfo", None)
+        if fixtureinfo is None:
+            return test_name
+        scopes = cls.AFFINITY_SCOPES[: cls.AFFINITY_SCOPES.index(level) + 1]
+        used = set()
+        for fixturedefs in fixtureinfo.name2fixturedefs.values():
+            if fixturedefs:
+                used.add(str(fixturedefs[-1].scope))
+        for scope in reversed(scopes):
+            if scope in used:
+                break
+        else:
+            return test_name
+        if scope == "class":
+            return test_name.rsplit("::", 1)[0]
+        module_path = test_name.split("::")[0]
+        if scope == "module":
+            return module_path
+        return os.path.dirname(module_path) or "."
+
+    @staticmethod
+    def make_test_groups(test_data, groups, max_group_duration=None):
+        """
+        merge the tests of each group into a unit, which pays the setup of the group once
+
+        a group longer than `max_group_duration` is split into parts, in collection order,
+        each paying the setup again
+
+        :param test_data: list of dicts with `test_name`, `duration` and `setup_duration`
+        :param groups: map from group key to the names of its tests, in collection order
+        :param max_group_duration: max duration of each part, in seconds
+
+        :returns: list of dicts with `test_name` of the unit, `duration` and `tests` names
+        """
+        by_name = {test["test_name"]: test for test in test_data}
+        units = []
+        for key, test_names in groups.items():
+            tests = [
+                by_name[test_name] for test_name in test_names if test_name in by_name
+            ]
+            if not tests:
+                continue
+            # the shared setup shows in the first test to run, and may come first in any part
+            setup = max(float(test.get("setup_duration") or 0.0) for test in tests)
+            parts = []
+            for test in tests:
+                duration = float(test["duration"])
+                if not parts or (
+                    max_group_duration
+                    and parts[-1]["duration"] + duration > max_group_duration
+                ):
+                    parts.append(
+                        dict(
+                            test_name="{}#{}".format(key, len(parts)),
+                            duration=setup,
+                            tests=[],
+                        )
+                    )
+                parts[-1]["duration"] += duration
+                parts[-1]["tests"].append(test["test_name"])
+            if len(parts) == 1:
+                parts[0]["test_name"] = key
+            units += parts
+        return units
+
+    @staticmethod
+    def expand_test_groups(slices, units):
+        """
+        replace the units made by `make_test_groups` with their tests, keeping each unit together
+
+        :returns: `slices`, updated
+        """
+        tests = {unit["test_name"]: unit["tests"] for unit in units}
+        for current_slice in slices:
+            current_slice["tests"] = [
+                test_name
+                for unit_name in current_slice["tests"]
+                for test_name in tests[unit_name]
+            ]
+        return slices
+
+    @staticmethod
+    def make_work_chunks(test_data, agents, chunks_per_agent=4, min_chunk_time=1.0):
+        """
+        split tests into chunks pulled by agents from a work queue, longest tests first
+
+        each chunk holds a fraction of the remaining work, so they get smaller towards the end
+        of the queue, and the agents finish at about the same time
+
+        :param test_data: list of dicts with `test_name` and `duration`
+        :param agents: number of agents expected to pull from the queue
+        :param chunks_per_agent: how many chunks each agent would get, out of the remaining work
+        :param min_chunk_time: chunks shorter than this get more tests, in seconds
+
+        :returns: list of dicts with `total` and `tests`, in the order they should be pulled
+        """
+        tests = sorted(test_data, key=lambda test: -test["duration"])
+        remaining = sum(test["duration"] for test in tests)
+        chunks = []
+        index = 0
+        while index < len(tests):
+            budget = max(remaining / (agents * chunks_per_agent), min_chunk_time)
+            chunk = dict(total=0.0, tests=[])
+            while index < len(tests) and (
+                not chunk["tests"]
+                or chunk["total"] + tests[index]["duration"] <= budget
+            ):
+                chunk["tests"].append(tests[index]["test_name"])
+                chunk["total"] += tests[index]["duration"]
+                index += 1
+            remaining -= chunk["total"]
+            chunks.append(chunk)
+        return chunks
+
+    @staticmethod
+    def make_test_slices(test_data, max_slice_duration):
+        """
+        pack tests into slices no longer than `max_slice_duration`
+
+        uses longest-processing-time first: tests are sorted from the longest,
+        and each goes into the least loaded slice, kept in a heap, starting
+        with the minimal number of slices needed, and opening a new one
+        only when a test doesn't fit in any of them.
+        tests longer than `max_slice_duration` get a slice of their own
+
+        :param test_data: list of dicts with `test_name` and `duration`
+        :param max_slice_duration: max duration of each slice, in seconds
+
+        :returns: list of slices dicts, with `total` duration and `tests` names
+        """
+        tests = sorted(
+            ((float(test["duration"]), test["test_name"]) for test in test_data),
+            key=lambda test: (-test[0], test[1]),
+        )
+        # tests longer than a slice get a slice of their own
+        slices = [
+            dict(total=duration, tests=[test_name])
+            for duration, test_name in tests
+            if duration > max_slice_duration
+        ]
+        tests = tests[len(slices) :]
+        total = sum(duration for duration, _ in tests)
+        heap = []
+        for _ in range(int(math.ceil(total / max_slice_duration))):
+            heap.append((0.0, len(slices)))
+            slices.append(dict(total=0.0, tests=[]))
+        for duration, test_name in tests:
+            if heap and heap[0][0] + duration <= max_slice_duration:
+                _, index = heapq.heappop(heap)
+            else:
+                index = len(slices)
+                slices.append(dict(total=0.0, tests=[]))
+            current_slice = slices[index]
+            current_slice["total"] += duration
+            current_slice["tests"].append(test_name)
+            heapq.heappush(heap, (current_slice["total"], index))
+        return [current_slice for current_slice in slices if current_slice["tests"]]
+
+    @staticmethod
+    def make_fixed_test_slices(test_data, slices_count, max_iterations=10000):
+        """
+        pack tests into exactly `slices_count` slices, minimizing the longest one
+
+        starts with longest-processing-time first packing, and then refines it
+        by moving a test, or swapping a pair of tests, between the longest and
+        the shortest slices, as long as it makes the longer of the two shorter
+
+        :param test_data: list of dicts with `test_name` and `duration`
+        :param slices_count: number of slices to make
+        :param max_iterations: max number of refinement steps
+
+        :returns: list of slices dicts, with `total` duration and `tests` names
+        """
+        tests = sorted(
+            ((float(test["duration"]), test["test_name"]) for test in test_data),
+            key=lambda test: (-test[0], test[1]),
+        )
+        bins, totals = SlicingMixin.pack_longest_first(tests, slices_count)
+
+        for _ in range(max_iterations):
+            longest = max(range(slices_count), key=lambda i: (totals[i], -i))
+            shortest = min(range(slices_count), key=lambda i: (totals[i], i))
+            gap = totals[longest] - totals[shortest]
+            best = SlicingMixin.best_slices_exchange(bins[longest], bins[shortest], gap)
+            if best is None:
+                break
+            delta, position, other = best
+            bins[shortest].append(bins[longest].pop(position))
+            if other:
+                bins[shortest].remove(other)
+                bins[longest].append(other)
+            totals[longest] -= delta
+            totals[shortest] += delta
+
+        return [
+            dict(
+                total=sum(duration for duration, _ in current_bin),
+                tests=[
+                    test_name
+                    for _, test_name in sorted(current_bin, key=lambda t: (-t[0], t[1]))
+                ],
+            )
+            for current_bin in bins
+        ]
+
+    @staticmethod
+    def pack_longest_first(tests, slices_count):
+        """
+        :param tests: list of `(duration, test_name)`, from the longest
+        :param slices_count: number of slices to make
+
+        :returns: tuple of the lists of `(duration, test_name)` of each slice, and their totals
+        """
+        bins = [[] for _ in range(slices_count)]
+        totals = [0.0] * slices_count
+        heap = [(0.0, i) for i in range(slices_count)]
+        for duration, test_name in tests:
+            total, index = heapq.heappop(heap)
+            bins[index].append((duration, test_name))
+            totals[index] = total + duration
+            heapq.heappush(heap, (totals[index], index))
+        return bins, totals
+
+    @staticmethod
+    def best_slices_exchange(longest_bin, shortest_bin, gap):
+        """
+        find the move of a test, or the swap of a pair of tests, from the longest slice
+        to the shortest one, that evens them out the most
+
+        moving `delta` from the longest to the shortest improves when 0 < delta < gap,
+        and is best when it's closest to half the gap
+
+        :param longest_bin: list of `(duration, test_name)` of the longest slice
+        :param shortest_bin: list of `(duration, test_name)` of the shortest slice
+        :param gap: difference between the durations of the two slices
+
+        :returns: tuple of `delta`, the position of the test in `longest_bin`, and the test
+                  of `shortest_bin` to swap it with (None to move it), or None if nothing improves
+        """
+        best, best_delta = None, 0.0
+        shortest_tests = sorted(shortest_bin)
+        for position, (duration, _) in enumerate(longest_bin):
+            # either move the test, or swap it with the tests closest to half the gap
+            candidates = [(duration, None)]
+            j = bisect.bisect_left(shortest_tests, (duration - gap / 2,))
+            candidates += [
+                (duration - other[0], other)
+                for other in shortest_tests[max(j - 1, 0) : j + 1]
+            ]
+            for delta, other in candidates:
+                if 0 < delta < gap and (
+                    best is None or abs(gap / 2 - delta) < abs(gap / 2 - best_delta)
+                ):
+                    best, best_delta = (delta, position, other), delta
+        return best
+
+    @staticmethod
+    def slices_imbalance(slices):
+        """
+        :returns: how much the longest slice is longer than the average slice, as a ratio
+        """
+        if not slices:
+            return 0.0
+        mean = sum(current_slice["total"] for current_slice in slices) / len(slices)
+        if not mean:
+            return 0.0
+        return max(current_slice["total"] for current_slice in slices) / mean - 1
+
+    def group_test_history(self, items, test_history_data):
+        """
+        group the tests by `--es-slices-group`, so the tests sharing fixtures are sliced together
+
+        groups are split to fit in a slice, `--es-max-splice-time` or the average slice
+        (setup included) with `--es-slices-count`
+
+        :param items: the collected tests
+        :param test_history_data: list of dicts with `test_name`, `duration` and `setup_duration`
+
+        :returns: list of units made by `make_test_groups`
+        """
+        groups = defaultdict(list)
+        for item in items:
+            groups[self.get_affinity_key(item, self.es_slices_group)].append(
+                item.nodeid.replace("::()", "")
+            )
+        units = self.make_test_groups(test_history_data, groups)
+        if self.es_slices_count:
+            max_group_duration = (
+                sum(unit["duration"] for unit in units) / self.es_slices_count
+            )
+        else:
+            max_group_duration = self.es_max_splice_time * 60
+        if any(unit["duration"] > max_group_duration for unit in units):
+            units = self.make_test_groups(test_history_data, groups, max_group_duration)
+        LOGGER.debug(
+            "%d tests grouped into %d units by %s",
+            len(test_history_data),
+            len(units),
+            self.es_slices_group,
+        )
+        return units
+
+    def publish_work_queue(self, test_history_data):
+        """
+        publish the tests into `--es-work-queue`, in chunks for the agents to pull
+        """
+        with self.metrics.timer("slicing"):
+            # the number of agents is the number of slices they would have run
+            agents = self.es_slices_count or len(
+                self.make_test_slices(
+                    test_history_data, max_slice_duration=self.es_max_splice_time * 60
+                )
+            )
+            chunks = self.make_work_chunks(test_history_data, agents)
+            if self.es_slices_group != "none":
+                self.expand_test_groups(chunks, test_history_data)
+        import pprint  # pylint: disable=import-outside-toplevel
+
+        LOGGER.debug(pprint.pformat(chunks))
+        WorkQueue(self.es_work_queue).publish([chunk["tests"] for chunk in chunks])
+        print(
+            "{} chunks published to [{}], for {} agents".format(
+                len(chunks), self.es_work_queue, agents
+            )
+        )
+
+    @pytest.hookimpl(optionalhook=True)
+    def pytest_xdist_make_scheduler(self, config, log):
+        if (
+            self.es_xdist_schedule == "longest-first"
+            and config.getvalue("dist") == "load"
+        ):
+            return LongestFirstScheduling.create(self, config, log)
+        return None
+
+    def pull_chunk(self, items):
+        """
+        claim the next chunk of the work queue
+
+        :param items: the collected items, by test name
+
+        :returns: list of [item, claimed chunk file] pairs, the file being set
+                  on the last one only, or None when the queue is empty
+        """
+        chunk = self.work_queue.claim()
+        if chunk is None:
+            return None
+        claimed, tests = chunk
+        chunk_items = []
+        for test in tests:
+            if test in items:
+                chunk_items.append([items[test], None])
+            else:
+                LOGGER.warning("[%s] from the work queue wasn't collected", test)
+        if chunk_items:
+            chunk_items[-1][1] = claimed
+        else:
+            self.work_queue.complete(claimed)
+        return chunk_items
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_runtestloop(self, session):
+        """
+        with `--es-work-queue`, run the chunks of tests pulled from the queue,
+        instead of all the collected tests
+        """
+        if (
+            not self.es_work_queue
+            or self.config.getoption("es_slices")
+            or self.es_slices_count
+            or self.config.getoption("collectonly")
+            or self.config.getoption("dist", "no") != "no"
+        ):
+            return None
+        if session.testsfailed and not self.config.option.continue_on_collection_errors:
+            raise session.Interrupted(
+                "%d error%s during collection"
+                % (session.testsfailed, "s" if session.testsfailed != 1 else "")
+            )
+        items = {item.nodeid.replace("::()", ""): item for item in session.items}
+        self.work_queue = WorkQueue(
+            self.es_work_queue, lease=self.config.getoption("es_work_queue_lease") * 60
+        )
+        # tests to run, with the claimed chunk file on the last test of each chunk
+        to_run = deque()
+        while True:
+            if len(to_run) < 2:
+                # claim the next chunk before the last test runs, so its `nextitem` is known,
+                # and fixtures shared with the next chunk aren't torn down
+                chunk_items = self.pull_chunk(items)
+                if chunk_items is not None:
+                    to_run.extend(chunk_items)
+                    continue
+            if not to_run:
+                break
+            item, claimed = to_run.popleft()
+            nextitem = to_run[0][0] if to_run else None
+            item.config.hook.pytest_runtest_protocol(item=item, nextitem=nextitem)
+            if claimed:
+                self.work_queue.complete(claimed)
+            self.work_queue.heartbeat()
+            if session.shouldfail:
+                raise session.Failed(session.shouldfail)
+            if session.shouldstop:
+                raise session.Interrupted(session.shouldstop)
+        return True
+
+    def pytest_collection_finish(self, session):
+        if self.config.getoption("es_slices") or self.es_slices_count:
+            assert (
+                self.es_default_test_time and self.es_max_splice_time
+            ), "'--es-max-splice-time' and '--es-default-test-time' should be positive numbers"
+            assert (
+                self.es_slices_count is None or self.es_slices_count > 0
+            ), "'--es-slices-count' should be a positive number"
+            with self.metrics.timer("history_lookup"):
+                test_history_data = self.fetch_test_duration(
+                    [item.nodeid.replace("::()", "") for item in session.items],
+                    default_time_sec=self.es_default_test_time,
+                )
+            if self.es_slices_group != "none":
+                with self.metrics.timer("slicing"):
+                    test_history_data = self.group_test_history(
+                        session.items, test_history_data
+                    )
+            if self.es_work_queue:
+                self.publish_work_queue(test_history_data)
+                return
+            with self.metrics.timer("slicing"):
+                if self.es_slices_count:
+                    slices = self.make_fixed_test_slices(
+                        test_history_data, slices_count=self.es_slices_count
+                    )
+                else:
+                    slices = self.make_test_slices(
+                        test_history_data,
+                        max_slice_duration=self.es_max_splice_time * 60,
+                    )
+                if self.es_slices_group != "none":
+                    self.expand_test_groups(slices, test_history_data)
+            import pprint  # pylint: disable=import-outside-toplevel
+
+            LOGGER.debug(pprint.pformat(slices))
+            self.clear_old_exclude_files(outputdir=".")
+            self.split_files_test_list(outputdir=".", slices=slices)
+            print(
+                "{} slices, imbalance: {:.1%}, estimated compute: {}".format(
+                    len(slices),
+                    self.slices_imbalance(slices),
+                    datetime.timedelta(
+                        0, sum(current_slice["total"] for current_slice in slices)
+                    ),
+                )
+            )
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+The transports sending requests to Elasticsearch
+"""
+
+import json
+import gzip
+import time
+import logging
+import threading
+import random
+from typing import Any
+
+import pytest
+
+
+LOGGER = logging.getLogger("elk-reporter")
+
+
+class RequestsTransport(object):
+    """
+    Run blocking `ElkReporter.es_request` calls in a pool of threads
+    """
+
+    def __init__(self, reporter, max_workers=20):
+        self.reporter = reporter
+        import concurrent.futures  # pylint: disable=import-outside-toplevel
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit(self, method, path, **kwargs):
+        """:returns: a `concurrent.futures.Future` of the response"""
+        return self.executor.submit(self.reporter.es_request, method, path, **kwargs)
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class AsyncResponse(object):
+    """
+    The parts of `requests.Response` used by the reporter, for responses read by aiohttp
+    """
+
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", "replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            import requests  # pylint: disable=import-outside-toplevel
+
+            raise requests.exceptions.HTTPError(
+                "{0.status_code} Error for url: {0.url}".format(self), response=self
+            )
+
+
+class AsyncTransport(object):  # pylint: disable=too-many-instance-attributes
+    """
+    Send requests to Elasticsearch with aiohttp, from an event loop running in its own thread,
+    limiting the number of requests in flight with a semaphore
+    """
+
+    def __init__(self, reporter, max_in_flight=200):
+        # pylint: disable=import-outside-toplevel
+        import asyncio
+        import requests
+
+        try:
+            import aiohttp
+        except ImportError as ex:
+            raise pytest.UsageError(
+                "'--es-transport=asyncio' requires aiohttp to be installed"
+            ) from ex
+        self.aiohttp = aiohttp
+        self.asyncio = asyncio
+        self.requests = requests
+        self.reporter = reporter
+        self.max_in_flight = max_in_flight
+        self.semaphore = None
+        self.session = None
+        self.loop = self.asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="elk-reporter-asyncio", daemon=True
+        )
+        self.thread.start()
+        self.asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+
+    async def _start(self):
+        self.semaphore = self.asyncio.Semaphore(self.max_in_flight)
+        self.session = self.aiohttp.ClientSession(
+            connector=self.aiohttp.TCPConnector(limit=self.max_in_flight)
+        )
+
+    def submit(self, method, path, **kwargs):
+        """:returns: a `concurrent.futures.Future` of the response"""
+        return self.asyncio.run_coroutine_threadsafe(
+            self._request(method, path, **kwargs), self.loop
+        )
+
+    async def _request(self, method, path, **kwargs):
+        reporter = self.reporter
+        url = "{0.es_url}/{1}".format(reporter, path)
+        auth_args = reporter.es_auth_args
+        headers = dict(auth_args.get("headers", {}))
+        headers.update(kwargs.pop("headers", None) or {})
+        if "auth" in auth_args:
+            kwargs["auth"] = self.aiohttp.BasicAuth(*auth_args["auth"])
+        timeout = self.aiohttp.ClientTimeout(
+            total=float(kwargs.pop("timeout", reporter.es_timeout))
+        )
+        metric = reporter.metrics.http_metric(path)
+        attempt = 0
+        async with self.semaphore:
+            while True:
+                start = time.perf_counter()
+                try:
+                    async with self.session.request(
+                        method, url, headers=headers, timeout=timeout, **kwargs
+                    ) as res:
+                        response = AsyncResponse(
+                            url, res.status, res.headers, await res.read()
+                        )
+                except self.asyncio.TimeoutError as ex:
+                    reporter.metrics.observe(metric, time.perf_counter() - start, True)
+                    raise self.requests.exceptions.Timeout(str(ex)) from ex
+                except self.aiohttp.ClientError as ex:
+                    reporter.metrics.observe(metric, time.perf_counter() - start, True)
+                    raise self.requests.exceptions.ConnectionError(str(ex)) from ex
+                reporter.metrics.observe(
+                    metric,
+                    time.perf_counter() - start,
+                    failed=response.status_code >= 400,
+                )
+                if (
+                    response.status_code not in reporter.RETRY_STATUSES
+                    or attempt >= reporter.es_max_retries
+                ):
+                    return response
+                await self.asyncio.sleep(reporter.retry_delay(response, attempt))
+                attempt += 1
+
+    def close(self):
+        self.asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+class TransportMixin(object):
+    """
+    Sending requests to Elasticsearch, part of `ElkReporter`
+    """
+
+    RETRY_STATUSES = (429, 502, 503)
+    MAX_RETRY_DELAY = 60.0
+
+    @property
+    def es_auth_args(self) -> dict[str, Any]:
+        if self.es_api_key:
+            return dict(headers={"Authorization": f"ApiKey {self.es_api_key}"})
+        if self.es_username and self.es_password:
+            return dict(auth=(self.es_username, self.es_password))
+        return {}
+
+    @property
+    def session(self):
+        """a `requests.Session` shared by all the calls to Elasticsearch"""
+        if self._session is None:
+            import requests  # pylint: disable=import-outside-toplevel
+
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=self.es_connections
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._session = session
+        return self._session
+
+    @property
+    def async_transport(self):
+        """an `AsyncTransport` shared by all the calls to Elasticsearch"""
+        if self._async_transport is None:
+            self._async_transport = AsyncTransport(self, self.es_max_in_flight)
+        return self._async_transport
+
+    def close_session(self):
+        if self._session:
+            self._session.close()
+            self._session = None
+        if self._async_transport:
+            self._async_transport.close()
+            self._async_transport = None
+
+    def retry_delay(self, response, attempt):
+        """
+        time to wait before retrying a throttled request
+
+        honors the `Retry-After` header if found, otherwise use exponential backoff with full jitter
+        """
+        retry_after = response.headers.get("Retry-After")
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = random.uniform(0, self.es_retry_backoff * 2**attempt)
+        return min(max(delay, 0.0), self.MAX_RETRY_DELAY)
+
+    def es_request(self, method, path, **kwargs):
+        """
+        send a request to Elasticsearch, retrying throttled requests
+
+        :param method: http method
+        :param path: path of the url, relative to `es_url`
+        :param kwargs: passed as is to `requests.Session.request`
+
+        :returns: the last `requests.Response`
+        """
+        if self.es_transport == "asyncio":
+            return self.async_transport.submit(method, path, **kwargs).result()
+        url = "{}/{}".format(self.es_url, path)
+        auth_args = self.es_auth_args
+        headers = dict(auth_args.pop("headers", {}))
+        headers.update(kwargs.pop("headers", None) or {})
+        kwargs.update(auth_args, headers=headers)
+        kwargs.setdefault("timeout", self.es_timeout)
+        metric = self.metrics.http_metric(path)
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                res = self.session.request(method, url, **kwargs)
+            except Exception:
+                self.metrics.observe(metric, time.perf_counter() - start, failed=True)
+                raise
+            self.metrics.observe(
+                metric, time.perf_counter() - start, failed=res.status_code >= 400
+            )
+            if res.status_code not in self.RETRY_STATUSES:
+                return res
+            if attempt >= self.es_max_retries:
+                return res
+            delay = self.retry_delay(res, attempt)
+            LOGGER.debug(
+                "elasticsearch returned %s, retrying in %.2f seconds",
+                res.status_code,
+                delay,
+            )
+            time.sleep(delay)
+            attempt += 1
+
+    def compress_body(self, data):
+        """
+        gzip the body of a request, if compression is enabled and it's large enough
+
+        :returns: tuple of the body, and the headers to send with it
+        """
+        headers = {}
+        self.body_bytes["raw_bytes"] += len(data)
+        if self.es_gzip and len(data) >= self.es_gzip_min_bytes:
+            data = gzip.compress(data, compresslevel=self.es_gzip_level)
+            headers["Content-Encoding"] = "gzip"
+        self.body_bytes["sent_bytes"] += len(data)
+        return data, headers
+
+    def bulk_to_elasticsearch(self, body):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        data, headers = self.compress_body(body)
+        headers["Content-Type"] = "application/x-ndjson"
+        return self.es_request(
+            "POST", "{}/_bulk".format(self.es_index_name), data=data, headers=headers
+        )
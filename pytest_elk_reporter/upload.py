@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+"""
+`pytest-elk-upload`, posting the files written by `--es-output-file`
+"""
+
+import os
+import json
+import time
+import logging
+import argparse
+import configparser
+from collections import defaultdict
+
+import pytest
+
+from .options import pytest_addoption
+from .reporter import ElkReporter
+from .shipping import split_bulk_items
+
+
+LOGGER = logging.getLogger("elk-reporter")
+
+
+class BulkUploader(object):
+    """
+    Upload files written with `--es-output-file`, with parallel `_bulk` requests
+
+    files are streamed in chunks, and the offset up to which all the chunks of a file were uploaded
+    is kept in a checkpoint file, so an interrupted upload resumes from there
+
+    documents go to the index named in their action lines, as written by the test session,
+    unless `override_index` is set, then they all go to the index of `reporter`
+    """
+
+    def __init__(
+        self, reporter, concurrency=None, checkpoint_path=None, override_index=False
+    ):
+        self.reporter = reporter
+        self.action = None
+        if override_index:
+            self.action = (reporter.bulk_action() + "\n").encode("utf-8")
+        self.concurrency = concurrency or reporter.es_connections
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint = self.load_checkpoint()
+        self.stats = dict(files=0, documents=0, errors=0, failed_requests=0)
+
+    def load_checkpoint(self):
+        if not self.checkpoint_path:
+            return {}
+        try:
+            with open(self.checkpoint_path) as checkpoint_file:
+                return json.load(checkpoint_file)
+        except (OSError, ValueError):
+            return {}
+
+    def save_checkpoint(self):
+        if not self.checkpoint_path:
+            return
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w") as checkpoint_file:
+            json.dump(self.checkpoint, checkpoint_file)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def get_offset(self, path):
+        """
+        :returns: offset to resume the upload of a file from, 0 if it was modified since
+        """
+        entry = self.checkpoint.get(os.path.abspath(path))
+        if entry and entry["mtime"] == os.path.getmtime(path):
+            return entry["offset"]
+        return 0
+
+    def read_chunks(self, path, offset=0):
+        """
+        stream a file in `_bulk` format, in chunks of `es_bulk_max_docs` documents at most
+
+        :returns: generator of tuples of the start offset, end offset and lines of each chunk
+        """
+        max_docs = self.reporter.es_bulk_max_docs
+        max_bytes = self.reporter.es_bulk_max_bytes
+        with open(path, "rb") as ndjson_file:
+            ndjson_file.seek(offset)
+            start = end = offset
+            lines, size = [], 0
+            while True:
+                action = ndjson_file.readline()
+                document = ndjson_file.readline()
+                if not document.endswith(b"\n"):
+                    if action.strip():
+                        LOGGER.warning("[%s] ends with a partial document", path)
+                    break
+                pair = (self.action or action) + document
+                if lines and (len(lines) >= max_docs or size + len(pair) > max_bytes):
+                    yield start, end, lines
+                    start, lines, size = end, [], 0
+                lines.append(pair)
+                size += len(pair)
+                end = ndjson_file.tell()
+            if lines:
+                yield start, end, lines
+
+    def send_chunk(self, lines):
+        """
+        send one chunk, retrying documents rejected with 429 by Elasticsearch
+
+        :returns: tuple of the number of indexed documents and of failed ones
+        """
+        reporter = self.reporter
+        indexed = errors = attempt = 0
+        while lines:
+            res = reporter.bulk_to_elasticsearch(b"".join(lines))
+            res.raise_for_status()
+            result = res.json()
+            if not result.get("errors"):
+                return indexed + len(lines), errors
+            throttled, done, failed = split_bulk_items(lines, result)
+            indexed += done
+            errors += failed
+            if throttled and attempt >= reporter.es_max_retries:
+                errors += len(throttled)
+                break
+            if throttled:
+                time.sleep(reporter.retry_delay(res, attempt))
+            attempt += 1
+            lines = throttled
+        return indexed, errors
+
+    def upload(self, paths):
+        """
+        :param paths: files to upload, in order
+        :returns: True if all the files were uploaded
+        """
+        import concurrent.futures  # pylint: disable=import-outside-toplevel
+
+        if self.reporter.es_index_template:
+            self.reporter.ensure_index_template()
+        pending = {}
+        # per file: offset up to which everything was uploaded, and chunks done after it
+        offsets, done_chunks, failed = {}, defaultdict(dict), set()
+
+        def handle(future):
+            path, start, end = pending.pop(future)
+            try:
+                indexed, errors = future.result()
+            except Exception as ex:  # pylint: disable=broad-except
+                LOGGER.warning("Failed to upload [%s]: [%s]", path, str(ex))
+                self.stats["failed_requests"] += 1
+                failed.add(path)
+                return
+            self.stats["documents"] += indexed
+            self.stats["errors"] += errors
+            done_chunks[path][start] = end
+            while offsets[path] in done_chunks[path]:
+                offsets[path] = done_chunks[path].pop(offsets[path])
+            self.checkpoint[os.path.abspath(path)] = dict(
+                offset=offsets[path], mtime=os.path.getmtime(path)
+            )
+            self.save_checkpoint()
+
+        with concurrent.futures.ThreadPoolExecutor(self.concurrency) as executor:
+            for path in paths:
+                self.stats["files"] += 1
+                offsets[path] = self.get_offset(path)
+                for start, end, lines in self.read_chunks(path, offsets[path]):
+                    while len(pending) >= self.concurrency:
+                        done, _ = concurrent.futures.wait(
+                            pending, return_when=concurrent.futures.FIRST_COMPLETED
+                        )
+                        for future in done:
+                            handle(future)
+                    if path in failed:
+                        # no point in sending more of it, it would be resent on resume
+                        break
+                    future = executor.submit(self.send_chunk, lines)
+                    pending[future] = (path, start, end)
+            while pending:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    handle(future)
+        return not failed
+
+
+class UploadConfig(object):
+    """
+    the settings of `pytest-elk-upload`, read like in a test session
+
+    stands in for the pytest parser while `pytest_addoption` runs, so the `--es-*` options
+    and the ini keys keep the same defaults, then only reads the ini file,
+    without any pytest plugin or conftest.py
+
+    :param args: `--es-*` command line options, like `--es-address=...`
+    :param inifile: the ini file, found from the current directory up if not given
+    :param override_ini: `option=value` overriding the ini file, like `-o` of pytest
+    """
+
+    # in the order pytest looks for them, with the section holding its keys
+    INI_FILES = (
+        ("pytest.ini", "pytest"),
+        ("pyproject.toml", "tool.pytest.ini_options"),
+        ("tox.ini", "pytest"),
+        ("setup.cfg", "tool:pytest"),
+    )
+
+    def __init__(self, args, inifile=None, override_ini=()):
+        self._parser = argparse.ArgumentParser(prog="pytest-elk-upload", add_help=False)
+        self._ini_defaults = {}
+        pytest_addoption(self)
+        self.option, unknown = self._parser.parse_known_args(list(args))
+        if unknown:
+            raise pytest.UsageError(
+                "unrecognized arguments: {}".format(" ".join(unknown))
+            )
+        self.inipath, self.inicfg = self.read_ini(inifile)
+        for override in override_ini:
+            key, sep, value = override.partition("=")
+            if not sep:
+                raise pytest.UsageError(
+                    "-o/--override-ini expects option=value style (got: {})".format(
+                        override
+                    )
+                )
+            self.inicfg[key] = value
+
+    def getgroup(self, name, description=""):  # pylint: disable=unused-argument
+        return self
+
+    def addoption(self, *opts, **attrs):
+        self._parser.add_argument(*opts, **attrs)
+
+    def addini(self, name, **attrs):
+        self._ini_defaults[name] = (attrs.get("type"), attrs.get("default"))
+
+    @classmethod
+    def read_ini(cls, inifile=None):
+        """
+        :returns: the path of the ini file and its pytest keys,
+                  from `inifile` or the first one found in the current directory or above
+        """
+        if inifile:
+            candidates = [os.path.abspath(inifile)]
+        else:
+            candidates = []
+            directory = os.getcwd()
+            while True:
+                candidates += [
+                    os.path.join(directory, name) for name, _ in cls.INI_FILES
+                ]
+                parent = os.path.dirname(directory)
+                if parent == directory:
+                    break
+                directory = parent
+        for path in candidates:
+            if not os.path.isfile(path):
+                continue
+            basename = os.path.basename(path)
+            section = dict(cls.INI_FILES).get(basename, "pytest")
+            if basename.endswith(".toml"):
+                keys = cls.read_toml(path, section)
+            else:
+                parser = configparser.RawConfigParser(strict=False)
+                parser.read(path)
+                keys = dict(parser[section]) if parser.has_section(section) else None
+            # a pytest.ini file is used even without a [pytest] section
+            if keys is not None or basename == "pytest.ini" or inifile:
+                return path, keys or {}
+        return None, {}
+
+    @staticmethod
+    def read_toml(path, section):
+        try:
+            import tomllib  # pylint: disable=import-outside-toplevel
+        except ImportError:  # python < 3.11
+            LOGGER.warning("can't read [%s] before python 3.11", path)
+            return None
+        with open(path, "rb") as toml_file:
+            data = tomllib.load(toml_file)
+        for key in section.split("."):
+            data = data.get(key)
+            if not isinstance(data, dict):
+                return None
+        return data
+
+    def getoption(self, name, default=None):
+        return getattr(self.option, name, default)
+
+    def getini(self, name):
+        ini_type, default = self._ini_defaults[name]
+        value = self.inicfg.get(name)
+        if value is None:
+            return default
+        if ini_type == "linelist" and isinstance(value, str):
+            return [line.strip() for line in value.split("\n") if line.strip()]
+        return value
+
+    def has_ini(self, name):
+        """:returns: True if `name` is set in the ini file, or overridden with `-o`"""
+        return name in self.inicfg
+
+
+def upload_main(argv=None):
+    """
+    `pytest-elk-upload`, upload files written with `--es-output-file` into Elasticsearch
+    """
+    parser = argparse.ArgumentParser(
+        prog="pytest-elk-upload",
+        description="Upload files written with --es-output-file into Elasticsearch",
+        epilog="Elasticsearch is configured like in a test session, "
+        "with the es_* keys of the pytest ini file, or with --es-* options given as --option=value "
+        "(i.e. --es-address=..., --es-bulk-max-docs=..., --es-max-retries=...)",
+    )
+    parser.add_argument(
+        "-c",
+        "--config-file",
+        default=None,
+        help="pytest ini file to read es_* keys from",
+    )
+    parser.add_argument(
+        "-o",
+        "--override-ini",
+        action="append",
+        default=[],
+        help="override an es_* key of the ini file, like -o of pytest",
+    )
+    parser.add_argument(
+        "paths", nargs="+", help="files, or directories of .ndjson files"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=None,
+        help="number of bulk requests in flight (default is --es-connections)",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default=".elk-upload-checkpoint.json",
+        help="file keeping the upload progress, to resume from (empty to disable)",
+    )
+    args, pytest_args = parser.parse_known_args(argv)
+    logging.basicConfig(format="%(levelname)s: %(message)s")
+
+    config = UploadConfig(pytest_args, args.config_file, args.override_ini)
+    reporter = ElkReporter(config)
+    if not reporter.es_address:
+        parser.error("es_address isn't configured")
+
+    paths = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            paths += sorted(
+                os.path.join(path, filename)
+                for filename in os.listdir(path)
+                if filename.endswith(".ndjson")
+            )
+        else:
+            paths.append(path)
+
+    uploader = BulkUploader(
+        reporter,
+        args.concurrency,
+        args.checkpoint or None,
+        # the files hold the index they were written for, unless the upload is told otherwise
+        override_index=config.has_ini("es_index_name"),
+    )
+    try:
+        success = uploader.upload(paths)
+    finally:
+        reporter.close_session()
+    print("uploaded to [{}]: {}".format(reporter.es_address, uploader.stats))
+    return 0 if success else 1
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+A queue of test chunks in Elasticsearch, pulled by the agents of a session
+"""
+
+import os
+import time
+import socket
+import logging
+import fnmatch
+
+
+LOGGER = logging.getLogger("elk-reporter")
+
+
+class WorkQueue(object):
+    """
+    Queue of test chunks in a shared directory, pulled by pytest runs on many agents
+
+    each chunk is a file listing test names, claimed by renaming it, which only one agent
+    can do, so no lock is needed (also on NFS, where rename is atomic)
+
+    the claimed file is touched after each test, and deleted once the chunk is done,
+    once the queue is empty, chunks whose claim wasn't touched for `lease` seconds
+    are claimed again, since their agent is likely gone
+    """
+
+    PATTERN = "chunk-*.txt"
+    CLAIMED_PATTERN = "chunk-*.txt.claimed-*"
+
+    def __init__(self, path, owner=None, lease=30 * 60):
+        self.path = path
+        self.owner = owner or "{}-{}".format(socket.gethostname(), os.getpid())
+        self.lease = lease
+        self.claimed = []
+        self.stats = dict(chunks=0, tests=0, reclaimed=0)
+
+    def publish(self, chunks):
+        """
+        replace the content of the queue
+
+        :param chunks: list of lists of test names, in the order they should be pulled
+        """
+        os.makedirs(self.path, exist_ok=True)
+        for filename in os.listdir(self.path):
+            if filename.startswith("chunk-"):
+                os.remove(os.path.join(self.path, filename))
+        for index, tests in enumerate(chunks):
+            filename = os.path.join(self.path, "chunk-{:05d}.txt".format(index))
+            # written aside and renamed, so agents never see a partial chunk
+            with open(filename + ".tmp", "w") as chunk_file:
+                chunk_file.write("".join(test + "\n" for test in tests))
+            os.rename(filename + ".tmp", filename)
+
+    def claim(self):
+        """
+        :returns: the claimed file of the next chunk and its test names,
+                  or None when the queue is empty
+        """
+        try:
+            filenames = sorted(os.listdir(self.path))
+        except OSError:
+            return None
+        for filename in fnmatch.filter(filenames, self.PATTERN):
+            claimed = self.take(filename)
+            if claimed:
+                return claimed, self.read(claimed)
+        now = time.time()
+        for filename in fnmatch.filter(filenames, self.CLAIMED_PATTERN):
+            try:
+                if (
+                    now - os.path.getmtime(os.path.join(self.path, filename))
+                    < self.lease
+                ):
+                    continue
+            except OSError:
+                # done in the meantime
+                continue
+            claimed = self.take(filename)
+            if claimed:
+                LOGGER.warning(
+                    "[%s] wasn't touched for a while, pulling it again", filename
+                )
+                self.stats["reclaimed"] += 1
+                return claimed, self.read(claimed)
+        return None
+
+    def take(self, filename):
+        """
+        :returns: the path of the chunk once renamed as claimed,
+                  or None if another agent got it first
+        """
+        chunk_name = filename.split(".claimed-")[0]
+        claimed = os.path.join(
+            self.path, "{}.claimed-{}".format(chunk_name, self.owner)
+        )
+        try:
+            os.rename(os.path.join(self.path, filename), claimed)
+            os.utime(claimed, None)
+        except OSError:
+            # claimed by another agent in the meantime
+            return None
+        self.claimed.append(claimed)
+        return claimed
+
+    def read(self, claimed):
+        with open(claimed) as chunk_file:
+            tests = [line.strip() for line in chunk_file if line.strip()]
+        self.stats["chunks"] += 1
+        self.stats["tests"] += len(tests)
+        return tests
+
+    def heartbeat(self):
+        """
+        touch the chunks being run, so other agents don't claim them again
+        """
+        for claimed in self.claimed:
+            try:
+                os.utime(claimed, None)
+            except OSError:
+                pass
+
+    def complete(self, claimed):
+        """
+        remove a chunk from the queue once all its tests ran
+        """
+        self.claimed.remove(claimed)
+        try:
+            os.remove(claimed)
+        except OSError:
+            # claimed again by another agent, which thought this one was gone
+            pass
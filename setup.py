@@ -23,11 +23,12 @@ setup(
     description="A simple plugin to use with pytest",
     long_description=read("README.md"),
     long_description_content_type="text/markdown",
-    py_modules=["pytest_elk_reporter"],
+    packages=["pytest_elk_reporter"],
     python_requires=">=2.7, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3.*",
     use_scm_version=True,
     setup_requires=["setuptools_scm"],
-    install_requires=["pytest>=3.5.0", "requests", "six"],
+    install_requires=["pytest>=3.5.0", "requests"],
+    extras_require={"asyncio": ["aiohttp"]},
     classifiers=[
         "Development Status :: 4 - Beta",
         "Framework :: Pytest",
@@ -42,5 +43,10 @@ setup(
         "Operating System :: OS Independent",
         "License :: OSI Approved :: MIT License",
     ],
-    entry_points={"pytest11": ["elk-reporter = pytest_elk_reporter"]},
+    entry_points={
+        "pytest11": ["elk-reporter = pytest_elk_reporter"],
+        "console_scripts": [
+            "pytest-elk-upload = pytest_elk_reporter.upload:upload_main"
+        ],
+    },
 )
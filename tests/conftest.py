@@ -1,4 +1,8 @@
 import re
+import json
+import gzip
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import pytest
 import requests_mock as rm_module
@@ -45,3 +49,96 @@ def configure_es_mock(requests_mock):  # pylint: disable=redefined-outer-name
             dict(text="should error !!!", status_code=500),
         ],
     )
+
+
+@pytest.fixture(scope="function")
+def es_documents(requests_mock):  # pylint: disable=redefined-outer-name
+    """Return a function listing all the documents posted via the `_bulk` api"""
+
+    def get_documents():
+        documents = []
+        for request in requests_mock.request_history:
+            if request.path.endswith("/_bulk"):
+                body = request.body
+                if request.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+                lines = body.decode("utf-8").splitlines()
+                documents += [json.loads(line) for line in lines[1::2]]
+        return documents
+
+    return get_documents
+
+
+@pytest.fixture(scope="function")
+def es_history(requests_mock):  # pylint: disable=redefined-outer-name
+    """
+    Return a function mocking the duration history lookups,
+    each of its arguments being the buckets of a page of the `composite` aggregation
+    """
+
+    def mock_pages(*pages):
+        responses = [
+            dict(
+                json={
+                    "aggregations": {
+                        "tests": {
+                            "after_key": {"name": "page-{}".format(index)},
+                            "buckets": buckets,
+                        }
+                    }
+                }
+            )
+            for index, buckets in enumerate(pages)
+        ]
+        # the empty page ending the lookup
+        responses.append(dict(json={"aggregations": {"tests": {"buckets": []}}}))
+        requests_mock.post(
+            "http://127.0.0.1:9200/test_data/_search", response_list=responses
+        )
+
+    return mock_pages
+
+
+class FakeElasticsearchHandler(BaseHTTPRequestHandler):
+    """Answer `_bulk` and `_search` requests, keeping the bodies it got"""
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.requests.append((self.path, body))
+        if "/_bulk" in self.path:
+            lines = body.splitlines()[::2]
+            response = {
+                "errors": False,
+                "items": [{"index": {"status": 201}}] * len(lines),
+            }
+        else:
+            response = {
+                "aggregations": {
+                    "tests": {"buckets": []},
+                    "percentiles_duration": {"values": {"95.0": None}},
+                }
+            }
+        data = json.dumps(response).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+@pytest.fixture(scope="function")
+def es_server():
+    """A local http server standing in for Elasticsearch"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeElasticsearchHandler)
+    server.requests = []
+    server.address = "127.0.0.1:{}".format(server.server_address[1])
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs=dict(poll_interval=0.05), daemon=True
+    )
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -1,12 +1,13 @@
 # -*- coding: utf-8 -*-
 
 import os
-import json
 
 import pytest
 
+from pytest_elk_reporter import ElkReporter
 
-def test_failures(testdir, requests_mock):  # pylint: disable=redefined-outer-name
+
+def test_failures(testdir, es_documents):  # pylint: disable=redefined-outer-name
     """Make sure that pytest accepts our fixture."""
 
     # create a temporary pytest test module
@@ -96,7 +97,7 @@ def test_failures(testdir, requests_mock):  # pylint: disable=redefined-outer-na
     # make sure that we get a '1' exit code for the testsuite
     assert result.ret == 1
 
-    last_report = json.loads(requests_mock.request_history[-1].text)
+    last_report = es_documents()[-1]
     assert last_report["stats"] == {
         "error": 1,
         "failure": 3,
@@ -275,6 +276,52 @@ def test_setup_es_from_code(testdir, requests_mock):
     assert "Basic" in auth_header
 
 
+def test_inactive_without_address(testdir):
+    testdir.makepyfile(
+        """
+        def test_should_pass(request, elk_reporter):
+            assert not elk_reporter.active
+            assert request.config.pluginmanager.get_plugin("elk-reporter-runtest") is None
+            assert elk_reporter.context.thread.ident is None
+            assert "username" not in elk_reporter.session_data
+        """
+    )
+
+    result = testdir.runpytest("-v")
+
+    result.stdout.fnmatch_lines(["*::test_should_pass PASSED*"])
+    assert result.ret == 0
+
+
+def test_activate_from_fixture(
+    testdir, es_documents
+):  # pylint: disable=redefined-outer-name
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture(scope='session', autouse=True)
+        def configure_es(elk_reporter):
+            assert not elk_reporter.active
+            elk_reporter.es_address = "127.0.0.1:9200"
+            assert elk_reporter.active
+
+        def test_should_pass():
+            pass
+        """
+    )
+
+    result = testdir.runpytest("-v")
+
+    result.stdout.fnmatch_lines(["*::test_should_pass PASSED*"])
+    assert result.ret == 0
+    documents = es_documents()
+    assert [doc["outcome"] for doc in documents if "outcome" in doc] == ["passed"]
+    assert "username" in documents[0] and "hostname" in documents[0]
+    assert documents[0]["setup_duration"] >= 0
+    assert documents[-1]["summery"]
+
+
 def test_setup_es_api_key_from_code(testdir, requests_mock):
     # create a temporary pytest test module
     testdir.makepyfile(
@@ -303,8 +350,7 @@ def test_setup_es_api_key_from_code(testdir, requests_mock):
     assert "ApiKey" in auth_header
 
 
-def test_git_info(testdir, requests_mock):  # pylint: disable=redefined-outer-name
-
+def test_git_info(testdir, es_documents):  # pylint: disable=redefined-outer-name
     # create a fake git repo
     testdir.run("git", "init")
     testdir.run("git", "checkout", "-b", "master")
@@ -332,7 +378,7 @@ def test_git_info(testdir, requests_mock):  # pylint: disable=redefined-outer-na
     # make sure that we get a '0' exit code for the testsuite
     assert result.ret == 0
 
-    last_report = json.loads(requests_mock.request_history[-1].text)
+    last_report = es_documents()[-1]
     assert last_report["git_branch"] == "master"
     assert "initial commit" in last_report["git_commit_oneline"]
     assert "initial commit" in last_report["git_commit_full"]
@@ -341,8 +387,35 @@ def test_git_info(testdir, requests_mock):  # pylint: disable=redefined-outer-na
     assert last_report["git_repo"] == "http://github.com/something/something.git"
 
 
+def test_git_info_cache(testdir, monkeypatch):
+    from pytest_elk_reporter import ContextCollector
+
+    testdir.run("git", "init")
+    testdir.run("git", "checkout", "-b", "master")
+    testdir.run("git", "config", "user.name", "Your Name")
+    testdir.run("git", "config", "user.email", "something@gmail.com")
+    testdir.run("git", "commit", "--allow-empty", "-m", "initial commit")
+
+    class Cache(dict):
+        def set(self, key, value):
+            self[key] = value
+
+    cache = Cache()
+    git_info = ContextCollector(cache, cwd=str(testdir.tmpdir)).get("git")
+    assert git_info["git_branch"] == "master"
+    assert "initial commit" in git_info["git_commit_full"]
+    assert len(cache) == 1
+
+    # HEAD didn't change, so git isn't called again
+    def git_log(_):
+        raise AssertionError("git log shouldn't be called")
+
+    monkeypatch.setattr(ContextCollector, "git_log", git_log)
+    assert ContextCollector(cache, cwd=str(testdir.tmpdir)).get("git") == git_info
+
+
 def test_append_test_data(
-    testdir, requests_mock
+    testdir, es_documents
 ):  # pylint: disable=redefined-outer-name
     # create a temporary pytest test module
     testdir.makepyfile(
@@ -363,10 +436,10 @@ def test_append_test_data(
     # make sure that we get a '0' exit code for the testsuite
     assert result.ret == 0
 
-    first_report = json.loads(requests_mock.request_history[0].text)
+    first_report = es_documents()[0]
     assert first_report["my_key"] == 1
 
-    second_report = json.loads(requests_mock.request_history[1].text)
+    second_report = es_documents()[1]
     assert "my_key" not in second_report, "key should be only on specific test"
 
 
@@ -396,7 +469,7 @@ def test_setup_es_from_ini(testdir):
 
 
 def test_marker_collection(
-    testdir, requests_mock
+    testdir, es_documents
 ):  # pylint: disable=redefined-outer-name
     # create a temporary pytest test module
     testdir.makepyfile(
@@ -422,16 +495,14 @@ def test_marker_collection(
     # make sure that we get a '0' exit code for the testsuite
     assert result.ret == 0
 
-    first_report = json.loads(requests_mock.request_history[0].text)
+    first_report = es_documents()[0]
     assert "mark1" in first_report["markers"]
 
-    second_report = json.loads(requests_mock.request_history[1].text)
+    second_report = es_documents()[1]
     assert "mark2" in second_report["markers"]
 
 
-def test_user_properties(
-    testdir, requests_mock
-):  # pylint: disable=redefined-outer-name
+def test_user_properties(testdir, es_documents):  # pylint: disable=redefined-outer-name
     # create a temporary pytest test module
     testdir.makepyfile(
         """
@@ -451,12 +522,12 @@ def test_user_properties(
     # make sure that we get a '0' exit code for the testsuite
     assert result.ret == 0
 
-    report = json.loads(requests_mock.request_history[0].text)
+    report = es_documents()[0]
     assert "example_key" in report
     assert report["example_key"] == 1
 
 
-def test_marks(testdir, requests_mock):  # pylint: disable=redefined-outer-name
+def test_marks(testdir, es_documents):  # pylint: disable=redefined-outer-name
     # create a temporary pytest test module
     testdir.makepyfile(
         """
@@ -481,7 +552,7 @@ def test_marks(testdir, requests_mock):  # pylint: disable=redefined-outer-name
     # make sure that we get a '0' exit code for the testsuite
     assert result.ret == 0
 
-    report = json.loads(requests_mock.request_history[0].text)
+    report = es_documents()[0]
     assert set(report["markers"]) == {"module_level", "class_level", "method_level"}
 
 
@@ -539,7 +610,7 @@ def test_no_post_reports(
     ), "Requests are not made to Elasticsearch when es_post_reports is False"
 
 
-def test_subtests(testdir, requests_mock):  # pylint: disable=redefined-outer-name
+def test_subtests(testdir, es_documents):  # pylint: disable=redefined-outer-name
     """Make sure subtests are identified and reported."""
 
     # create a temporary pytest test module
@@ -567,17 +638,129 @@ def test_subtests(testdir, requests_mock):  # pylint: disable=redefined-outer-na
     assert result.ret == 1
 
     # validate each subtest is being reported on its own
-    report = json.loads(requests_mock.request_history[-2].text)
+    report = es_documents()[-2]
     assert report["name"] == "test_subtests.py::test_failing_subtests"
     assert "subtest" not in report
     assert report["outcome"] == "passed"
 
-    report = json.loads(requests_mock.request_history[-3].text)
+    report = es_documents()[-3]
     assert report["name"] == "test_subtests.py::test_failing_subtests"
     assert report["subtest"] == "success subtest"
     assert report["outcome"] == "passed"
 
-    report = json.loads(requests_mock.request_history[-4].text)
+    report = es_documents()[-4]
     assert report["name"] == "test_subtests.py::test_failing_subtests"
     assert report["subtest"] == "failed subtest"
     assert report["outcome"] == "failure"
+
+
+def test_failure_fingerprint(
+    testdir, es_documents
+):  # pylint: disable=redefined-outer-name
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.mark.parametrize("i", range(3))
+        def test_fail(i):
+            raise ValueError("a long failure message " * 50)
+
+        def test_other_fail():
+            assert False
+        """
+    )
+
+    result = testdir.runpytest(
+        "--es-address=127.0.0.1:9200", "--es-failure-max-bytes=200", "-v"
+    )
+    assert result.ret == 1
+
+    first, second, third, other = es_documents()[:4]
+    assert first["failure_fingerprint"] == second["failure_fingerprint"]
+    assert first["failure_fingerprint"] == third["failure_fingerprint"]
+    assert first["failure_fingerprint"] != other["failure_fingerprint"]
+
+    assert "failure_message_truncated" not in first
+    assert first["failure_message"].count("a long failure message") > 50
+    assert second["failure_message_truncated"]
+    assert len(second["failure_message"].encode("utf-8")) <= 200
+    assert "bytes truncated" in second["failure_message"]
+    assert second["failure_message"].endswith(first["failure_message"][-80:])
+    assert "failure_message_truncated" not in other
+
+
+def test_failure_fingerprint_of_asserts(
+    testdir, es_documents
+):  # pylint: disable=redefined-outer-name
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.mark.parametrize("i", [500, 404])
+        def test_status(i):
+            assert i == 200
+        """
+    )
+
+    result = testdir.runpytest("--es-address=127.0.0.1:9200", "-v")
+    assert result.ret == 1
+
+    first, second = es_documents()[:2]
+    assert "500" in first["failure_message"] and "404" in second["failure_message"]
+    # the same assert failing with other values is the same failure
+    assert first["failure_fingerprint"] == second["failure_fingerprint"]
+
+
+def test_truncate_message():
+    message = "a" * 50 + "b" * 50
+    truncated = ElkReporter.truncate_message(message, 40)
+    assert truncated == "aaaaa\n...[90 bytes truncated]...\nbbbbb"
+    assert len(truncated.encode("utf-8")) <= 40
+
+    # multi-byte characters cut in the middle are dropped
+    truncated = ElkReporter.truncate_message("\u00e9" * 100, 40)
+    assert truncated == "\u00e9\u00e9\n...[192 bytes truncated]...\n\u00e9\u00e9"
+    assert len(truncated.encode("utf-8")) <= 40
+
+    # the marker doesn't fit
+    assert ElkReporter.truncate_message("x" * 100, 10) == "x" * 10
+    assert ElkReporter.truncate_message("x" * 20, 1) == "x"
+    assert ElkReporter.truncate_message("x" * 20, 20) == "x" * 20
+
+
+def test_normalize_session(
+    testdir, es_documents
+):  # pylint: disable=redefined-outer-name
+    testdir.makeini(
+        """
+        [pytest]
+        es_session_fields =
+            hostname
+        """
+    )
+    testdir.makepyfile(
+        """
+        def test_1():
+            pass
+        def test_2(elk_reporter):
+            definitions = elk_reporter.get_session_enrich_definitions()
+            assert "session_start_time" in definitions["policy"]["match"]["enrich_fields"]
+        """
+    )
+
+    result = testdir.runpytest(
+        "--es-address=127.0.0.1:9200", "--es-normalize-session", "-v"
+    )
+    assert result.ret == 0
+
+    session, test_1, test_2, summary = es_documents()
+    assert session["session_context"]
+    assert "session_start_time" in session
+    assert "username" in session
+    for test in (test_1, test_2):
+        assert test["session_id"] == session["session_id"]
+        assert "hostname" in test
+        assert "username" not in test
+        assert "session_start_time" not in test
+    assert summary["session_id"] == session["session_id"]
+    assert summary["stats"]["passed"] == 2
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+import json
+import datetime
+
+
+def test_index_template(testdir, requests_mock):  # pylint: disable=redefined-outer-name
+    template_url = "http://127.0.0.1:9200/_index_template/pytest-elk-reporter-test_data"
+    requests_mock.get(template_url, status_code=404, json={})
+    requests_mock.put(template_url, json={"acknowledged": True})
+    requests_mock.post(
+        "http://127.0.0.1:9200/test_data/_bulk", json={"errors": False, "items": []}
+    )
+    testdir.makepyfile(
+        """
+        def test_1():
+            pass
+        """
+    )
+
+    result = testdir.runpytest("--es-address=127.0.0.1:9200", "--es-index-template")
+    assert result.ret == 0
+    paths = [request.path for request in requests_mock.request_history]
+    # installed before the first document is posted
+    assert paths[:3] == [
+        "/_index_template/pytest-elk-reporter-test_data",
+        "/_index_template/pytest-elk-reporter-test_data",
+        "/test_data/_bulk",
+    ]
+    template = requests_mock.request_history[1].json()
+    assert template["index_patterns"] == ["test_data", "test_data-*"]
+    properties = template["template"]["mappings"]["properties"]
+    assert properties["name"] == {"type": "keyword"}
+    assert properties["duration"] == {"type": "float"}
+    assert properties["setup_duration"] == {"type": "float"}
+    assert properties["failure_message"]["index"] is False
+
+    # done once, the next sessions skip it
+    requests_mock.reset_mock()
+    result = testdir.runpytest("--es-address=127.0.0.1:9200", "--es-index-template")
+    assert result.ret == 0
+    assert {request.path for request in requests_mock.request_history} == {
+        "/test_data/_bulk"
+    }
+
+
+def test_index_template_already_installed(
+    testdir, requests_mock
+):  # pylint: disable=redefined-outer-name
+    template_url = "http://127.0.0.1:9200/_index_template/pytest-elk-reporter-test_data"
+    requests_mock.get(
+        template_url,
+        json={
+            "index_templates": [
+                {
+                    "name": "pytest-elk-reporter-test_data",
+                    "index_template": {
+                        "version": 1,
+                        "_meta": {
+                            "managed_by": "pytest-elk-reporter",
+                            "index_mode": "index",
+                            "retention_days": None,
+                        },
+                    },
+                }
+            ]
+        },
+    )
+    requests_mock.post(
+        "http://127.0.0.1:9200/test_data/_bulk", json={"errors": False, "items": []}
+    )
+    testdir.makepyfile(
+        """
+        def test_1():
+            pass
+        """
+    )
+
+    result = testdir.runpytest("--es-address=127.0.0.1:9200", "--es-index-template")
+    assert result.ret == 0
+    methods = [request.method for request in requests_mock.request_history]
+    assert methods[0] == "GET"
+    assert "PUT" not in methods
+
+
+def test_daily_indices(testdir, requests_mock):  # pylint: disable=redefined-outer-name
+    requests_mock.get(
+        "http://127.0.0.1:9200/_index_template/pytest-elk-reporter-test_data",
+        status_code=404,
+        json={},
+    )
+    requests_mock.put(
+        "http://127.0.0.1:9200/_index_template/pytest-elk-reporter-test_data",
+        json={"acknowledged": True},
+    )
+    requests_mock.put(
+        "http://127.0.0.1:9200/_ilm/policy/pytest-elk-reporter-test_data",
+        json={"acknowledged": True},
+    )
+    requests_mock.post(
+        "http://127.0.0.1:9200/test_data/_bulk", json={"errors": False, "items": []}
+    )
+    testdir.makepyfile(
+        """
+        def test_1():
+            pass
+        """
+    )
+
+    result = testdir.runpytest(
+        "--es-address=127.0.0.1:9200", "--es-index-mode=daily", "--es-ilm-retention=30"
+    )
+    assert result.ret == 0
+
+    history = requests_mock.request_history
+    policy, template = history[1].json(), history[2].json()
+    assert policy["policy"]["phases"] == {
+        "delete": {"min_age": "720h", "actions": {"delete": {}}}
+    }
+    assert template["template"]["aliases"] == {"test_data-history": {}}
+    assert (
+        template["template"]["settings"]["index.lifecycle.name"]
+        == "pytest-elk-reporter-test_data"
+    )
+    action = json.loads(history[3].body.splitlines()[0])
+    today = datetime.datetime.now(tz=datetime.timezone.utc)
+    assert action == {"index": {"_index": "test_data-{:%Y.%m.%d}".format(today)}}
+
+
+def test_data_stream(testdir, requests_mock):  # pylint: disable=redefined-outer-name
+    requests_mock.get(
+        "http://127.0.0.1:9200/_index_template/pytest-elk-reporter-test_data",
+        status_code=404,
+        json={},
+    )
+    requests_mock.put(
+        "http://127.0.0.1:9200/_index_template/pytest-elk-reporter-test_data",
+        json={"acknowledged": True},
+    )
+    requests_mock.post(
+        "http://127.0.0.1:9200/test_data/_bulk", json={"errors": False, "items": []}
+    )
+    testdir.makepyfile(
+        """
+        def test_1():
+            pass
+        """
+    )
+
+    result = testdir.runpytest(
+        "--es-address=127.0.0.1:9200", "--es-index-mode=data-stream"
+    )
+    assert result.ret == 0
+
+    template = requests_mock.request_history[1].json()
+    assert template["index_patterns"] == ["test_data"]
+    assert template["data_stream"] == {}
+    bulks = [
+        request.body.decode("utf-8").splitlines()
+        for request in requests_mock.request_history
+        if request.path == "/test_data/_bulk"
+    ]
+    for lines in bulks:
+        for action, document in zip(lines[::2], lines[1::2]):
+            assert json.loads(action) == {"create": {"_index": "test_data"}}
+            assert json.loads(document)["@timestamp"]
+
+
+def test_ilm_retention_needs_time_based_indices(testdir):
+    result = testdir.runpytest("--es-address=127.0.0.1:9200", "--es-ilm-retention=30")
+    assert result.ret != 0
+    result.stderr.fnmatch_lines(["*--es-ilm-retention needs*"])
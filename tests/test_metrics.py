@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from pytest_elk_reporter import ReporterMetrics
+
+
+def test_reporter_metrics(
+    testdir, es_documents
+):  # pylint: disable=redefined-outer-name
+    testdir.makepyfile(
+        """
+        def test_should_pass():
+            pass
+        """
+    )
+
+    result = testdir.runpytest("--es-address=127.0.0.1:9200", "-v")
+
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(
+        ["*elk-reporter metrics*", "http_bulk: *", "logreport: 3 calls, 0 failed*"]
+    )
+    metrics = es_documents()[-1]["reporter_metrics"]
+    assert metrics["logreport"]["count"] == 3
+    assert metrics["http_bulk"]["count"] == 1
+    assert metrics["http_bulk"]["failures"] == 0
+    assert sum(metrics["http_bulk"]["histogram"].values()) == 1
+    assert metrics["queue_depth_max"] >= 1
+    assert metrics["raw_bytes"] > 0
+
+
+def test_metrics_percentiles():
+    metrics = ReporterMetrics()
+    for millis in range(1, 101):
+        metrics.observe("lookup", millis / 1000.0, failed=millis > 98)
+
+    lookup = metrics.as_dict()["lookup"]
+    assert lookup["count"] == 100
+    assert lookup["failures"] == 2
+    assert lookup["p50_ms"] == 50
+    assert lookup["p95_ms"] == 100
+    assert lookup["max_ms"] == 100
+    assert ReporterMetrics.http_metric("test_data/_search?size=0") == "http_search"
+
+
+def test_memory_is_bounded(testdir):
+    """memory allocated by the reporter doesn't grow with the number of tests"""
+    testdir.makeconftest(
+        """
+        import json
+        import tracemalloc
+
+        CONFIG = []
+        SIZES = {}
+
+        def pytest_configure(config):
+            CONFIG.append(config)
+            tracemalloc.start()
+
+        def reporter_memory():
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(True, "*pytest_elk_reporter/*")]
+            )
+            return sum(stat.size for stat in snapshot.statistics("filename"))
+
+        def pytest_runtest_logfinish(nodeid, location):
+            if nodeid.endswith(("[100]", "[499]")):
+                elk = CONFIG[0].pluginmanager.get_plugin("elk-reporter-runtime")
+                assert not elk.reports and not elk.test_data
+                SIZES[nodeid.split("[")[-1][:-1]] = reporter_memory()
+
+        def pytest_unconfigure(config):
+            tracemalloc.stop()
+            with open("sizes.json", "w") as sizes_file:
+                json.dump(SIZES, sizes_file)
+        """
+    )
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.mark.parametrize("index", range(500))
+        def test_many(index, record_property, elk_reporter, request):
+            record_property("index", index)
+            elk_reporter.append_test_data(request, {"output": "x" * 1000})
+            print("x" * 100)
+        """
+    )
+
+    result = testdir.runpytest("--es-output-file=reports.ndjson", "-q")
+
+    assert result.ret == 0
+    sizes = json.loads(testdir.tmpdir.join("sizes.json").read())
+    assert sizes["499"] - sizes["100"] < 16 * 1024
@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import threading
+
+import pytest
+
+from pytest_elk_reporter import ReportSpool
+
+
+def test_bulk_shipping(
+    testdir, requests_mock, es_documents
+):  # pylint: disable=redefined-outer-name
+    testdir.makepyfile(
+        """
+        def test_1():
+            pass
+        def test_2():
+            pass
+        def test_3():
+            pass
+        """
+    )
+
+    result = testdir.runpytest(
+        "--es-address=127.0.0.1:9200",
+        "--es-bulk-max-docs=2",
+        "--es-bulk-flush-interval=60",
+        "-v",
+    )
+    assert result.ret == 0
+
+    bulk_requests = [
+        request
+        for request in requests_mock.request_history
+        if request.path == "/test_data/_bulk"
+    ]
+    assert len(bulk_requests) == 3
+    assert bulk_requests[0].headers["Content-Type"] == "application/x-ndjson"
+
+    documents = es_documents()
+    assert [doc.get("name") for doc in documents[:3]] == [
+        "test_bulk_shipping.py::test_1",
+        "test_bulk_shipping.py::test_2",
+        "test_bulk_shipping.py::test_3",
+    ]
+    shipping = documents[-1]["shipping"]
+    assert shipping.pop("raw_bytes") == shipping.pop("sent_bytes") > 0
+    assert shipping == dict(
+        documents=3, errors=0, failed_requests=0, spooled=0, replayed=0
+    )
+
+
+def test_bulk_item_errors(
+    testdir, requests_mock, es_documents
+):  # pylint: disable=redefined-outer-name
+    requests_mock.post(
+        "http://127.0.0.1:9200/test_data/_bulk",
+        json={
+            "errors": True,
+            "items": [
+                {"index": {"status": 400, "error": {"type": "mapper_parsing"}}},
+                {"index": {"status": 201}},
+            ],
+        },
+    )
+    testdir.makepyfile(
+        """
+        def test_1():
+            pass
+        def test_2():
+            pass
+        """
+    )
+
+    result = testdir.runpytest(
+        "--es-address=127.0.0.1:9200", "--es-bulk-flush-interval=60", "-v"
+    )
+    assert result.ret == 0
+
+    shipping = es_documents()[-1]["shipping"]
+    assert (shipping["documents"], shipping["errors"]) == (1, 1)
+
+
+def test_bulk_item_throttled(
+    testdir, requests_mock, es_documents
+):  # pylint: disable=redefined-outer-name
+    rejected = {"index": {"status": 429, "error": {"type": "es_rejected_execution"}}}
+    indexed = {"index": {"status": 201}}
+    requests_mock.post(
+        "http://127.0.0.1:9200/test_data/_bulk",
+        response_list=[
+            dict(
+                json={"errors": True, "items": [indexed, rejected]},
+                headers={"Retry-After": "0"},
+            ),
+            dict(json={"errors": False, "items": [indexed]}),
+            dict(
+                json={"errors": True, "items": [rejected]},
+                headers={"Retry-After": "0"},
+            ),
+        ],
+    )
+    testdir.makepyfile(
+        """
+        def test_1():
+            pass
+        def test_2():
+            pass
+        """
+    )
+    spool_dir = testdir.tmpdir / "spool"
+
+    result = testdir.runpytest(
+        "--es-address=127.0.0.1:9200",
+        "--es-bulk-flush-interval=60",
+        "--es-spool-dir={}".format(spool_dir),
+        "--es-max-retries=1",
+        "-v",
+    )
+    assert result.ret == 0
+
+    documents = es_documents()
+    # the rejected document was sent again
+    assert documents[1] == documents[2]
+    # the summary was still rejected after the retries, so it was spooled
+    spooled = spool_dir.listdir("spool-*.ndjson")[0].read().splitlines()
+    assert len(spooled) == 2
+    assert json.loads(spooled[1])["summery"]
+
+
+def test_spool_and_replay(
+    testdir, requests_mock, es_documents
+):  # pylint: disable=redefined-outer-name
+    requests_mock.post(
+        "http://127.0.0.1:9200/test_data/_bulk", text="unavailable", status_code=503
+    )
+    testdir.makepyfile(
+        """
+        def test_1():
+            pass
+        def test_2():
+            pass
+        """
+    )
+    spool_dir = testdir.tmpdir / "spool"
+
+    result = testdir.runpytest(
+        "--es-address=127.0.0.1:9200",
+        "--es-spool-dir={}".format(spool_dir),
+        "--es-max-retries=0",
+        "-v",
+    )
+    assert result.ret == 0
+    spool_files = spool_dir.listdir("spool-*.ndjson")
+    assert len(spool_files) == 1
+    spooled = spool_files[0].read().splitlines()
+    assert json.loads(spooled[0]) == {"index": {"_index": "test_data"}}
+    assert json.loads(spooled[1])["name"] == "test_spool_and_replay.py::test_1"
+    assert json.loads(spooled[-1])["summery"]
+
+    requests_mock.reset_mock()
+    requests_mock.post("http://127.0.0.1:9200/test_data/_bulk", json={})
+    result = testdir.runpytest(
+        "--es-address=127.0.0.1:9200", "--es-spool-dir={}".format(spool_dir), "-v"
+    )
+    assert result.ret == 0
+    assert spool_dir.listdir() == []
+
+    documents = es_documents()
+    assert len(documents) == 6
+    assert documents[-1]["shipping"]["replayed"] == 3
+
+
+def test_replay_of_a_missing_spool_file(
+    testdir, monkeypatch, requests_mock, es_documents
+):  # pylint: disable=redefined-outer-name
+    # e.g. removed by another session, in between
+    gone = str(testdir.tmpdir / "spool" / "spool-20200101000000-1-gone.replay")
+    monkeypatch.setattr(ReportSpool, "claim_leftovers", lambda self: [gone])
+    requests_mock.post("http://127.0.0.1:9200/test_data/_bulk", json={})
+    testdir.makepyfile(
+        """
+        def test_1():
+            pass
+        def test_2():
+            pass
+        """
+    )
+
+    result = testdir.runpytest(
+        "--es-address=127.0.0.1:9200",
+        "--es-spool-dir={}".format(testdir.tmpdir / "spool"),
+        "--es-flush-timeout=5",
+    )
+    assert result.ret == 0
+    # the documents of this session are still shipped
+    documents = es_documents()
+    assert len(documents) == 3
+    assert documents[-1]["shipping"]["documents"] == 2
+
+
+def test_flush_timeout_covers_closing(
+    testdir, requests_mock
+):  # pylint: disable=redefined-outer-name
+    release = threading.Event()
+
+    def slow_bulk(request, context):  # pylint: disable=unused-argument
+        release.wait(30)
+        return {"errors": False, "items": []}
+
+    requests_mock.post("http://127.0.0.1:9200/test_data/_bulk", json=slow_bulk)
+    testdir.makepyfile(
+        """
+        def test_1():
+            pass
+        """
+    )
+
+    start = time.monotonic()
+    try:
+        result = testdir.runpytest(
+            "--es-address=127.0.0.1:9200",
+            "--es-spool-dir={}".format(testdir.tmpdir / "spool"),
+            "--es-flush-timeout=2",
+        )
+        elapsed = time.monotonic() - start
+    finally:
+        release.set()
+    assert result.ret == 0
+    # flushing and closing the shipper wait 2 seconds in all, not 2 seconds each
+    assert 2 <= elapsed < 3.5
+
+
+def test_retry_throttled_requests(
+    testdir, requests_mock, es_documents
+):  # pylint: disable=redefined-outer-name
+    requests_mock.post(
+        "http://127.0.0.1:9200/test_data/_bulk",
+        response_list=[
+            dict(
+                text="too many requests", status_code=429, headers={"Retry-After": "0"}
+            ),
+            dict(text="unavailable", status_code=503, headers={"Retry-After": "0"}),
+            dict(json={}, status_code=200),
+        ],
+    )
+    testdir.makepyfile(
+        """
+        def test_1():
+            pass
+        """
+    )
+
+    result = testdir.runpytest(
+        "--es-address=127.0.0.1:9200", "--es-bulk-flush-interval=60", "-v"
+    )
+    assert result.ret == 0
+
+    assert requests_mock.call_count == 4
+    documents = es_documents()
+    assert documents[-1]["shipping"]["documents"] == 1
+    assert documents[-1]["shipping"]["failed_requests"] == 0
+
+
+def test_es_request_arguments(testdir, requests_mock):
+    requests_mock.get("http://127.0.0.1:9200/_cluster/health", json={})
+    testdir.makepyfile(
+        """
+        def test_1(elk_reporter):
+            res = elk_reporter.es_request(
+                "GET", "_cluster/health", timeout=3, headers={"X-Test": "1"}
+            )
+            assert res.status_code == 200
+        """
+    )
+
+    result = testdir.runpytest("--es-address=127.0.0.1:9200", "--es-api-key=abc")
+    assert result.ret == 0
+    request = next(
+        request
+        for request in requests_mock.request_history
+        if request.path == "/_cluster/health"
+    )
+    assert request.timeout == 3
+    assert request.headers["X-Test"] == "1"
+    assert request.headers["Authorization"] == "ApiKey abc"
+
+
+def test_asyncio_transport(testdir, es_server):  # pylint: disable=redefined-outer-name
+    pytest.importorskip("aiohttp")
+    testdir.makepyfile(
+        """
+        def test_1():
+            pass
+        def test_2():
+            pass
+        """
+    )
+
+    result = testdir.runpytest(
+        "--es-address={}".format(es_server.address),
+        "--es-transport=asyncio",
+        "--es-slices",
+        "--es-slices-lookup=per-test",
+        "-v",
+    )
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(["*0: 0:04:00 - 2*"])
+
+    searches = [body for path, body in es_server.requests if "/_search" in path]
+    assert len(searches) == 2
+    documents = [
+        json.loads(line)
+        for path, body in es_server.requests
+        if "/_bulk" in path
+        for line in body.splitlines()[1::2]
+    ]
+    assert [doc.get("name") for doc in documents] == [
+        "test_asyncio_transport.py::test_1",
+        "test_asyncio_transport.py::test_2",
+        None,
+    ]
+    assert documents[-1]["shipping"]["documents"] == 2
+
+
+def test_gzip(
+    testdir, requests_mock, es_documents
+):  # pylint: disable=redefined-outer-name
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.mark.parametrize("i", range(20))
+        def test_fail(i):
+            assert False, "a long and repetitive failure message" * 10
+        """
+    )
+
+    result = testdir.runpytest(
+        "--es-address=127.0.0.1:9200",
+        "--es-gzip",
+        "--es-gzip-level=9",
+        "--es-bulk-flush-interval=60",
+        "-v",
+    )
+    assert result.ret == 1
+
+    bulk_requests = [
+        request
+        for request in requests_mock.request_history
+        if request.path == "/test_data/_bulk"
+    ]
+    assert bulk_requests[0].headers["Content-Encoding"] == "gzip"
+
+    documents = es_documents()
+    assert len(documents) == 21
+    shipping = documents[-1]["shipping"]
+    assert shipping["sent_bytes"] * 5 < shipping["raw_bytes"]
+
+
+def test_output_file(testdir, requests_mock):
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.mark.parametrize("index", range(20))
+        def test_should_pass(index):
+            pass
+        """
+    )
+
+    result = testdir.runpytest(
+        "--es-output-file=reports/", "--es-output-max-bytes=2048", "-v"
+    )
+
+    result.stdout.fnmatch_lines(["*stats written to*"])
+    assert result.ret == 0
+    assert not requests_mock.called
+
+    filenames = sorted(testdir.tmpdir.join("reports").listdir())
+    assert len(filenames) > 1
+    documents = []
+    for filename in filenames:
+        lines = filename.read_text("utf-8").splitlines()
+        assert os.path.getsize(str(filename)) <= 2048
+        assert {json.loads(line)["index"]["_index"] for line in lines[::2]} == {
+            "test_data"
+        }
+        documents += [json.loads(line) for line in lines[1::2]]
+
+    assert len(documents) == 21
+    assert documents[-1]["summery"]
+    assert documents[-1]["output"]["documents"] == 20
+    # the stats are taken before the summary is written, which may start a file of its own
+    assert documents[-1]["output"]["files"] in (len(filenames) - 1, len(filenames))
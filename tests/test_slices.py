@@ -1,3 +1,13 @@
+import os
+import time
+import random
+import datetime
+
+import pytest
+
+from pytest_elk_reporter import ElkReporter, WorkQueue
+
+
 def test_history_slices(testdir):
     # create a temporary pytest test module
     testdir.makepyfile(
@@ -20,6 +30,7 @@ def test_history_slices(testdir):
         "-s",
         "--collect-only",
         "--es-slices",
+        "--es-slices-lookup=per-test",
         "--es-max-splice-time=4",
         "--es-address=127.0.0.1:9200",
     )
@@ -55,7 +66,584 @@ def test_history_slices(testdir):
         "-s",
         "--collect-only",
         "--es-slices",
+        "--es-slices-lookup=per-test",
         "--es-max-splice-time=4",
         "--es-address=127.0.0.1:9200",
         "--log-cli-level=debug",
     )
+
+
+def test_history_slices_aggregation(testdir, requests_mock, es_history, monkeypatch):
+    def bucket(name, duration):
+        return {
+            "key": {"name": "test_history_slices_aggregation.py::" + name},
+            "doc_count": 10,
+            "percentiles_duration": {"values": {"95.0": duration}},
+        }
+
+    es_history(
+        [bucket("test_1", 180.0), bucket("test_2", 60.0)], [bucket("test_3", 120.0)]
+    )
+    monkeypatch.setattr(ElkReporter, "history_page_size", lambda self: 2)
+    testdir.makepyfile(
+        """
+        def test_1():
+            pass
+        def test_2():
+            pass
+        def test_3():
+           pass
+        def test_4():
+           pass
+        """
+    )
+
+    result = testdir.runpytest(
+        "-v",
+        "-s",
+        "--collect-only",
+        "--es-slices",
+        "--es-max-splice-time=4",
+        "--es-default-test-time=60",
+        "--es-address=127.0.0.1:9200",
+    )
+    assert result.ret == 0
+
+    # one query per page, not one per test, and none after the last partial page
+    assert requests_mock.call_count == 2
+    query = requests_mock.request_history[0].json()
+    assert query["query"]["bool"]["filter"][0]["terms"]["name.keyword"] == [
+        "test_history_slices_aggregation.py::test_1",
+        "test_history_slices_aggregation.py::test_2",
+        "test_history_slices_aggregation.py::test_3",
+        "test_history_slices_aggregation.py::test_4",
+    ]
+    assert requests_mock.request_history[1].json()["aggs"]["tests"]["composite"][
+        "after"
+    ] == {"name": "page-0"}
+
+    result.stdout.fnmatch_lines(["*0: 0:04:00*"])
+    result.stdout.fnmatch_lines(["*1: 0:03:00*"])
+
+
+def test_history_slices_long_names(testdir, requests_mock):
+    requests_mock.post(
+        "http://127.0.0.1:9200/test_data/_search",
+        response_list=[
+            dict(json={"aggregations": {"tests": {"buckets": []}}}),
+            dict(
+                json={
+                    "aggregations": {
+                        "percentiles_duration": {"values": {"95.0": 180.0}}
+                    }
+                }
+            ),
+        ],
+    )
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.mark.parametrize("value", ["a" * 300])
+        def test_long(value):
+            pass
+        """
+    )
+
+    result = testdir.runpytest(
+        "-s",
+        "--collect-only",
+        "--es-slices",
+        "--es-max-splice-time=4",
+        "--es-address=127.0.0.1:9200",
+    )
+    assert result.ret == 0
+    # not indexed in `name.keyword`, so it's looked up on its own
+    assert requests_mock.call_count == 2
+    query = requests_mock.request_history[1].json()["query"]
+    assert "a" * 300 in query["query_string"]["query"]
+    result.stdout.fnmatch_lines(["*0: 0:03:00 - 1*"])
+
+
+def test_history_slices_exact_lookup(testdir, requests_mock):
+    requests_mock.get(
+        "http://127.0.0.1:9200/test_data/_mapping/field/name",
+        json={
+            "test_data": {
+                "mappings": {
+                    "name": {
+                        "full_name": "name",
+                        "mapping": {"name": {"type": "keyword"}},
+                    }
+                }
+            }
+        },
+    )
+    requests_mock.post(
+        "http://127.0.0.1:9200/test_data/_search",
+        json={"aggregations": {"tests": {"buckets": []}}},
+    )
+    testdir.makepyfile(
+        """
+        def test_1():
+            pass
+        """
+    )
+
+    result = testdir.runpytest(
+        "--collect-only",
+        "--es-slices",
+        "--es-index-template",
+        "--es-address=127.0.0.1:9200",
+    )
+    assert result.ret == 0
+
+    query = requests_mock.request_history[-1].json()
+    assert query["query"]["bool"]["filter"] == [
+        {"terms": {"name": ["test_history_slices_exact_lookup.py::test_1"]}},
+        {"term": {"outcome": "passed"}},
+    ]
+    assert query["aggs"]["tests"]["composite"]["sources"] == [
+        {"name": {"terms": {"field": "name"}}}
+    ]
+
+
+def test_history_slices_cache(testdir, requests_mock):
+    requests_mock.post(
+        "http://127.0.0.1:9200/test_data/_search",
+        json={
+            "aggregations": {
+                "tests": {
+                    "buckets": [
+                        {
+                            "key": {"name": "test_history_slices_cache.py::test_1"},
+                            "percentiles_duration": {"values": {"95.0": 180.0}},
+                        }
+                    ]
+                }
+            }
+        },
+    )
+    testdir.makepyfile(
+        """
+        def test_1():
+            pass
+        def test_2():
+            pass
+        """
+    )
+    args = [
+        "-s",
+        "--collect-only",
+        "--es-slices",
+        "--es-max-splice-time=4",
+        "--es-default-test-time=90",
+        "--es-address=127.0.0.1:9200",
+    ]
+
+    result = testdir.runpytest(*args)
+    assert result.ret == 0
+    assert requests_mock.call_count == 1
+    result.stdout.fnmatch_lines(["*0: 0:03:00*", "*1: 0:01:30*"])
+
+    # only the test without history is looked up again
+    result = testdir.runpytest(*args)
+    assert result.ret == 0
+    assert requests_mock.call_count == 2
+    assert requests_mock.request_history[-1].json()["query"]["bool"]["filter"][0][
+        "terms"
+    ]["name.keyword"] == ["test_history_slices_cache.py::test_2"]
+    result.stdout.fnmatch_lines(["*0: 0:03:00*", "*1: 0:01:30*"])
+
+    # nothing is looked up when offline
+    result = testdir.runpytest(*args, "--es-offline")
+    assert result.ret == 0
+    assert requests_mock.call_count == 2
+    result.stdout.fnmatch_lines(["*0: 0:03:00*", "*1: 0:01:30*"])
+
+
+def test_history_window_and_branch(testdir, requests_mock):
+    requests_mock.post(
+        "http://127.0.0.1:9200/test_data/_search",
+        json={"aggregations": {"tests": {"buckets": []}}},
+    )
+    testdir.makepyfile(
+        """
+        def test_1():
+            pass
+        """
+    )
+
+    result = testdir.runpytest(
+        "--collect-only",
+        "--es-slices",
+        "--es-history-window=30",
+        "--es-history-branch=feature",
+        "--es-history-cache-ttl=0",
+        "--es-address=127.0.0.1:9200",
+    )
+    assert result.ret == 0
+
+    window = {"range": {"timestamp": {"gte": "now-43200m"}}}
+    branch = {"term": {"git_branch.keyword": "feature"}}
+    first, second = [request.json() for request in requests_mock.request_history]
+    assert first["query"]["bool"]["filter"][2:] == [window, branch]
+    # nothing found on the branch, so the test is looked up on all the branches
+    assert second["query"]["bool"]["filter"][2:] == [window]
+
+
+def test_history_samples_weighted(testdir, requests_mock, es_history):
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+
+    def hit(duration, days_ago):
+        timestamp = now - datetime.timedelta(days=days_ago)
+        return {"_source": {"duration": duration, "timestamp": timestamp.isoformat()}}
+
+    es_history(
+        [
+            {
+                "key": {"name": "test_history_samples_weighted.py::test_1"},
+                "recent": {
+                    "hits": {
+                        "hits": [
+                            hit(60.0, 0),
+                            hit(60.0, 1),
+                            # slow a long time ago, it barely counts
+                            hit(600.0, 90),
+                        ]
+                    }
+                },
+            }
+        ]
+    )
+    testdir.makepyfile(
+        """
+        def test_1():
+            pass
+        """
+    )
+
+    result = testdir.runpytest(
+        "-s",
+        "--collect-only",
+        "--es-slices",
+        "--es-history-samples=3",
+        "--es-history-half-life=7",
+        "--es-address=127.0.0.1:9200",
+    )
+    assert result.ret == 0
+
+    query = requests_mock.request_history[0].json()
+    assert query["aggs"]["tests"]["aggs"]["recent"]["top_hits"]["size"] == 3
+    result.stdout.fnmatch_lines(["*0: 0:01:00*"])
+
+
+@pytest.mark.parametrize("samples", [0, 101])
+def test_history_samples_bounds(testdir, samples):
+    result = testdir.runpytest(
+        "--es-slices",
+        "--es-history-samples={}".format(samples),
+        "--es-address=127.0.0.1:9200",
+    )
+    assert result.ret != 0
+    result.stderr.fnmatch_lines(["*--es-history-samples should be between 1 and 100*"])
+
+
+def test_weighted_percentile():
+    assert ElkReporter.weighted_percentile([], 0.95) is None
+    samples = [(value, 1.0) for value in range(1, 101)]
+    assert ElkReporter.weighted_percentile(samples, 0.95) == 95
+    assert ElkReporter.weighted_percentile(samples, 0.5) == 50
+    assert ElkReporter.weighted_percentile([(10, 1.0), (100, 0.01)], 0.95) == 10
+    assert ElkReporter.weighted_percentile([(10, 1.0), (100, 1.0)], 0.95) == 100
+
+
+def test_make_test_slices():
+    rand = random.Random(0)
+    test_data = [
+        dict(test_name="test_{}".format(i), duration=rand.uniform(1, 300))
+        for i in range(1000)
+    ]
+    # a test longer than a slice gets a slice of its own
+    test_data.append(dict(test_name="test_long", duration=7200))
+
+    slices = ElkReporter.make_test_slices(list(test_data), max_slice_duration=3600)
+
+    assert slices == ElkReporter.make_test_slices(
+        list(reversed(test_data)), max_slice_duration=3600
+    )
+    assert sorted(sum((s["tests"] for s in slices), [])) == sorted(
+        test["test_name"] for test in test_data
+    )
+    assert slices[0] == dict(total=7200.0, tests=["test_long"])
+    assert all(s["total"] <= 3600 for s in slices[1:])
+    assert ElkReporter.slices_imbalance(slices[1:]) < 0.05
+
+
+def test_make_fixed_test_slices():
+    rand = random.Random(0)
+    test_data = [
+        dict(test_name="test_{}".format(i), duration=rand.uniform(1, 300))
+        for i in range(1000)
+    ]
+
+    slices = ElkReporter.make_fixed_test_slices(list(test_data), slices_count=7)
+
+    assert len(slices) == 7
+    assert slices == ElkReporter.make_fixed_test_slices(
+        list(reversed(test_data)), slices_count=7
+    )
+    assert sorted(sum((s["tests"] for s in slices), [])) == sorted(
+        test["test_name"] for test in test_data
+    )
+    assert ElkReporter.slices_imbalance(slices) < 0.001
+
+    # a refinement pass improves on plain longest-first packing
+    test_data = [dict(test_name=str(d), duration=d) for d in (3, 3, 2, 2, 2)]
+    slices = ElkReporter.make_fixed_test_slices(test_data, slices_count=2)
+    assert sorted(s["total"] for s in slices) == [6, 6]
+
+    # more slices than tests, leaves empty slices
+    slices = ElkReporter.make_fixed_test_slices(test_data[:1], slices_count=2)
+    assert slices == [dict(total=3.0, tests=["3"]), dict(total=0, tests=[])]
+
+
+def test_history_slices_count(testdir):
+    testdir.makepyfile(
+        """
+        def test_1():
+            pass
+        def test_2():
+            pass
+        def test_3():
+           pass
+        """
+    )
+
+    result = testdir.runpytest(
+        "-s",
+        "--collect-only",
+        "--es-slices-count=2",
+        "--es-default-test-time=60",
+        "--es-offline",
+    )
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(["*0: 0:02:00 - 2*", "*1: 0:01:00 - 1*"])
+    assert (testdir.tmpdir / "include_000.txt").exists()
+    assert (testdir.tmpdir / "include_001.txt").exists()
+    assert not (testdir.tmpdir / "include_002.txt").exists()
+
+
+def test_make_work_chunks():
+    rand = random.Random(0)
+    test_data = [
+        dict(test_name="test_{}".format(i), duration=rand.uniform(1, 300))
+        for i in range(1000)
+    ]
+
+    chunks = ElkReporter.make_work_chunks(test_data, agents=8)
+
+    assert sorted(sum((chunk["tests"] for chunk in chunks), [])) == sorted(
+        test["test_name"] for test in test_data
+    )
+    # the longest tests are pulled first, and chunks shrink towards the end
+    assert (
+        chunks[0]["tests"][0]
+        == max(test_data, key=lambda t: t["duration"])["test_name"]
+    )
+    assert chunks[-1]["total"] < chunks[0]["total"] / 10
+    total = sum(test["duration"] for test in test_data)
+    assert all(chunk["total"] <= total / 32 + 300 for chunk in chunks)
+
+
+def test_work_queue(testdir, requests_mock):
+    requests_mock.post(
+        "http://127.0.0.1:9200/test_data/_search",
+        json={"aggregations": {"tests": {"buckets": []}}},
+    )
+    testdir.makeconftest(
+        """
+        import pytest
+
+        @pytest.fixture(scope="session", autouse=True)
+        def session_setup():
+            with open("setups.txt", "a") as setups:
+                setups.write("setup\\n")
+        """
+    )
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.mark.parametrize("index", range(20))
+        def test_pull(index):
+            pass
+        """
+    )
+
+    result = testdir.runpytest(
+        "--collect-only",
+        "--es-slices-count=2",
+        "--es-default-test-time=60",
+        "--es-work-queue=queue",
+        "--es-address=127.0.0.1:9200",
+    )
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(["* chunks published to [[]queue[]], for 2 agents"])
+
+    # another agent got the first chunk
+    other_claim, other_tests = WorkQueue("queue", owner="other").claim()
+    assert other_tests
+
+    result = testdir.runpytest("--es-work-queue=queue")
+    assert result.ret == 0
+    result.assert_outcomes(passed=20 - len(other_tests))
+    result.stdout.fnmatch_lines(
+        ["*pulled * chunks, {} tests*".format(20 - len(other_tests))]
+    )
+    # session fixtures aren't torn down between chunks
+    assert testdir.tmpdir.join("setups.txt").read() == "setup\n"
+
+    # the chunks that ran are gone, only the one of the other agent is left
+    assert os.listdir("queue") == [os.path.basename(other_claim)]
+
+    # nothing left for a late agent
+    result = testdir.runpytest("--es-work-queue=queue")
+    assert result.ret == 0
+    result.assert_outcomes()
+    result.stdout.fnmatch_lines(["*pulled 0 chunks, 0 tests*"])
+
+    # the other agent stopped touching its chunk, so it's pulled again
+    an_hour_ago = time.time() - 3600
+    os.utime(other_claim, (an_hour_ago, an_hour_ago))
+    result = testdir.runpytest("--es-work-queue=queue")
+    assert result.ret == 0
+    result.assert_outcomes(passed=len(other_tests))
+    result.stdout.fnmatch_lines(
+        ["*pulled 1 chunks, {} tests*".format(len(other_tests))]
+    )
+    assert os.listdir("queue") == []
+
+
+def test_make_test_groups():
+    test_data = [
+        dict(test_name="a.py::test_1", duration=10.0, setup_duration=100.0),
+        dict(test_name="a.py::test_2", duration=20.0, setup_duration=0.1),
+        dict(test_name="a.py::test_3", duration=30.0, setup_duration=0.1),
+        dict(test_name="b.py::test_1", duration=40.0, setup_duration=None),
+    ]
+    groups = {
+        "a.py": ["a.py::test_1", "a.py::test_2", "a.py::test_3"],
+        "b.py::test_1": ["b.py::test_1"],
+    }
+
+    units = ElkReporter.make_test_groups(test_data, groups)
+    assert units == [
+        dict(
+            test_name="a.py",
+            duration=160.0,
+            tests=["a.py::test_1", "a.py::test_2", "a.py::test_3"],
+        ),
+        dict(test_name="b.py::test_1", duration=40.0, tests=["b.py::test_1"]),
+    ]
+
+    # an oversized group is split, each part paying the setup again
+    units = ElkReporter.make_test_groups(test_data, groups, max_group_duration=140)
+    assert [(unit["test_name"], unit["duration"]) for unit in units] == [
+        ("a.py#0", 130.0),
+        ("a.py#1", 130.0),
+        ("b.py::test_1", 40.0),
+    ]
+
+    slices = ElkReporter.make_fixed_test_slices(units, slices_count=2)
+    ElkReporter.expand_test_groups(slices, units)
+    assert sorted(current_slice["tests"] for current_slice in slices) == [
+        ["a.py::test_1", "a.py::test_2", "b.py::test_1"],
+        ["a.py::test_3"],
+    ]
+
+
+def test_history_slices_grouped(testdir, requests_mock, es_history):
+    def bucket(name, duration, setup_duration):
+        return {
+            "key": {"name": "test_history_slices_grouped.py::" + name},
+            "doc_count": 10,
+            "percentiles_duration": {"values": {"95.0": duration}},
+            "percentiles_setup_duration": {"values": {"95.0": setup_duration}},
+        }
+
+    es_history(
+        [
+            bucket("test_db_1", 10.0, 300.0),
+            bucket("test_db_2", 10.0, 0.1),
+            bucket("TestServer::test_1", 10.0, 200.0),
+            bucket("TestServer::test_2", 10.0, 0.1),
+            bucket("test_free_1", 60.0, 0.1),
+            bucket("test_free_2", 60.0, 0.1),
+        ]
+    )
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.fixture(scope="module")
+        def database():
+            pass
+
+        @pytest.fixture(scope="class")
+        def server():
+            pass
+
+        def test_db_1(database):
+            pass
+
+        def test_free_1():
+            pass
+
+        class TestServer:
+            def test_1(self, server):
+                pass
+
+            def test_2(self, server):
+                pass
+
+        def test_free_2():
+            pass
+
+        def test_db_2(database):
+            pass
+        """
+    )
+
+    result = testdir.runpytest(
+        "-s",
+        "--collect-only",
+        "--es-slices-count=2",
+        "--es-slices-group=module",
+        "--es-address=127.0.0.1:9200",
+    )
+    assert result.ret == 0
+    aggs = requests_mock.request_history[0].json()["aggs"]["tests"]["aggs"]
+    assert aggs["percentiles_setup_duration"]["percentiles"]["field"] == (
+        "setup_duration"
+    )
+
+    slices = []
+    for index in range(2):
+        with open(str(testdir.tmpdir / "include_{:03d}.txt".format(index))) as f:
+            slices.append(f.read().splitlines())
+    # the tests sharing the module and the class fixtures stay together
+    assert sorted(slices) == [
+        [
+            "test_history_slices_grouped.py::TestServer::test_1",
+            "test_history_slices_grouped.py::TestServer::test_2",
+            "test_history_slices_grouped.py::test_free_1",
+            "test_history_slices_grouped.py::test_free_2",
+        ],
+        [
+            "test_history_slices_grouped.py::test_db_1",
+            "test_history_slices_grouped.py::test_db_2",
+        ],
+    ]
+    # the setups are paid once, instead of in each slice
+    result.stdout.fnmatch_lines(["2 slices, * estimated compute: 0:11:00.2*"])
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+import pytest
+
+from pytest_elk_reporter import upload_main
+
+
+def write_reports(testdir, count):
+    testdir.makepyfile(
+        test_reports="""
+        import pytest
+
+        @pytest.mark.parametrize("index", range({}))
+        def test_should_pass(index):
+            pass
+        """.format(
+            count
+        )
+    )
+    result = testdir.runpytest("--es-output-file=reports/")
+    assert result.ret == 0
+    return testdir.tmpdir.join("reports")
+
+
+def test_upload(testdir, requests_mock, es_documents):
+    reports_dir = write_reports(testdir, 12)
+    requests_mock.post(
+        "http://127.0.0.1:9200/test_data/_bulk", json={"errors": False, "items": []}
+    )
+
+    assert (
+        upload_main(
+            [str(reports_dir), "--es-address=127.0.0.1:9200", "--es-bulk-max-docs=5"]
+        )
+        == 0
+    )
+    documents = es_documents()
+    assert len(documents) == 13
+    assert requests_mock.call_count == 3
+    # chunks are sent concurrently, so the summary isn't necessarily the last one
+    assert [doc for doc in documents if doc.get("summery")]
+
+    # everything was uploaded, so there's nothing to resume
+    assert upload_main([str(reports_dir), "--es-address=127.0.0.1:9200"]) == 0
+    assert requests_mock.call_count == 3
+
+
+def test_upload_resume(testdir, requests_mock, es_documents):
+    reports_dir = write_reports(testdir, 12)
+    args = [
+        str(reports_dir),
+        "--es-address=127.0.0.1:9200",
+        "--es-bulk-max-docs=5",
+        "--es-max-retries=0",
+        "--concurrency=1",
+    ]
+    requests_mock.post(
+        "http://127.0.0.1:9200/test_data/_bulk",
+        response_list=[
+            dict(json={"errors": False, "items": []}),
+            dict(text="unavailable", status_code=503),
+        ],
+    )
+    assert upload_main(args) == 1
+    # the failed chunk stops the upload of that file
+    assert requests_mock.call_count == 2
+
+    requests_mock.reset_mock()
+    requests_mock.post(
+        "http://127.0.0.1:9200/test_data/_bulk", json={"errors": False, "items": []}
+    )
+    assert upload_main(args) == 0
+    documents = es_documents()
+    # resumed after the first chunk
+    assert len(documents) == 8
+    assert documents[-1]["summery"]
+
+
+def test_upload_retry_rejected_documents(testdir, requests_mock, es_documents):
+    reports_dir = write_reports(testdir, 2)
+    rejected = {"index": {"status": 429, "error": {"type": "es_rejected_execution"}}}
+    indexed = {"index": {"status": 201}}
+    requests_mock.post(
+        "http://127.0.0.1:9200/test_data/_bulk",
+        response_list=[
+            dict(
+                json={"errors": True, "items": [indexed, rejected, indexed]},
+                headers={"Retry-After": "0"},
+            ),
+            dict(json={"errors": False, "items": [indexed]}),
+        ],
+    )
+
+    assert (
+        upload_main([str(reports_dir), "--es-address=127.0.0.1:9200", "--checkpoint="])
+        == 0
+    )
+    documents = es_documents()
+    assert len(documents) == 4
+    assert documents[1] == documents[3]
+    assert json.loads(requests_mock.request_history[1].body.splitlines()[0]) == {
+        "index": {"_index": "test_data"}
+    }
+
+
+def test_upload_ini_without_conftest(testdir, requests_mock, es_documents):
+    reports_dir = write_reports(testdir, 2)
+    testdir.makeini(
+        """
+        [pytest]
+        es_address = 127.0.0.1:9200
+        es_index_name = uploaded
+        """
+    )
+    testdir.makeconftest(
+        """
+        raise AssertionError("conftest.py shouldn't be imported")
+        """
+    )
+    requests_mock.post(
+        "http://127.0.0.1:9200/uploaded/_bulk", json={"errors": False, "items": []}
+    )
+
+    assert upload_main([str(reports_dir), "--checkpoint="]) == 0
+    assert len(es_documents()) == 3
+    # the files were written for test_data, the index of the ini file replaces it
+    actions = [
+        json.loads(line)
+        for request in requests_mock.request_history
+        for line in request.body.splitlines()[::2]
+    ]
+    assert actions == [{"index": {"_index": "uploaded"}}] * 3
+    # -o overrides the ini file, like in a test session
+    with pytest.raises(SystemExit):
+        upload_main([str(reports_dir), "--checkpoint=", "-o", "es_address="])
@@ -1,3 +1,6 @@
+import re
+
+
 def test_xdist(testdir):  # pylint: disable=redefined-outer-name
     # create a temporary pytest test module
     testdir.makepyfile(
@@ -42,3 +45,104 @@ def test_without_xdist(testdir):  # pylint: disable=redefined-outer-name
     # fnmatch_lines does an assertion internally
     result.stdout.fnmatch_lines(["test_without_xdist.py::test_1*PASSED"])
     result.stdout.fnmatch_lines(["test_without_xdist.py::test_2*PASSED"])
+
+
+def test_xdist_controller_shipping(
+    testdir, es_documents
+):  # pylint: disable=redefined-outer-name
+    testdir.makeconftest(
+        """
+        import pytest
+
+        @pytest.fixture(scope="session", autouse=True)
+        def report_formal_version_to_elk(request):
+            elk = request.config.pluginmanager.get_plugin("elk-reporter-runtime")
+            elk.session_data.update(formal_version="1.0.0-rc2")
+        """
+    )
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.mark.mark1
+        def test_1(request, elk_reporter):
+            elk_reporter.append_test_data(request, {"my_key": 1})
+
+        def test_2():
+            assert False
+        """
+    )
+
+    result = testdir.runpytest("--es-address=127.0.0.1:9200", "-v", "-n", "2")
+    assert result.ret == 1
+
+    documents = es_documents()
+    tests = {doc["name"]: doc for doc in documents if "name" in doc}
+    assert set(tests) == {
+        "test_xdist_controller_shipping.py::test_1",
+        "test_xdist_controller_shipping.py::test_2",
+    }
+    test_1 = tests["test_xdist_controller_shipping.py::test_1"]
+    assert test_1["my_key"] == 1
+    assert test_1["markers"] == ["mark1"]
+    assert test_1["formal_version"] == "1.0.0-rc2"
+    assert tests["test_xdist_controller_shipping.py::test_2"]["outcome"] == "failure"
+
+    summaries = [doc for doc in documents if doc.get("summery")]
+    assert len(summaries) == 1
+    assert summaries[0]["stats"]["passed"] == 1
+    assert summaries[0]["stats"]["failure"] == 1
+    assert summaries[0]["formal_version"] == "1.0.0-rc2"
+
+
+def test_xdist_controller_keeps_its_session_data(
+    testdir, es_documents
+):  # pylint: disable=redefined-outer-name
+    testdir.makepyfile(
+        """
+        def test_worker(elk_reporter):
+            # the controller collects the context and spools, not the workers
+            assert elk_reporter.is_slave
+            assert elk_reporter.session_data == {}
+            assert elk_reporter.context.thread.ident is None
+            assert elk_reporter.spool is None
+        """
+    )
+
+    result = testdir.runpytest("--es-address=127.0.0.1:9200", "-v", "-n", "1")
+    assert result.ret == 0
+
+    test, summary = es_documents()
+    assert test["outcome"] == "passed"
+    assert test["session_start_time"] == summary["session_start_time"]
+    assert summary["hostname"]
+
+
+def test_xdist_longest_first(testdir, es_history):
+    def bucket(index):
+        return {
+            "key": {"name": "test_xdist_longest_first.py::test_{}".format(index)},
+            "percentiles_duration": {"values": {"95.0": index + 1.0}},
+        }
+
+    es_history([bucket(index) for index in range(8)])
+    testdir.makepyfile(
+        "\n".join("def test_{}():\n    pass\n".format(index) for index in range(8))
+    )
+
+    result = testdir.runpytest(
+        "--es-address=127.0.0.1:9200",
+        "--es-xdist-schedule=longest-first",
+        "-v",
+        "-n",
+        "2",
+    )
+    assert result.ret == 0
+
+    first_tests = {}
+    for line in result.outlines:
+        match = re.match(r"\[(gw\d)\].* PASSED .*::(test_\d)", line)
+        if match:
+            first_tests.setdefault(match.group(1), match.group(2))
+    # the two longest tests started first, each on its own worker
+    assert sorted(first_tests.values()) == ["test_6", "test_7"]